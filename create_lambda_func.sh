@@ -21,6 +21,8 @@ cp -pr "releases_scanner.py" "${STAGING_DIR}/"
 cp -pr "nightly_scanner.py" "${STAGING_DIR}/"
 cp -pr "graph_analyzer.py" "${STAGING_DIR}/"
 cp -pr "parquet_collator.py" "${STAGING_DIR}/"
+cp -pr "event_ingester.py" "${STAGING_DIR}/"
+cp -pr "dataset_compactor.py" "${STAGING_DIR}/"
 
 cp -p *.yml "${STAGING_DIR}/"
 
@@ -77,7 +79,7 @@ echo "2. Visit https://console.aws.amazon.com/lambda/home?region=us-east-1#/func
 echo "3. For each measuring_ci function, under 'Function code' choose a 'Code entry type' of 'Upload a file from Amazon S3'"
 echo "Paste the above s3 url into the box"
 echo "4. Ensure the Handler is set correctly if not using lambda_function:lambda_handler()"
-echo "5. Under 'Basic Settings' ensure the Memory usage is at 512Mb and Timeout is at least 2 minutes."
+echo "5. Under 'Basic Settings' ensure the Memory usage is at 512Mb and Timeout is at least 2 minutes, and matches analyzer_timeout in the config."
 echo "6. Click 'Save' at the top of the page"
 
 echo ""
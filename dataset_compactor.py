@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+import pandas as pd
+import yaml
+
+from measuring_ci.dataset import COMPACT_MIN_FILES, PARTITION_COLUMNS, append_rows, compact_dataset
+from measuring_ci.layout import layout_options
+
+LOG_LEVEL = logging.INFO
+
+# AWS artisinal log handling, they've already set up a handler by the time we get here
+log = logging.getLogger()
+log.setLevel(LOG_LEVEL)
+
+
+def parse_args():
+    """Extract arguments."""
+    parser = argparse.ArgumentParser(description="Compact a partitioned cost dataset")
+    parser.add_argument('--config', type=str, default='scanner.yml')
+    parser.add_argument('--project', type=str, default=None,
+                        help="Only compact this project's partitions")
+    parser.add_argument('--month', type=str, action='append', default=None,
+                        help="Only compact this month's partitions, YYYY-MM. May be repeated")
+    parser.add_argument('--min-files', type=int, default=COMPACT_MIN_FILES,
+                        help="Leave partitions with fewer files than this alone")
+    parser.add_argument('--import-legacy', action='store_true',
+                        help="First copy the rows of the single-file total_cost_output into the dataset")
+    return parser.parse_args()
+
+
+def import_legacy_costs(filename, dataset, partition_cols, layout=None):
+    """Copy a single-file cost output into a dataset, returning the rows copied."""
+    costs = pd.read_parquet(filename)
+    log.info("Importing %d rows from %s", len(costs), filename)
+    append_rows(dataset, costs, partition_cols=partition_cols, layout=layout)
+    return len(costs)
+
+
+async def main(args):
+    """What to do."""
+    with open(args['config'], 'r') as yamlfile:
+        config = yaml.load(yamlfile)
+    dataset = config['cost_dataset']
+    partition_cols = config.get('cost_partitions', PARTITION_COLUMNS)
+
+    result = {'imported': 0}
+    if args.get('import_legacy'):
+        filename = config['total_cost_output']
+        if args.get('project'):
+            filename = filename.format(project=args['project'].split('/')[-1])
+        result['imported'] = import_legacy_costs(filename, dataset, partition_cols, layout=layout_options(config))
+
+    filters = dict()
+    if args.get('project') and 'project' in partition_cols:
+        filters['project'] = [args['project'].split('/')[-1]]
+    if args.get('month'):
+        filters['month'] = args['month']
+    result['compacted'] = compact_dataset(dataset, partition_cols, filters=filters or None,
+                                          min_files=args.get('min_files', COMPACT_MIN_FILES),
+                                          layout=layout_options(config))
+    log.info("Compacted %d partitions of %s", result['compacted'], dataset)
+    return result
+
+
+def lambda_handler(args, context):
+    """AWS entrypoint."""
+    assert context  # not current used
+    if 'config' not in args:
+        args['config'] = 'scanner.yml'
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(main(args))
+
+
+if __name__ == "__main__":
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+    lambda_handler(vars(parse_args()), 'foo')
@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import logging
+
+import aiohttp
+import yaml
+
+from measuring_ci.events import EventEnricher, FileEventSource, MemoryEventSource, ingest_events
+from measuring_ci.jobqueue import open_job_queue
+
+LOG_LEVEL = logging.INFO
+
+# AWS artisinal log handling, they've already set up a handler by the time we get here
+log = logging.getLogger()
+log.setLevel(LOG_LEVEL)
+# some modules are very chatty
+logging.getLogger("taskcluster").setLevel(logging.INFO)
+logging.getLogger("aiohttp").setLevel(logging.INFO)
+
+
+def parse_args():
+    """Parse arguments if run on command line."""
+    parser = argparse.ArgumentParser(description="Queue analysis of task groups as they resolve")
+    parser.add_argument('--events', type=str, required=True,
+                        help="File of task-group-resolved messages, one JSON document per line")
+    parser.add_argument('--job-queue', type=str, default=None,
+                        help="Job queue to add graphs to, e.g. sqlite:///tmp/analysis.db. Default: the config's job_queue")
+    parser.add_argument('--config', type=str, default='scanner.yml',
+                        help="Pushlog scanner configuration, for its pushlog caches")
+    parser.add_argument('--projects', type=str, nargs='+', default=['mozilla-central'],
+                        help="Projects to analyze push graphs for")
+    parser.add_argument('--product', type=str, default='firefox')
+    return parser.parse_args()
+
+
+async def main(args):
+    """Enqueue analysis for every task group in the events."""
+    with open(args['config'], 'r') as yamlfile:
+        config = yaml.load(yamlfile)
+
+    if 'messages' in args:
+        source = MemoryEventSource(args['messages'])
+        source.close()
+    else:
+        source = FileEventSource(args['events'])
+
+    job_queue_url = args.get('job_queue') or config.get('job_queue')
+    if not job_queue_url:
+        raise ValueError("No job queue to add graphs to; pass job_queue or set it in {}".format(args['config']))
+    job_queue = open_job_queue(job_queue_url)
+    async with aiohttp.ClientSession() as session:
+        enricher = EventEnricher(args['projects'], config, product=args.get('product', 'firefox'), session=session)
+        counts = await ingest_events(source, enricher, job_queue)
+
+    log.info("%d events: %d graphs queued, %d already known, %d ignored",
+             counts['events'], counts['queued'], counts['known'], counts['ignored'])
+    return counts
+
+
+def lambda_handler(args, context):
+    """AWS entrypoint, taking the messages themselves as {'messages': [...]}.
+
+    The job queue must outlive the invocation, so set job_queue in the
+    config to an sqs:// queue.
+    """
+    assert context  # not current used
+    if 'config' not in args:
+        args['config'] = 'scanner.yml'
+    if 'projects' not in args:
+        args['projects'] = ['mozilla-central']
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(main(args))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL)
+    # Use command-line arguments instead of json blob if not running in AWS Lambda
+    lambda_handler(vars(parse_args()), {'dummy': 1})
@@ -1,13 +1,22 @@
+import argparse
 import asyncio
 import logging
 import os
+import sys
 
+import aiohttp
 import pandas as pd
 import yaml
 
-from measuring_ci.artifacts import get_artifact_costs
+from measuring_ci.artifacts import get_artifact_costs, get_task_artifact_costs
 from measuring_ci.costs import fetch_all_worker_costs, taskgraph_cost
-from taskhuddler.aio.graph import TaskGraph
+from measuring_ci.dispatch import BATCH_CONCURRENCY
+from measuring_ci.examined import record_examined
+from measuring_ci.files import remove_files
+from measuring_ci.incremental import load_progress, progress_complete, progress_summary, progress_tasks, save_progress, update_progress
+from measuring_ci.jobqueue import VISIBILITY_TIMEOUT, open_job_queue
+from measuring_ci.manifest import add_manifest_entry, staged_file_name
+from measuring_ci.taskgraph import TaskGraph
 
 LOG_LEVEL = logging.INFO
 
@@ -18,6 +27,9 @@ log.setLevel(LOG_LEVEL)
 logging.getLogger("taskcluster").setLevel(logging.INFO)
 logging.getLogger("aiohttp").setLevel(logging.INFO)
 
+# Worker cost tables by csv file, kept between graphs analyzed by one process.
+_worker_costs = dict()
+
 
 def load_parquet(filename, columns):
     """Load existing parquet file or an empty one."""
@@ -30,26 +42,102 @@ def load_parquet(filename, columns):
     return df
 
 
-async def analyze_taskgraph(args, config):
+def load_worker_costs(config):
+    """Fetch worker costs, reusing them for later graphs in the same process."""
+    key = (config['costs_csv_file'], config.get('costs_scriptworker_csv_file'))
+    if key not in _worker_costs:
+        log.info("Fetching worker costs")
+        _worker_costs[key] = fetch_all_worker_costs(
+            tc_csv_filename=config['costs_csv_file'],
+            scriptworker_csv_filename=config.get('costs_scriptworker_csv_file'),
+        )
+    return _worker_costs[key]
 
-    log.info("Examining taskgraph %s", args['groupid'])
-    graph = await TaskGraph(args['groupid'])
 
-    log.info("Fetching worker costs")
-    worker_costs = fetch_all_worker_costs(
-        tc_csv_filename=config['costs_csv_file'],
-        scriptworker_csv_filename=config.get('costs_scriptworker_csv_file'),
-    )
+async def analyze_progress(args, config, raw_data, worker_costs, session=None):
+    """Bring a graph's progress record up to date and fill in its costs so far.
 
-    log.info("Calculating costs")
+    Once the graph is complete its artifact costs are filled in too, from
+    the task definitions in the progress record.
+
+    Returns:
+        True once every task in the graph has resolved.
+    """
+    progress_output = config['progress_output'].format(project=raw_data.get('project'))
+    progress = load_progress(progress_output, args['groupid'])
+    await update_progress(progress, session=session)
+    if progress['listed_all'] and not progress['unresolved'] and not progress['reconciled']:
+        # Looks finished: list the whole group once more, for tasks added behind the listing.
+        await update_progress(progress, finished=True, session=session)
+    save_progress(progress_output, progress)
+
+    for key, value in progress_summary(progress, worker_costs).items():
+        if key in raw_data and raw_data[key] is None:
+            raw_data[key] = value
+    if not progress_complete(progress):
+        return False
+
+    labels = ['artifact_size', 'artifact_projected_cost']
+    if any(label in raw_data and raw_data[label] is None for label in labels):
+        results = await get_task_artifact_costs(progress_tasks(progress))
+        for index, label in enumerate(labels):
+            if label in raw_data and raw_data[label] is None:
+                raw_data[label] = results[index]
+    return True
+
+
+def write_costs(raw_data, output_dir, name):
+    """Write one graph's costs as a single row parquet file, output_dir/name.parquet."""
+    # Need to convert scalar values to lists
+    costs_df = pd.DataFrame.from_dict({k: [v] for k, v in raw_data.items()})
+    output = os.path.join(output_dir, "{}.parquet".format(name))
+    log.info("Writing parquet file %s", output)
+    costs_df.to_parquet(output, compression='gzip')
+    return output
+
+
+async def analyze_taskgraph(args, config, session=None):
+    """Work out one graph's costs and stage them.
+
+    Args:
+        session (aiohttp.ClientSession): for Taskcluster requests, shared
+            with other graphs; if None, each client makes its own
+    """
+
+    log.info("Examining taskgraph %s", args['groupid'])
+
+    worker_costs = load_worker_costs(config)
 
     raw_data = args['data']
     if not isinstance(raw_data, dict):
         raise ValueError("Only able to complete dictionaries. Wrong value passed as data")
 
+    # Split up things based on project, if mentioned.
+    if 'project' in raw_data:
+        config['staging_output'] = config['staging_output'].format(project=raw_data['project'])
+
+    if args.get('incremental') and config.get('progress_output'):
+        partial_output = config['partial_output'].format(project=raw_data.get('project'))
+        if not await analyze_progress(args, config, raw_data, worker_costs, session=session):
+            write_costs(raw_data, partial_output, args['groupid'])
+            return
+        remove_files([os.path.join(partial_output, "{}.parquet".format(args['groupid']))])
+    else:
+        await fill_from_graph(args, raw_data, worker_costs, session=session)
+
+    write_staged_costs(args, config, raw_data)
+
+
+async def fill_from_graph(args, raw_data, worker_costs, session=None):
+    """Fill in the costs the scanner left as None, from the whole task graph."""
+    log.info("Calculating costs")
+
+    graph = None
     for key, value in raw_data.items():
         if value is not None:
             continue
+        if graph is None:
+            graph = await TaskGraph(args['groupid'], session=session)
         if key == "graph_date":
             raw_data[key] = graph.earliest_start_time.strftime("%Y-%m-%d")
         elif key == 'compute_time':
@@ -67,37 +155,126 @@ async def analyze_taskgraph(args, config):
                 if label in raw_data:
                     raw_data[label] = results[index]
 
-    # Need to convert scalar values to lists
-    costs_df = pd.DataFrame.from_dict({k: [v] for k, v in raw_data.items()})
 
-    # Split up things based on project, if mentioned.
-    if 'project' in raw_data:
-        config['staging_output'] = config['staging_output'].format(project=raw_data['project'])
-    output = os.path.join(config['staging_output'], "{}.parquet".format(args['groupid']))
-    log.info("Writing parquet file %s", output)
-    costs_df.to_parquet(output, compression='gzip')
+def write_staged_costs(args, config, raw_data):
+    """Stage a graph's costs for the collator, and note it as examined."""
+    if config.get('staging_manifest'):
+        output = write_costs(raw_data, config['staging_output'], staged_file_name(args['groupid']))
+        add_manifest_entry(config['staging_output'], args['groupid'], output)
+    else:
+        write_costs(raw_data, config['staging_output'], args['groupid'])
+
+    # Best effort: the collator also adds everything it collates, and the
+    # scanners also check the staging area.
+    try:
+        record_examined(
+            config['total_cost_output'].format(project=raw_data.get('project')),
+            args['groupid'],
+            raw_data.get('graph_date'),
+        )
+    except Exception as e:
+        log.warning("Couldn't update examined index: %s", e)
 
 
-async def main(args):
+async def main(args, session=None):
     """What to do."""
     with open(args['config'], 'r') as yamlfile:
         config = yaml.load(yamlfile)
     os.environ['TC_CACHE_DIR'] = config['TC_CACHE_DIR']
     config['backfill_count'] = args.get('backfill_count', None)
 
-    await analyze_taskgraph(args=args, config=config)
+    await analyze_taskgraph(args=args, config=config, session=session)
+
+
+async def analyze_one(args, semaphore, session=None):
+    """Analyze one graph of a batch, returning the exception if it failed."""
+    async with semaphore:
+        try:
+            await main(args, session=session)
+        except Exception as e:
+            log.exception("Failed to analyze %s: %s", args.get('groupid'), e)
+            return e
+    return None
+
+
+async def main_batch(batch, concurrency=BATCH_CONCURRENCY):
+    """Analyze several graphs at once, reporting each one's outcome.
+
+    A failed graph doesn't fail the invocation, so Lambda won't retry the
+    graphs that succeeded; the failed ones aren't recorded as examined,
+    so the next scan picks them up again.
+
+    Returns:
+        dict with the analyzed group IDs, and failed: group ID to error.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(*[analyze_one(args, semaphore, session=session) for args in batch])
+    outcome = {'analyzed': list(), 'failed': dict()}
+    for args, error in zip(batch, results):
+        if error is None:
+            outcome['analyzed'].append(args.get('groupid'))
+        else:
+            outcome['failed'][args.get('groupid')] = str(error)
+    if outcome['failed']:
+        log.error("Failed to analyze %d of %d graphs: %s",
+                  len(outcome['failed']), len(batch), ', '.join(outcome['failed']))
+    return outcome
+
+
+async def run_queue_worker(job_queue, batch_size=1, visibility_timeout=VISIBILITY_TIMEOUT):
+    """Lease and analyze graphs from a job queue until no more are visible."""
+    queue = open_job_queue(job_queue)
+    analyzed = 0
+    async with aiohttp.ClientSession() as session:
+        while True:
+            jobs = queue.lease(count=batch_size, visibility_timeout=visibility_timeout)
+            if not jobs:
+                break
+            for job in jobs:
+                try:
+                    await main(job.payload, session=session)
+                except Exception as e:
+                    log.exception("Failed to analyze %s (attempt %d): %s", job.groupid, job.attempts, e)
+                    queue.fail(job, e)
+                    continue
+                queue.complete(job)
+                analyzed += 1
+    log.info("Analyzed %d graphs from %s", analyzed, job_queue)
+    return analyzed
 
 
 def lambda_handler(args, context):
     """AWS entrypoint."""
     assert context  # not current used
-    if 'config' not in args:
-        args['config'] = 'scanner.yml'
+    # Scanners send several graphs per invocation, as {'batch': [args, ...]}
+    batch = args.get('batch', [args])
+    for graph_args in batch:
+        if 'config' not in graph_args:
+            graph_args['config'] = 'scanner.yml'
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(args))
+    return loop.run_until_complete(main_batch(batch))
+
+
+def parse_args():
+    """Extract arguments."""
+    parser = argparse.ArgumentParser(description="CI Costs")
+    parser.add_argument('--job-queue', type=str, default=None,
+                        help="Work through graphs queued in this job queue, e.g. sqlite:///tmp/analysis.db")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="Jobs to lease at once from the job queue")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    cli_args = parse_args()
+    if cli_args.job_queue:
+        logging.basicConfig(level=LOG_LEVEL)
+        asyncio.get_event_loop().run_until_complete(
+            run_queue_worker(cli_args.job_queue, batch_size=cli_args.batch_size),
+        )
+        sys.exit(0)
+
     payload = {
         "config": "nightlies.yml",
         "groupid": "JypwL9OsRkq-hVsOERwBFA",  # Might not have the same name in the data
@@ -10,6 +10,8 @@ from .utils import list_s3_objects, semaphore_wrapper
 
 log = logging.getLogger(__name__)
 
+_s3_client = None
+
 
 def get_artifact_expiry(task_json):
     """Extract artifact expiry times from task definition.
@@ -61,15 +63,23 @@ def insert_artifact_expiry(task, s3_by_name):
     return s3_by_name
 
 
-async def get_s3_task_artifacts(taskid,
-                                bucket_name='taskcluster-public-artifacts',
-                                s3_client=None):
-    if s3_client is None:
-        s3_client = boto3.client(
+def taskcluster_s3_client():
+    """Return an s3 client for Taskcluster's artifact bucket, shared within a process."""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client(
             's3',
             aws_access_key_id=os.environ.get('TASKCLUSTER_S3_ACCESS_KEY'),
             aws_secret_access_key=os.environ.get('TASKCLUSTER_S3_SECRET_KEY'),
         )
+    return _s3_client
+
+
+async def get_s3_task_artifacts(taskid,
+                                bucket_name='taskcluster-public-artifacts',
+                                s3_client=None):
+    if s3_client is None:
+        s3_client = taskcluster_s3_client()
     prefix = taskid + '/'
     return await list_s3_objects(s3_client, bucket_name, prefix)
 
@@ -98,10 +108,22 @@ async def get_artifact_metadata(task):
 async def get_artifact_costs(group):
     """Calculate artifact costs for a given task graph."""
     log.info("Fetching Taskcluster artifact info for %s", str(group))
+    return await get_task_artifact_costs(group.tasks())
+
+
+async def get_task_artifact_costs(tasks):
+    """Calculate artifact costs for some tasks.
+
+    Args:
+        tasks (iterable): objects with the taskid and json of a taskhuddler Task
+
+    Returns:
+        (size, cost) of the tasks' artifacts.
+    """
     sem = asyncio.Semaphore(10)
 
     s3_tasks = []
-    for t in group.tasks():
+    for t in tasks:
         s3_tasks.append(semaphore_wrapper(sem, get_artifact_metadata(t)))
 
     log.info('Gathering artifacts')
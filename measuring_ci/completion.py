@@ -0,0 +1,55 @@
+"""Find out whether a task graph has finished running."""
+import logging
+from datetime import datetime, timedelta
+
+import taskcluster.aio
+
+from .ratelimit import taskcluster_client
+
+log = logging.getLogger()
+
+UNRESOLVED_STATES = {'unscheduled', 'pending', 'running'}
+# Task deadlines are at most a few days after creation, so a graph older than
+# this has resolved even if its tasks have since expired from the queue.
+RESOLVED_AFTER = timedelta(days=7)
+PAGE_SIZE = 1000
+
+
+async def taskgroup_resolved(group_id, session=None, page_size=PAGE_SIZE):
+    """Check that every task in a task group has resolved.
+
+    Pages through the task group, stopping at the first unresolved task,
+    so an unfinished graph usually costs a single request.
+
+    Returns:
+        False if any task is unscheduled, pending or running, or if the
+        group has no tasks.
+    """
+    queue = taskcluster_client('Queue', session=session)
+    query = {'limit': page_size}
+    seen = 0
+    while True:
+        try:
+            outcome = await queue.listTaskGroup(group_id, query=query)
+        except taskcluster.exceptions.TaskclusterRestFailure as e:
+            log.debug("Couldn't list task group %s: %s", group_id, e)
+            return False
+        tasks = outcome.get('tasks', [])
+        for task in tasks:
+            if task['status']['state'] in UNRESOLVED_STATES:
+                log.debug("Task group %s has unresolved task %s", group_id, task['status']['taskId'])
+                return False
+        seen += len(tasks)
+        if not outcome.get('continuationToken'):
+            return seen > 0
+        query['continuationToken'] = outcome['continuationToken']
+
+
+async def graph_finished(group_id, timestamp, session=None):
+    """Check whether a graph created at timestamp (epoch) has finished.
+
+    Old graphs are assumed finished without asking Taskcluster.
+    """
+    if datetime.now() - datetime.fromtimestamp(timestamp) > RESOLVED_AFTER:
+        return True
+    return await taskgroup_resolved(group_id, session=session)
@@ -57,19 +57,16 @@ def worker_unit_cost(costs, worker_type, date):
     return filter_1.iloc[filter_1.index.get_loc(date.timestamp(), method='nearest')]['unit_cost']
 
 
-def taskgraph_cost(graph, worker_costs):
-    """Calculate the cost of a taskgraph."""
-    total_wall_time_buckets = defaultdict(timedelta)
-    final_task_wall_time_buckets = defaultdict(timedelta)
-
-    start_date = graph.earliest_start_time
-
-    for task in graph.tasks():
-        key = task.json['status']['workerType']
-        total_wall_time_buckets[key] += sum(task.run_durations(), timedelta(0))
-        if task.completed:
-            final_task_wall_time_buckets[key] += task.resolved - task.started
-
+def bucket_costs(total_wall_time_buckets, final_task_wall_time_buckets, worker_costs, start_date):
+    """Cost wall time per worker type, for all runs and for final runs only.
+
+    Args:
+        total_wall_time_buckets (dict): worker type to timedelta over all runs
+        final_task_wall_time_buckets (dict): worker type to timedelta over each
+            completed task's final run
+        worker_costs (DataFrame): from fetch_all_worker_costs
+        start_date (datetime): date used to pick the unit cost
+    """
     total_cost = 0.0
     final_task_costs = 0.0
 
@@ -82,9 +79,24 @@ def taskgraph_cost(graph, worker_costs):
         cost = unit_cost * hours
         total_cost += cost
 
-        hours = final_task_wall_time_buckets[bucket].total_seconds() / (60 * 60)
-        unit_cost = worker_unit_cost(worker_costs, worker_type=bucket, date=start_date)
+        hours = final_task_wall_time_buckets.get(bucket, timedelta(0)).total_seconds() / (60 * 60)
         cost = unit_cost * hours
         final_task_costs += cost
 
     return total_cost, final_task_costs
+
+
+def taskgraph_cost(graph, worker_costs):
+    """Calculate the cost of a taskgraph."""
+    total_wall_time_buckets = defaultdict(timedelta)
+    final_task_wall_time_buckets = defaultdict(timedelta)
+
+    start_date = graph.earliest_start_time
+
+    for task in graph.tasks():
+        key = task.json['status']['workerType']
+        total_wall_time_buckets[key] += sum(task.run_durations(), timedelta(0))
+        if task.completed:
+            final_task_wall_time_buckets[key] += task.resolved - task.started
+
+    return bucket_costs(total_wall_time_buckets, final_task_wall_time_buckets, worker_costs, start_date)
@@ -0,0 +1,212 @@
+"""Cost outputs as an append-only, Hive-partitioned parquet dataset.
+
+Rows are stored by partition, by default project and month of graph_date:
+
+    {dataset}/project=autoland/month=2019-03/part-20190312T101500-<id>.parquet
+
+Writers only ever add new files, so concurrent writers can't lose each
+other's rows, and the cost of a write doesn't grow with the history.
+Readers such as Athena, and the scanners here, can skip partitions that
+can't match. Partition values are kept in the paths, not in the files.
+
+The same task graph may be in more than one file; file names sort in the
+order they were written, and the last row for a graph wins. Compaction
+merges a partition's files into one, keeping only those rows.
+"""
+import logging
+import os
+import urllib.parse
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+from .files import make_dirs, remove_files, walk_files
+from .layout import write_cost_file
+from .parquet import read_parquet_files
+
+log = logging.getLogger()
+
+PARTITION_COLUMNS = ['project', 'month']
+# Hive's name for a partition whose value is missing
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+COMPACT_MIN_FILES = 2
+
+
+def month_of(graph_date):
+    """The YYYY-MM month of a graph_date, which may be a timestamp, a YYYY-MM-DD string or an epoch."""
+    if graph_date is None or pd.isnull(graph_date):
+        return NULL_PARTITION
+    if isinstance(graph_date, str):
+        return graph_date[:7]
+    if isinstance(graph_date, datetime):
+        return graph_date.strftime('%Y-%m')
+    return datetime.utcfromtimestamp(int(graph_date)).strftime('%Y-%m')
+
+
+def partition_frame(costs, partition_cols=PARTITION_COLUMNS):
+    """Add the partition columns a frame of costs lacks, as strings."""
+    costs = costs.copy()
+    for column in partition_cols:
+        if column == 'month' and 'month' not in costs.columns:
+            costs['month'] = costs['graph_date'].map(month_of)
+        elif column not in costs.columns:
+            costs[column] = NULL_PARTITION
+        else:
+            costs[column] = costs[column].fillna(NULL_PARTITION).astype(str)
+    return costs
+
+
+def partition_path(dataset, partition_cols, values):
+    """Directory for one partition."""
+    # Escaped as Hive does, so a value can't add a level to the path.
+    parts = ['{}={}'.format(column, urllib.parse.quote(str(value), safe='')) for column, value in zip(partition_cols, values)]
+    return '/'.join([dataset.rstrip('/')] + parts) + '/'
+
+
+def parse_partition(dataset, filename, partition_cols=PARTITION_COLUMNS):
+    """Partition values of a data file, or None if it isn't one."""
+    relative = filename[len(dataset.rstrip('/')) + 1:]
+    parts = relative.split('/')
+    if len(parts) != len(partition_cols) + 1 or not parts[-1].endswith('.parquet'):
+        return None
+    values = list()
+    for column, part in zip(partition_cols, parts):
+        key, _, value = part.partition('=')
+        if key != column:
+            return None
+        values.append(urllib.parse.unquote(value))
+    return tuple(values)
+
+
+def list_partitions(dataset, partition_cols=PARTITION_COLUMNS, filters=None):
+    """Find a dataset's data files, by partition.
+
+    Args:
+        filters (dict): column to the values wanted. Partitions with any
+            other value are skipped without being read.
+
+    Returns:
+        OrderedDict of partition values to data files in the order written.
+    """
+    partitions = dict()
+    for filename in walk_files(dataset):
+        values = parse_partition(dataset, filename, partition_cols)
+        if values is None:
+            continue
+        if filters and any(column in filters and value not in filters[column]
+                           for column, value in zip(partition_cols, values)):
+            continue
+        partitions.setdefault(values, list()).append(filename)
+    return OrderedDict((values, sorted(partitions[values], key=os.path.basename)) for values in sorted(partitions))
+
+
+def new_file_name(partition_dir):
+    """Name for a new data file, sorting after those already written."""
+    return '{}part-{}-{}.parquet'.format(partition_dir, datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex)
+
+
+def write_partition_file(filename, rows, partition_cols=PARTITION_COLUMNS, layout=None):
+    """Write one partition's rows, leaving the partition columns to the path.
+
+    Args:
+        layout (dict): options for write_cost_file, from layout_options
+    """
+    make_dirs(os.path.dirname(filename))
+    rows = rows.drop(columns=[c for c in partition_cols if c in rows.columns])
+    write_cost_file(rows, filename, **(layout or {}))
+
+
+def append_rows(dataset, costs, partition_cols=PARTITION_COLUMNS, layout=None):
+    """Add rows to a dataset, as one new file in each partition they fall in.
+
+    Returns:
+        list of files written.
+    """
+    if costs is None or costs.empty:
+        return list()
+    costs = partition_frame(costs, partition_cols)
+    written = list()
+    for values, rows in costs.groupby(partition_cols):
+        if not isinstance(values, tuple):
+            values = (values,)
+        filename = new_file_name(partition_path(dataset, partition_cols, values))
+        write_partition_file(filename, rows, partition_cols, layout=layout)
+        written.append(filename)
+    log.info("Appended %d rows to %d partitions of %s", len(costs), len(written), dataset)
+    return written
+
+
+def read_partition(files, values, partition_cols=PARTITION_COLUMNS, dedupe_on='groupid', columns=None):
+    """Read one partition's files, with its partition values as columns."""
+    if columns:
+        columns = [c for c in columns if c not in partition_cols]
+        if dedupe_on and dedupe_on not in columns:
+            columns.append(dedupe_on)
+    rows = read_parquet_files(files, columns=columns)
+    if rows is None:
+        return None
+    for column, value in zip(partition_cols, values):
+        rows[column] = value
+    if dedupe_on and dedupe_on in rows.columns:
+        rows = rows.drop_duplicates(subset=[dedupe_on], keep='last')
+    return rows
+
+
+def read_dataset(dataset, partition_cols=PARTITION_COLUMNS, filters=None, columns=None, dedupe_on='groupid'):
+    """Read a dataset, or the partitions of it matching filters.
+
+    Args:
+        filters (dict): column to the partition values wanted
+        columns (list): columns to return
+        dedupe_on (str): keep only the last row written for each value of
+            this column. None to keep every row.
+
+    Returns:
+        DataFrame, empty if nothing matched.
+    """
+    frames = list()
+    for values, files in list_partitions(dataset, partition_cols, filters).items():
+        rows = read_partition(files, values, partition_cols, dedupe_on=dedupe_on, columns=columns)
+        if rows is not None:
+            frames.append(rows)
+    if not frames:
+        return pd.DataFrame(columns=columns or [])
+    costs = pd.concat(frames, sort=True, ignore_index=True)
+    if dedupe_on and dedupe_on in costs.columns:
+        # Normally a graph is in one partition only, but its month may have
+        # been corrected since it was first written.
+        costs = costs.drop_duplicates(subset=[dedupe_on], keep='last')
+    if columns:
+        costs = costs[[c for c in columns if c in costs.columns]]
+    return costs.reset_index(drop=True)
+
+
+def compact_partition(dataset, values, files, partition_cols=PARTITION_COLUMNS, dedupe_on='groupid', layout=None):
+    """Merge a partition's files into one, keeping the last row for each graph.
+
+    The merged file gets a new name of its own, so concurrent compactions
+    can't overwrite each other. Only the files that were read are removed.
+    """
+    rows = read_partition(files, values, partition_cols, dedupe_on=dedupe_on)
+    filename = new_file_name(partition_path(dataset, partition_cols, values))
+    write_partition_file(filename, rows, partition_cols, layout=layout)
+    remove_files(files)
+    log.info("Compacted %d files into %s", len(files), filename)
+    return filename
+
+
+def compact_dataset(dataset, partition_cols=PARTITION_COLUMNS, filters=None, min_files=COMPACT_MIN_FILES, layout=None):
+    """Compact each partition with at least min_files files.
+
+    Returns:
+        number of partitions compacted.
+    """
+    compacted = 0
+    for values, files in list_partitions(dataset, partition_cols, filters).items():
+        if len(files) < min_files:
+            continue
+        compact_partition(dataset, values, files, partition_cols, layout=layout)
+        compacted += 1
+    return compacted
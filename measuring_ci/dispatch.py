@@ -0,0 +1,125 @@
+"""Send batches of task graphs to the analyzer Lambda function."""
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import boto3
+
+log = logging.getLogger()
+
+ANALYZER_FUNCTION = 'taskgraph_analyzer'
+# Asynchronous invocations accept up to 256KB; leave room for the wrapper.
+MAX_PAYLOAD_BYTES = 255 * 1024
+# The analyzer function's timeout, and the time to allow one large graph,
+# in seconds; batches are sized from these, so set them in the config to
+# match the function.
+ANALYZER_TIMEOUT = 120
+GRAPH_SECONDS = 90
+# Graphs the analyzer works on at once within an invocation.
+BATCH_CONCURRENCY = 4
+MAX_BATCH_SIZE = 10
+DISPATCH_CONCURRENCY = 16
+
+
+def batch_size_for_timeout(timeout=ANALYZER_TIMEOUT, graph_seconds=GRAPH_SECONDS,
+                           concurrency=BATCH_CONCURRENCY, max_batch_size=MAX_BATCH_SIZE):
+    """Graphs per invocation, so that a batch finishes within the function's timeout.
+
+    The analyzer works on `concurrency` graphs at once, so a batch takes
+    about as many rounds of graph_seconds as it has graphs per worker.
+    """
+    rounds = max(1, int(timeout // graph_seconds))
+    return max(1, min(max_batch_size, rounds * concurrency))
+
+
+def batch_size_from_config(config):
+    """Graphs per invocation, from the analyzer_timeout and analyzer_graph_seconds config values."""
+    return batch_size_for_timeout(
+        timeout=config.get('analyzer_timeout', ANALYZER_TIMEOUT),
+        graph_seconds=config.get('analyzer_graph_seconds', GRAPH_SECONDS),
+        concurrency=config.get('analyzer_batch_concurrency', BATCH_CONCURRENCY),
+    )
+
+
+def pack_batches(payloads, max_bytes=MAX_PAYLOAD_BYTES, max_batch_size=MAX_BATCH_SIZE):
+    """Group payloads into batches whose encoded form fits in one invocation.
+
+    Returns:
+        list of lists of payloads. A single payload too large to fit is
+        given a batch of its own, and will be reported as failed when sent.
+    """
+    wrapper_size = len(json.dumps({'batch': []}))
+    batches = list()
+    batch = list()
+    batch_size = wrapper_size
+    for payload in payloads:
+        # Each payload after the first also needs a ', ' separator.
+        size = len(json.dumps(payload)) + (2 if batch else 0)
+        if batch and (batch_size + size > max_bytes or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = list()
+            batch_size = wrapper_size
+            size -= 2
+        batch.append(payload)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def invoke_batch(lambda_client, function_name, batch):
+    """Invoke the analyzer asynchronously for one batch, raising on failure."""
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'batch': batch}),
+    )
+    if response.get('StatusCode') != 202:
+        raise RuntimeError("Unexpected status {} invoking {}".format(response.get('StatusCode'), function_name))
+    return response
+
+
+async def dispatch_payloads(payloads,
+                            function_name=ANALYZER_FUNCTION,
+                            max_bytes=MAX_PAYLOAD_BYTES,
+                            max_batch_size=MAX_BATCH_SIZE,
+                            concurrency=DISPATCH_CONCURRENCY,
+                            lambda_client=None):
+    """Invoke the analyzer for many graphs, several graphs per invocation.
+
+    The blocking boto3 calls run concurrently in a thread pool, so the
+    event loop isn't held up by each API round trip.
+
+    Args:
+        payloads (list): analyzer arguments, one dict per graph, each with a 'groupid'.
+        function_name (str): Lambda function to invoke.
+        max_bytes (int): payload size limit per invocation.
+        max_batch_size (int): graphs per invocation.
+        concurrency (int): invocations in flight.
+        lambda_client: boto3 Lambda client to use. Default: a new one.
+
+    Returns:
+        list of (groupids, exception) for each batch that failed.
+    """
+    if lambda_client is None:
+        lambda_client = boto3.client('lambda')
+    batches = pack_batches(payloads, max_bytes=max_bytes, max_batch_size=max_batch_size)
+    log.info("Invoking %s for %d graphs in %d batches", function_name, len(payloads), len(batches))
+
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = await asyncio.gather(
+            *[loop.run_in_executor(executor, partial(invoke_batch, lambda_client, function_name, batch))
+              for batch in batches],
+            return_exceptions=True,
+        )
+
+    failures = list()
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            groupids = [p.get('groupid') for p in batch]
+            log.error("Failed to invoke %s for %s: %s", function_name, ', '.join(groupids), result)
+            failures.append((groupids, result))
+    return failures
@@ -0,0 +1,262 @@
+"""Turn task-group-resolved events into analysis jobs.
+
+Taskcluster announces each task group that resolves on the
+exchange/taskcluster-queue/v1/task-group-resolved exchange, with the group
+ID in the message. Sources here yield those messages; whatever reads the
+exchange can feed them in, as JSON lines in a file or through memory.
+
+Each group's decision task (which has the same ID as its group) says
+which repository, revision and push the graph was made for, and whether
+it was a nightly cron graph, so the job payload can be built without
+scanning the pushlog or the index.
+"""
+import asyncio
+import json
+import logging
+import re
+
+import dateutil.parser
+import taskcluster.aio
+
+from .nightly import fetch_app_version
+from .pushlog_cache import PushlogCache
+from .ratelimit import taskcluster_client
+
+log = logging.getLogger()
+
+PUSHLOG_ROUTE = re.compile(r'^index\.gecko\.v2\.[^.]+\.pushlog-id\.(\d+)\.decision$')
+NIGHTLY_ROUTE = re.compile(r'\.decision-nightly(?:-(\w+))?$')
+# Product for each kind of nightly cron decision task
+NIGHTLY_PRODUCTS = {
+    'desktop': 'firefox',
+    'android': 'mobile',
+}
+NIGHTLY_PROJECT = 'mozilla-central'
+REPOSITORY_PREFIX = 'https://hg.mozilla.org/'
+
+
+class EventSource:
+    """Base class for places task-group-resolved messages come from."""
+
+    async def events(self):
+        """Yield message dicts as they arrive."""
+        raise NotImplementedError
+        yield
+
+
+class FileEventSource(EventSource):
+    """Messages stored one JSON document per line, in a file."""
+
+    def __init__(self, path):
+        """Read messages from path."""
+        self.path = path
+
+    async def events(self):
+        """Yield each message in the file, skipping lines that aren't JSON."""
+        with open(self.path, 'r') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    log.warning("Skipping line %d of %s: %s", number, self.path, e)
+
+
+class MemoryEventSource(EventSource):
+    """Messages handed over in memory, for example by a pulse listener in the same process."""
+
+    def __init__(self, messages=()):
+        """Start with any messages given."""
+        self.queue = asyncio.Queue()
+        for message in messages:
+            self.queue.put_nowait(message)
+
+    def put(self, message):
+        """Add a message."""
+        self.queue.put_nowait(message)
+
+    def close(self):
+        """Stop once the messages added so far have been read."""
+        self.queue.put_nowait(None)
+
+    async def events(self):
+        """Yield messages until closed."""
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            yield message
+
+
+def parse_event(message):
+    """Find the task group ID in a task-group-resolved message.
+
+    Accepts either a whole pulse message, with the event under 'payload',
+    or the event itself.
+
+    Returns:
+        taskGroupId, or None if the message doesn't have one.
+    """
+    payload = message.get('payload', message) if isinstance(message, dict) else None
+    if not isinstance(payload, dict):
+        return None
+    return payload.get('taskGroupId')
+
+
+def describe_decision_task(task):
+    """Pull out what a decision task definition says about its graph.
+
+    Returns:
+        dict with project, revision, pushid, nightly product (or None)
+        and created (epoch).
+    """
+    env = task.get('payload', {}).get('env', {})
+    repository = env.get('GECKO_HEAD_REPOSITORY', '').rstrip('/')
+    project = repository[len(REPOSITORY_PREFIX):] if repository.startswith(REPOSITORY_PREFIX) else None
+
+    pushid = None
+    nightly = None
+    for route in task.get('routes', []):
+        match = PUSHLOG_ROUTE.match(route)
+        if match:
+            pushid = int(match.group(1))
+        match = NIGHTLY_ROUTE.search(route)
+        if match:
+            nightly = NIGHTLY_PRODUCTS.get(match.group(1) or 'desktop')
+
+    return {
+        'project': project,
+        'revision': env.get('GECKO_HEAD_REV'),
+        'pushid': pushid,
+        'nightly': nightly,
+        'created': int(dateutil.parser.parse(task['created']).timestamp()),
+    }
+
+
+def empty_costs():
+    """Cost columns for the analyzer to fill in."""
+    return {
+        'totalcost': None,
+        'idealcost': None,
+        'taskcount': None,
+        'compute_time': None,
+        'artifact_size': None,
+        'artifact_projected_cost': None,
+    }
+
+
+class EventEnricher:
+    """Build analyzer payloads for task groups, as the scanners would have.
+
+    Args:
+        projects (list): projects to accept push graphs for, as in the pushlog scanner
+        scanner_config (dict): pushlog scanner configuration, for its pushlog caches
+        product (str): product to record for push graphs
+        session (aiohttp.ClientSession): session for Taskcluster requests
+    """
+
+    def __init__(self, projects, scanner_config, product='firefox', session=None):
+        """Set up, without reading any pushlog caches until they are needed."""
+        self.projects = set(projects)
+        self.scanner_config = scanner_config
+        self.product = product
+        self.session = session
+        self.queue = taskcluster_client('Queue', session=session)
+        self._caches = dict()
+
+    def pushlog_cache(self, project):
+        """Open a project's pushlog cache once, if one is configured."""
+        if project not in self._caches:
+            self._caches[project] = None
+            if self.scanner_config.get('pushlog_cache'):
+                cache = PushlogCache(self.scanner_config['pushlog_cache'].format(project=project.replace('/', '_')))
+                try:
+                    log.debug("%d pushlog cache files for %s", len(cache.files), project)
+                    self._caches[project] = cache
+                except Exception as e:
+                    log.info("No pushlog cache for %s: %s", project, e)
+        return self._caches[project]
+
+    async def push_payload(self, group_id, info):
+        """Payload for a graph made by a push, preferring the pushlog cache's record of it."""
+        pushid, date = info['pushid'], info['created']
+        cache = self.pushlog_cache(info['project'])
+        if cache is not None:
+            # Only the row group holding the push is read.
+            cached = cache.get(pushid)
+            if cached is not None and cached['taskgraph'] == group_id:
+                date = cached['date']
+        data = {
+            'project': info['project'].split('/')[-1],
+            'product': self.product,
+            'groupid': group_id,
+            'pushid': pushid,
+            'graph_date': date,
+            'origin': 'push',
+        }
+        data.update(empty_costs())
+        return {'groupid': group_id, 'project': info['project'], 'config': 'scanner.yml', 'product': self.product, 'data': data}
+
+    async def nightly_payload(self, group_id, info):
+        """Payload for a nightly graph, as the nightly scanner makes them."""
+        version = await fetch_app_version(self.session, self.queue, group_id)
+        data = {
+            'product': info['nightly'],
+            'groupid': group_id,
+            'revision': info['revision'],
+            'graph_date': None,
+            'version': version,
+        }
+        data.update(empty_costs())
+        return {'groupid': group_id, 'project': NIGHTLY_PROJECT, 'config': 'nightlies.yml', 'data': data}
+
+    async def payload(self, group_id):
+        """Build the analyzer payload for a task group.
+
+        Returns:
+            payload dict, or None if the group isn't one we measure.
+        """
+        try:
+            task = await self.queue.task(group_id)
+        except taskcluster.exceptions.TaskclusterRestFailure as e:
+            log.info("No decision task for %s: %s", group_id, e)
+            return None
+
+        info = describe_decision_task(task)
+        if info['nightly'] and info['project'] == NIGHTLY_PROJECT:
+            return await self.nightly_payload(group_id, info)
+        if info['project'] in self.projects and info['pushid'] is not None:
+            return await self.push_payload(group_id, info)
+        log.debug("Ignoring task group %s from %s", group_id, info['project'])
+        return None
+
+
+async def ingest_events(source, enricher, job_queue):
+    """Enqueue analysis for each task group announced by a source.
+
+    Args:
+        source (EventSource): where the messages come from
+        enricher (EventEnricher): builds the payloads
+        job_queue (JobQueue): where analysis jobs go
+
+    Returns:
+        dict counting events seen, queued, already known and ignored.
+    """
+    counts = {'events': 0, 'queued': 0, 'known': 0, 'ignored': 0}
+    async for message in source.events():
+        counts['events'] += 1
+        group_id = parse_event(message)
+        if not group_id:
+            counts['ignored'] += 1
+            continue
+        payload = await enricher.payload(group_id)
+        if payload is None:
+            counts['ignored'] += 1
+        elif job_queue.enqueue(group_id, payload):
+            log.info("Queued %s", group_id)
+            counts['queued'] += 1
+        else:
+            counts['known'] += 1
+    return counts
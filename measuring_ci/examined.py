@@ -0,0 +1,249 @@
+"""Compact index of the task graph IDs that have already been analyzed.
+
+Task graph IDs are 22 character slugs, each encoding a 16 byte UUID. The
+index stores them decoded, sorted and concatenated in a small sidecar
+object next to the cost output, so scanners don't need to read the whole
+cost history to find out what has been examined.
+
+The index is split by the month of each graph's date, so a scanner only
+reads the months it is looking at:
+
+    {cost output}-examined/2019-03.idx
+    {cost output}-examined/pending/2019-03.{task graph ID}
+
+The collator is the only writer of the monthly shards. Analyzers instead
+leave a note per graph under pending/, which the collator merges
+into the shards; scanners read the notes' names along with the shards.
+"""
+import base64
+import logging
+import os
+from collections import defaultdict
+
+import pandas as pd
+
+from .dataset import NULL_PARTITION, month_of
+from .files import list_files, make_dirs, open_wrapper, remove_files
+from .manifest import read_manifest
+from .utils import find_staged_data_files
+
+log = logging.getLogger()
+
+ID_WIDTH = 16
+SHARD_SUFFIX = '.idx'
+PENDING_DIR = 'pending/'
+
+
+def slug_to_bytes(slug):
+    """Decode a task graph ID slug to its 16 raw bytes."""
+    if not isinstance(slug, str) or len(slug) != 22:
+        raise ValueError("Not a task graph ID: {!r}".format(slug))
+    return base64.urlsafe_b64decode(slug + '==')
+
+
+def bytes_to_slug(raw):
+    """Encode 16 raw bytes as a task graph ID slug."""
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def index_dir(total_cost_output):
+    """Where the examined index for a cost output lives."""
+    return os.path.splitext(total_cost_output)[0] + '-examined/'
+
+
+def shard_url(directory, month):
+    """The part of an index holding graphs from one month."""
+    return '{}{}{}'.format(directory, month, SHARD_SUFFIX)
+
+
+def delta_url(directory, month, slug):
+    """Where an analyzer notes one graph it has examined."""
+    return '{}{}{}.{}'.format(directory, PENDING_DIR, month, slug)
+
+
+class ExaminedIndex:
+    """Set of task graph IDs, stored as sorted fixed-width binary records."""
+
+    def __init__(self, ids=()):
+        """Create an index holding the given task graph ID slugs."""
+        self._ids = set()
+        self.add(ids)
+
+    @classmethod
+    def load(cls, url):
+        """Read an index, returning an empty one if it doesn't exist."""
+        index = cls()
+        try:
+            with open_wrapper(url, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return index
+        index._ids = {data[pos:pos + ID_WIDTH] for pos in range(0, len(data) - ID_WIDTH + 1, ID_WIDTH)}
+        return index
+
+    def save(self, url):
+        """Write the index as sorted, concatenated 16 byte IDs."""
+        with open_wrapper(url, 'wb') as f:
+            f.write(b''.join(sorted(self._ids)))
+
+    def merge(self, other):
+        """Add every ID in another index."""
+        self._ids.update(other._ids)
+
+    def add(self, slugs):
+        """Add task graph ID slugs, ignoring anything that isn't one."""
+        for slug in slugs:
+            try:
+                self._ids.add(slug_to_bytes(slug))
+            except ValueError:
+                log.debug("Ignoring invalid task graph ID %r", slug)
+
+    def __contains__(self, slug):
+        """Check whether a task graph ID slug is in the index."""
+        try:
+            return slug_to_bytes(slug) in self._ids
+        except ValueError:
+            return False
+
+    def __len__(self):
+        """Return the number of IDs held."""
+        return len(self._ids)
+
+    def __iter__(self):
+        """Yield the IDs, as slugs, in sorted order."""
+        return (bytes_to_slug(raw) for raw in sorted(self._ids))
+
+
+def months_between(start, end, margin=1):
+    """YYYY-MM months from start to end, datetimes, with margin months either side.
+
+    A graph's date is when its first task started, which can be in the
+    month after its push or nightly, so callers should leave a margin.
+    """
+    first = pd.Timestamp(start).to_period('M') - margin
+    last = pd.Timestamp(end).to_period('M') + margin
+    return [str(month) for month in pd.period_range(first, last, freq='M')]
+
+
+def list_shards(directory):
+    """Map each month with an index shard to the shard's URL."""
+    return {name[:-len(SHARD_SUFFIX)]: directory + name
+            for name in list_files(directory) if name.endswith(SHARD_SUFFIX)}
+
+
+def list_pending(directory):
+    """List analyzers' notes of graphs not yet merged, as (url, month, slug)."""
+    pending = list()
+    for name in list_files(directory + PENDING_DIR):
+        month, _, slug = name.rpartition('.')
+        pending.append((directory + PENDING_DIR + name, month, slug))
+    return pending
+
+
+def history_by_month(total_cost_output):
+    """Group the graphs already in a cost output by month, for a first index."""
+    try:
+        costs = pd.read_parquet(total_cost_output, columns=['groupid', 'graph_date'])
+    except Exception as e:
+        log.info("No existing costs to index in %s (%s)", total_cost_output, e)
+        return dict()
+    log.info("Building examined index of %d task graphs from %s", len(costs), total_cost_output)
+    return group_by_month(costs)
+
+
+def group_by_month(costs):
+    """Map months to the task graph IDs with a graph_date in them."""
+    months = costs['graph_date'].map(month_of)
+    return {month: rows.tolist() for month, rows in costs['groupid'].groupby(months)}
+
+
+def load_examined_index(total_cost_output, months=None):
+    """Load the examined index for a cost output.
+
+    Args:
+        months (iterable): YYYY-MM months to load. Graphs with no date are
+            always loaded. Default: every month.
+    """
+    directory = index_dir(total_cost_output)
+    shards = list_shards(directory)
+    index = ExaminedIndex()
+    if not shards:
+        # Nothing collated since the index was sharded; read the costs
+        # instead, leaving the collator to write the index.
+        for slugs in history_by_month(total_cost_output).values():
+            index.add(slugs)
+        return index
+    if months is not None:
+        wanted = set(months) | {NULL_PARTITION}
+        shards = {month: url for month, url in shards.items() if month in wanted}
+    for url in shards.values():
+        index.merge(ExaminedIndex.load(url))
+    return index
+
+
+def record_examined(total_cost_output, slug, graph_date):
+    """Note that a graph has been examined, for the collator to merge into the index.
+
+    Each note is an object of its own, so analyzers never rewrite anything
+    shared. Its name says all there is to know, but it holds the ID's
+    bytes, as s3 may not store an empty object.
+    """
+    directory = index_dir(total_cost_output)
+    make_dirs(directory + PENDING_DIR)
+    with open_wrapper(delta_url(directory, month_of(graph_date), slug), 'wb') as f:
+        f.write(slug_to_bytes(slug))
+
+
+def merge_examined(total_cost_output, costs):
+    """Add collated graphs and analyzers' notes to the index.
+
+    Only the collator calls this, so it is the index's only writer. Notes
+    are merged and removed from a snapshot taken first; any written
+    meanwhile wait for the next merge. Only the shards for months that
+    have new graphs are rewritten.
+
+    Args:
+        costs (DataFrame): collated rows, with groupid and graph_date
+    """
+    directory = index_dir(total_cost_output)
+    pending = list_pending(directory)
+    shards = list_shards(directory)
+
+    additions = defaultdict(list)
+    if not shards:
+        for month, slugs in history_by_month(total_cost_output).items():
+            additions[month].extend(slugs)
+    for month, slugs in group_by_month(costs).items():
+        additions[month].extend(slugs)
+    for _, month, slug in pending:
+        additions[month].append(slug)
+
+    make_dirs(directory)
+    for month, slugs in additions.items():
+        url = shards.get(month, shard_url(directory, month))
+        index = ExaminedIndex.load(url)
+        index.add(slugs)
+        index.save(url)
+    remove_files([url for url, _, _ in pending])
+    log.info("Merged %d task graphs and %d notes into %d months of the examined index",
+             len(costs), len(pending), len(additions))
+
+
+async def find_examined_taskgraph_ids(config, months=None):
+    """Find the task graph IDs we have examined already, or are waiting to be collated.
+
+    Args:
+        months (iterable): YYYY-MM months of the graphs to be checked.
+            Default: every month.
+    """
+    index = load_examined_index(config['total_cost_output'], months=months)
+    index.add(slug for _, _, slug in list_pending(index_dir(config['total_cost_output'])))
+
+    if config.get('staging_manifest'):
+        entries = await read_manifest(config['staging_output'])
+        index.add(entry['groupid'] for entry in entries)
+    else:
+        staged_files = await find_staged_data_files(config['staging_output'])
+        index.add(os.path.basename(f).replace('.parquet', '') for f in staged_files)
+
+    return index
@@ -0,0 +1,174 @@
+"""Ways for the scanners to get task graphs analyzed.
+
+Every executor takes the same analyzer payloads the scanners build, and
+results end up in the configured staging output either way:
+
+    lambda        invoke the taskgraph_analyzer Lambda function
+    inline        run graph_analyzer in this process, a few graphs at a time
+    process-pool  run graph_analyzer in worker processes, one graph per worker at once
+    queue         add graphs to a job queue, for analyzers to lease and work through
+"""
+import asyncio
+import importlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+from .dispatch import dispatch_payloads
+from .jobqueue import open_job_queue
+from .utils import semaphore_wrapper
+
+log = logging.getLogger()
+
+INLINE_CONCURRENCY = 4
+
+# Each worker process keeps its own event loop and HTTP session between
+# graphs; both go when the process does.
+_worker_loop = None
+_worker_session = None
+
+
+def analyzer():
+    """Import graph_analyzer, which sits alongside the scanners rather than in this package."""
+    return importlib.import_module('graph_analyzer')
+
+
+def collect_failures(payloads, results):
+    """Pair each failed payload's group ID with its exception."""
+    failures = list()
+    for payload, result in zip(payloads, results):
+        if isinstance(result, Exception):
+            log.error("Failed to analyze %s: %s", payload.get('groupid'), result)
+            failures.append(([payload.get('groupid')], result))
+    return failures
+
+
+class Executor:
+    """Base class for analysis backends."""
+
+    async def submit(self, payloads):
+        """Analyze each payload's task graph.
+
+        Returns:
+            list of (groupids, exception) for work that failed.
+        """
+        raise NotImplementedError
+
+
+class LambdaExecutor(Executor):
+    """Hand graphs to the analyzer Lambda function in batches."""
+
+    def __init__(self, **kwargs):
+        """Keep any dispatch_payloads options, such as function_name."""
+        self.options = kwargs
+
+    async def submit(self, payloads):
+        """Invoke the analyzer function; failures are only those of the invocation itself."""
+        return await dispatch_payloads(payloads, **self.options)
+
+
+class InlineExecutor(Executor):
+    """Analyze graphs on this process's own event loop."""
+
+    def __init__(self, concurrency=INLINE_CONCURRENCY):
+        """Set how many graphs are analyzed at once."""
+        self.concurrency = concurrency
+
+    async def submit(self, payloads):
+        """Analyze the graphs, waiting for all of them."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        graph_analyzer = analyzer()
+        async with aiohttp.ClientSession() as session:
+            results = await asyncio.gather(
+                *[semaphore_wrapper(semaphore, graph_analyzer.main(payload, session=session)) for payload in payloads],
+                return_exceptions=True,
+            )
+        return collect_failures(payloads, results)
+
+
+async def analyze_with_worker_session(payload):
+    """Analyze a graph using the worker process's session, opening it on first use."""
+    global _worker_session
+    if _worker_session is None or _worker_session.closed:
+        _worker_session = aiohttp.ClientSession()
+    await analyzer().main(payload, session=_worker_session)
+
+
+def analyze_in_worker(payload):
+    """Run one analysis in a worker process, reusing its event loop and session."""
+    global _worker_loop
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_worker_loop)
+    _worker_loop.run_until_complete(analyze_with_worker_session(payload))
+    return payload.get('groupid')
+
+
+class ProcessExecutor(Executor):
+    """Analyze graphs in a pool of worker processes, using every core.
+
+    Worker processes live for the whole submission, so the worker cost
+    tables and s3 client graph_analyzer caches, and each worker's
+    Taskcluster session, are reused across graphs.
+    """
+
+    def __init__(self, workers=None):
+        """Set the number of worker processes. Default: one per core."""
+        self.workers = workers
+
+    async def submit(self, payloads):
+        """Analyze the graphs, waiting for all of them."""
+        loop = asyncio.get_event_loop()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = await asyncio.gather(
+                *[loop.run_in_executor(pool, analyze_in_worker, payload) for payload in payloads],
+                return_exceptions=True,
+            )
+        return collect_failures(payloads, results)
+
+
+class QueueExecutor(Executor):
+    """Add graphs to a durable job queue, skipping any already queued or analyzed."""
+
+    def __init__(self, job_queue):
+        """Open the job queue at the given location."""
+        self.queue = open_job_queue(job_queue)
+
+    async def submit(self, payloads):
+        """Enqueue the graphs; analysis happens later, when analyzers lease them."""
+        added = sum(self.queue.enqueue(payload['groupid'], payload) for payload in payloads)
+        log.info("Queued %d graphs, %d were already known", added, len(payloads) - added)
+        return list()
+
+
+EXECUTORS = {
+    'lambda': LambdaExecutor,
+    'inline': InlineExecutor,
+    'process-pool': ProcessExecutor,
+    'queue': QueueExecutor,
+}
+
+
+def get_executor(name='lambda', workers=None, job_queue=None, batch_size=None):
+    """Create an executor by name.
+
+    Args:
+        name (str): one of 'lambda', 'inline', 'process-pool' or 'queue'
+        workers (int): concurrency for the local backends
+        job_queue (str): location of the job queue, for the 'queue' executor
+        batch_size (int): graphs per invocation, for the 'lambda' executor
+    """
+    if name not in EXECUTORS:
+        raise ValueError("Unknown executor {}, expected one of {}".format(name, ', '.join(sorted(EXECUTORS))))
+    if name == 'queue':
+        if not job_queue:
+            raise ValueError("The queue executor needs a job queue location")
+        return QueueExecutor(job_queue)
+    if name == 'lambda':
+        return LambdaExecutor(max_batch_size=batch_size) if batch_size else LambdaExecutor()
+    if workers is None:
+        return EXECUTORS[name]()
+    if name == 'inline':
+        return InlineExecutor(concurrency=workers)
+    return ProcessExecutor(workers=workers)
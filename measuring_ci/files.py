@@ -1,8 +1,18 @@
-
+import glob
+import os
+import urllib.parse
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
 
+import boto3
 import s3fs
 
+# The most keys one s3 DeleteObjects request takes.
+DELETE_BATCH_SIZE = 1000
+DELETE_WORKERS = 8
+
 
 @contextmanager
 def open_wrapper(filename, *args, **kwargs):
@@ -13,3 +23,119 @@ def open_wrapper(filename, *args, **kwargs):
         else:
             f = stack.enter_context(open(filename, *args, **kwargs))
         yield f
+
+
+def list_files(directory):
+    """List the file names directly inside a local or s3:// directory."""
+    if directory.startswith('s3://'):
+        fs = s3fs.S3FileSystem()
+        try:
+            return [os.path.basename(p.rstrip('/')) for p in fs.ls(directory)]
+        except FileNotFoundError:
+            return list()
+    return [os.path.basename(p) for p in glob.glob(os.path.join(directory, '*'))
+            if os.path.isfile(p)]
+
+
+def walk_files(directory):
+    """List every file below a local or s3:// directory, as full paths."""
+    if directory.startswith('s3://'):
+        fs = s3fs.S3FileSystem()
+        try:
+            return ['s3://' + key for key in fs.walk(directory)]
+        except FileNotFoundError:
+            return list()
+    return [os.path.join(root, name)
+            for root, _, names in os.walk(directory) for name in names]
+
+
+def remove_files(filenames):
+    """Remove a list of local or s3:// files, ignoring any already gone."""
+    fs = None
+    for filename in filenames:
+        if filename.startswith('s3://'):
+            if fs is None:
+                fs = s3fs.S3FileSystem()
+            try:
+                fs.rm(filename)
+            except FileNotFoundError:
+                pass
+        elif os.path.exists(filename):
+            os.remove(filename)
+
+
+def delete_s3_batch(s3_client, bucket, keys):
+    """Delete up to DELETE_BATCH_SIZE keys from one bucket in a single request."""
+    response = s3_client.delete_objects(
+        Bucket=bucket,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+    )
+    errors = response.get('Errors', [])
+    if errors:
+        raise IOError("Failed to delete {} objects from {}, such as {}: {}".format(
+            len(errors), bucket, errors[0].get('Key'), errors[0].get('Message')))
+    return len(keys)
+
+
+def remove_files_in_batches(filenames, batch_size=DELETE_BATCH_SIZE, max_workers=DELETE_WORKERS):
+    """Remove many local or s3:// files, with s3 deletes batched and run concurrently.
+
+    Returns:
+        number of files removed, or requested to be.
+    """
+    keys_by_bucket = defaultdict(list)
+    local = list()
+    for filename in filenames:
+        if filename.startswith('s3://'):
+            url = urllib.parse.urlparse(filename)
+            keys_by_bucket[url.netloc].append(url.path.lstrip('/'))
+        else:
+            local.append(filename)
+    remove_files(local)
+
+    batches = [(bucket, keys[index:index + batch_size])
+               for bucket, keys in keys_by_bucket.items()
+               for index in range(0, len(keys), batch_size)]
+    if not batches:
+        return len(local)
+    s3_client = boto3.client('s3')
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        removed = sum(pool.map(lambda batch: delete_s3_batch(s3_client, *batch), batches))
+    return removed + len(local)
+
+
+def make_dirs(directory):
+    """Create a local directory if needed; s3 has no directories."""
+    if not directory.startswith('s3://'):
+        os.makedirs(directory, exist_ok=True)
+
+
+def create_exclusive(filename, content):
+    """Create a local or s3:// file holding content, unless it already exists.
+
+    Local files are created atomically. s3 has no conditional create, so
+    two writers racing may both appear to succeed; callers that care
+    should read the file back.
+
+    Returns:
+        True if this call created the file.
+    """
+    if filename.startswith('s3://'):
+        fs = s3fs.S3FileSystem()
+        if fs.exists(filename):
+            return False
+        with fs.open(filename, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        return True
+    # Write elsewhere first and link into place, so the file never exists
+    # without its content.
+    temp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+    with open(temp, 'w') as f:
+        f.write(content)
+    try:
+        os.link(temp, filename)
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(temp)
+    return True
@@ -0,0 +1,259 @@
+"""Analyze task graphs a little at a time, while they are still running.
+
+Each pass over a graph saves a progress record alongside the other
+analysis output, holding:
+
+    tasks               per task: worker type, state, number of runs, and
+                        the wall time, final run time and compute time it
+                        contributed, plus its latest start time
+    unresolved          tasks that were still unscheduled, pending or running
+    continuation_token  where the last page of the task group's listing starts
+    listed_all          whether the listing has reached the end of the group
+    definitions         per task: the artifacts and expiry from its definition,
+                        so artifact costs can be worked out without the graph
+
+The next pass asks the queue for the status of the unresolved tasks only,
+then carries on listing the group from the continuation point, so every
+pass re-reads the last page and anything added after it. A task's
+contribution is replaced whenever its state or run count changes, so
+costs can be worked out from the records without re-reading the graph.
+
+Tasks can also be added to a group ahead of the continuation point, for
+example by actions, so once the graph has finished there is one final
+listing of the whole group; tasks that haven't changed are skipped.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+import dateutil.parser
+import taskcluster.aio
+
+from .completion import PAGE_SIZE, UNRESOLVED_STATES
+from .costs import bucket_costs
+from .files import open_wrapper
+from .ratelimit import taskcluster_client
+from .utils import semaphore_wrapper
+
+log = logging.getLogger()
+
+STATUS_CONCURRENCY = 20
+
+# Fields of each task's record in progress['tasks']
+WORKER, STATE, RUNS, WALL, FINAL, COMPUTE, STARTED = range(7)
+
+
+def new_progress(group_id):
+    """Progress record for a graph not looked at yet."""
+    return {
+        'groupid': group_id,
+        'tasks': dict(),
+        'unresolved': list(),
+        'continuation_token': None,
+        'listed_all': False,
+        'reconciled': False,
+        'definitions': dict(),
+    }
+
+
+class ProgressTask:
+    """Enough of a taskhuddler Task, from a progress record, for get_task_artifact_costs."""
+
+    def __init__(self, taskid, definition, runs):
+        """Rebuild the parts of the task's json that artifact costs look at."""
+        self.taskid = taskid
+        self.json = {
+            'task': {'payload': {'artifacts': definition['artifacts']}, 'expires': definition['expires']},
+            'status': {'runs': [{'runId': run_id} for run_id in range(runs)]},
+        }
+
+
+def progress_tasks(progress):
+    """The tasks in a progress record whose definitions it holds, as ProgressTasks."""
+    definitions = progress.get('definitions', {})
+    missing = len(progress['tasks']) - len(definitions)
+    if missing:
+        log.debug("Task group %s: no definition for %d tasks", progress['groupid'], missing)
+    return [ProgressTask(task_id, definitions[task_id], record[RUNS])
+            for task_id, record in progress['tasks'].items() if task_id in definitions]
+
+
+def record_definition(progress, definition, task_id):
+    """Keep what artifact costs need from a task's definition, which never changes."""
+    definitions = progress.setdefault('definitions', dict())
+    if task_id not in definitions:
+        definitions[task_id] = {
+            'artifacts': definition.get('payload', {}).get('artifacts'),
+            'expires': definition['expires'],
+        }
+
+
+def progress_url(progress_output, group_id):
+    """Where the progress record for a graph is kept."""
+    return os.path.join(progress_output, '{}.json'.format(group_id))
+
+
+def load_progress(progress_output, group_id):
+    """Read a graph's progress record, or start a new one."""
+    try:
+        with open_wrapper(progress_url(progress_output, group_id), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return new_progress(group_id)
+
+
+def save_progress(progress_output, progress):
+    """Write a graph's progress record."""
+    with open_wrapper(progress_url(progress_output, progress['groupid']), 'w') as f:
+        json.dump(progress, f)
+
+
+def task_contribution(status):
+    """Work out what one task adds to the graph's totals, from its status.
+
+    Follows taskgraph_cost and TaskGraph.total_compute_time: every run counts
+    towards wall time, a completed task's final run towards the ideal cost,
+    and a completed task's runs towards compute time.
+    """
+    runs = status.get('runs', [])
+    wall = 0.0
+    for run in runs:
+        if run.get('started') and run.get('resolved'):
+            wall += (dateutil.parser.parse(run['resolved']) - dateutil.parser.parse(run['started'])).total_seconds()
+
+    final = 0.0
+    compute = 0.0
+    started = None
+    if runs and runs[-1].get('started'):
+        started = runs[-1]['started']
+        if status['state'] == 'completed' and runs[-1].get('resolved'):
+            final = (dateutil.parser.parse(runs[-1]['resolved']) - dateutil.parser.parse(started)).total_seconds()
+            compute = wall
+
+    return [status['workerType'], status['state'], len(runs), wall, final, compute, started]
+
+
+def record_status(progress, status, unresolved):
+    """Update a task's record from its latest status.
+
+    Returns:
+        True if the task was new or had changed.
+    """
+    task_id = status['taskId']
+    if status['state'] in UNRESOLVED_STATES:
+        unresolved.add(task_id)
+    else:
+        unresolved.discard(task_id)
+
+    record = progress['tasks'].get(task_id)
+    if record and record[STATE] == status['state'] and record[RUNS] == len(status.get('runs', [])):
+        return False
+    progress['tasks'][task_id] = task_contribution(status)
+    return True
+
+
+async def fetch_status(queue, task_id):
+    """Fetch one task's status, or None if the queue no longer knows it."""
+    try:
+        return (await queue.status(task_id))['status']
+    except taskcluster.exceptions.TaskclusterRestFailure as e:
+        log.debug("Couldn't get status of %s: %s", task_id, e)
+        return None
+
+
+async def update_progress(progress, finished=False, session=None, concurrency=STATUS_CONCURRENCY):
+    """Bring a progress record up to date with the queue.
+
+    Args:
+        progress (dict): from load_progress; updated in place
+        finished (bool): whether the graph is known to have finished, in
+            which case the whole group is listed once more
+        session (aiohttp.ClientSession): session for Taskcluster requests
+        concurrency (int): task status requests in flight
+
+    Returns:
+        number of tasks that were new or had changed.
+    """
+    group_id = progress['groupid']
+    queue = taskcluster_client('Queue', session=session)
+    unresolved = set(progress['unresolved'])
+    changed = 0
+
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = await asyncio.gather(*[
+        semaphore_wrapper(semaphore, fetch_status(queue, task_id)) for task_id in sorted(unresolved)
+    ])
+    for status in statuses:
+        if status is not None:
+            changed += record_status(progress, status, unresolved)
+
+    if finished and not progress['reconciled']:
+        progress['continuation_token'] = None
+        progress['listed_all'] = False
+
+    # Always carry on from the last page, even once the end has been
+    # reached, so tasks created since the last pass are picked up.
+    query = {'limit': PAGE_SIZE}
+    if progress['continuation_token']:
+        query['continuationToken'] = progress['continuation_token']
+    while True:
+        outcome = await queue.listTaskGroup(group_id, query=query)
+        for task in outcome.get('tasks', []):
+            changed += record_status(progress, task['status'], unresolved)
+            record_definition(progress, task['task'], task['status']['taskId'])
+        token = outcome.get('continuationToken')
+        if not token:
+            break
+        # Save the point reached after each full page, so the next pass
+        # only re-reads the page that was still filling up.
+        progress['continuation_token'] = query['continuationToken'] = token
+    progress['listed_all'] = True
+    if finished:
+        progress['reconciled'] = True
+
+    progress['unresolved'] = sorted(unresolved)
+    log.info("Task group %s: %d tasks known, %d changed, %d unresolved",
+             group_id, len(progress['tasks']), changed, len(unresolved))
+    return changed
+
+
+def progress_complete(progress):
+    """Whether every task the progress record knows of has resolved."""
+    return progress['listed_all'] and progress['reconciled'] and not progress['unresolved']
+
+
+def progress_summary(progress, worker_costs):
+    """Work out a graph's costs so far from its progress record.
+
+    Returns:
+        dict with graph_date, compute_time, taskcount, totalcost and
+        idealcost, like the columns the analyzer fills in.
+    """
+    total_wall_time_buckets = defaultdict(timedelta)
+    final_task_wall_time_buckets = defaultdict(timedelta)
+    compute_time = 0.0
+    started = list()
+    for record in progress['tasks'].values():
+        total_wall_time_buckets[record[WORKER]] += timedelta(seconds=record[WALL])
+        final_task_wall_time_buckets[record[WORKER]] += timedelta(seconds=record[FINAL])
+        compute_time += record[COMPUTE]
+        if record[STARTED]:
+            started.append(dateutil.parser.parse(record[STARTED]))
+
+    summary = {
+        'graph_date': None,
+        'compute_time': compute_time,
+        'taskcount': len(progress['tasks']),
+        'totalcost': 0.0,
+        'idealcost': 0.0,
+    }
+    if started:
+        start_date = min(started)
+        summary['graph_date'] = start_date.strftime("%Y-%m-%d")
+        summary['totalcost'], summary['idealcost'] = bucket_costs(
+            total_wall_time_buckets, final_task_wall_time_buckets, worker_costs, start_date,
+        )
+    return summary
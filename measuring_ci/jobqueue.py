@@ -0,0 +1,307 @@
+"""A durable queue of task graphs waiting to be analyzed.
+
+Scanners enqueue graphs and analyzers lease them at their own pace. A
+lease hides a job from other analyzers until its visibility timeout
+passes, so a job whose analyzer dies becomes visible again. Jobs that
+keep failing are moved to a dead-letter table instead of being dropped.
+
+JobQueue is the interface, with two implementations:
+
+    sqlite:///path   SQLiteJobQueue, for analyzers on a single machine
+    sqs://name       SQSJobQueue, durable and shared, for Lambda; leases
+                     are receive + visibility timeout, and dead letters
+                     the queue's redrive queue
+"""
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from collections import namedtuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+log = logging.getLogger()
+
+VISIBILITY_TIMEOUT = 15 * 60
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+
+Job = namedtuple('Job', ['groupid', 'payload', 'attempts', 'lease_token'])
+
+
+class JobQueue:
+    """Interface for analysis job queues."""
+
+    def enqueue(self, groupid, payload):
+        """Add a job, unless that groupid is already queued, done or dead-lettered.
+
+        Returns:
+            True if the job was added.
+        """
+        raise NotImplementedError
+
+    def lease(self, count=1, visibility_timeout=VISIBILITY_TIMEOUT):
+        """Take up to count visible jobs, hiding them for visibility_timeout seconds."""
+        raise NotImplementedError
+
+    def complete(self, job):
+        """Mark a leased job as done. Returns False if the lease had already been lost."""
+        raise NotImplementedError
+
+    def fail(self, job, error):
+        """Return a leased job for a later retry, or dead-letter it once out of attempts."""
+        raise NotImplementedError
+
+    def dead_letters(self):
+        """List (groupid, attempts, error) for jobs that have been given up on."""
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue kept in a local SQLite database, safe to share between processes."""
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        """Open, creating if needed, the queue database at path."""
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                groupid TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'ready',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                visible_at REAL NOT NULL,
+                lease_token TEXT,
+                enqueued_at REAL NOT NULL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (state, visible_at);
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                groupid TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT,
+                failed_at REAL NOT NULL
+            );
+        ''')
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two analyzers
+        # can't both select the same job before either updates it.
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def enqueue(self, groupid, payload):
+        """Add a job, unless that groupid is already queued, done or dead-lettered."""
+        now = time.time()
+        self._transaction()
+        try:
+            dead = self.db.execute('SELECT 1 FROM dead_letters WHERE groupid = ?', (groupid,)).fetchone()
+            added = False
+            if not dead:
+                cursor = self.db.execute(
+                    'INSERT OR IGNORE INTO jobs (groupid, payload, visible_at, enqueued_at) VALUES (?, ?, ?, ?)',
+                    (groupid, json.dumps(payload), now, now),
+                )
+                added = cursor.rowcount == 1
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return added
+
+    def lease(self, count=1, visibility_timeout=VISIBILITY_TIMEOUT):
+        """Take up to count visible jobs, including any whose lease has expired."""
+        now = time.time()
+        leased = list()
+        self._transaction()
+        try:
+            rows = self.db.execute(
+                "SELECT groupid, payload, attempts, last_error FROM jobs "
+                "WHERE state IN ('ready', 'leased') AND visible_at <= ? "
+                "ORDER BY enqueued_at LIMIT ?",
+                (now, count),
+            ).fetchall()
+            for groupid, payload, attempts, last_error in rows:
+                if attempts >= self.max_attempts:
+                    # The last lease expired without the job completing.
+                    self._dead_letter(groupid, payload, attempts, last_error or 'lease expired')
+                    continue
+                token = uuid.uuid4().hex
+                self.db.execute(
+                    "UPDATE jobs SET state = 'leased', attempts = attempts + 1, visible_at = ?, lease_token = ? "
+                    "WHERE groupid = ?",
+                    (now + visibility_timeout, token, groupid),
+                )
+                leased.append(Job(groupid, json.loads(payload), attempts + 1, token))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return leased
+
+    def complete(self, job):
+        """Mark a leased job as done, so it is never handed out again."""
+        cursor = self.db.execute(
+            "UPDATE jobs SET state = 'done', lease_token = NULL WHERE groupid = ? AND lease_token = ?",
+            (job.groupid, job.lease_token),
+        )
+        if cursor.rowcount != 1:
+            log.warning("Lease on %s was lost before it completed", job.groupid)
+            return False
+        return True
+
+    def fail(self, job, error):
+        """Return a leased job for a later retry, or dead-letter it once out of attempts."""
+        self._transaction()
+        try:
+            row = self.db.execute(
+                'SELECT payload, attempts FROM jobs WHERE groupid = ? AND lease_token = ?',
+                (job.groupid, job.lease_token),
+            ).fetchone()
+            if row is None:
+                log.warning("Lease on %s was lost before it failed", job.groupid)
+            elif row[1] >= self.max_attempts:
+                self._dead_letter(job.groupid, row[0], row[1], str(error))
+            else:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'ready', visible_at = ?, lease_token = NULL, last_error = ? "
+                    "WHERE groupid = ?",
+                    (time.time() + self.retry_delay, str(error), job.groupid),
+                )
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def _dead_letter(self, groupid, payload, attempts, error):
+        log.error("Giving up on %s after %d attempts: %s", groupid, attempts, error)
+        self.db.execute(
+            'INSERT OR REPLACE INTO dead_letters (groupid, payload, attempts, error, failed_at) VALUES (?, ?, ?, ?, ?)',
+            (groupid, payload, attempts, error, time.time()),
+        )
+        self.db.execute('DELETE FROM jobs WHERE groupid = ?', (groupid,))
+
+    def dead_letters(self):
+        """List (groupid, attempts, error) for jobs that have been given up on."""
+        return self.db.execute('SELECT groupid, attempts, error FROM dead_letters ORDER BY failed_at').fetchall()
+
+    def retry_dead_letter(self, groupid):
+        """Move a dead-lettered job back onto the queue with fresh attempts."""
+        row = self.db.execute('SELECT payload FROM dead_letters WHERE groupid = ?', (groupid,)).fetchone()
+        if row is None:
+            return False
+        self.db.execute('DELETE FROM dead_letters WHERE groupid = ?', (groupid,))
+        return self.enqueue(groupid, json.loads(row[0]))
+
+    def counts(self):
+        """Number of jobs in each state, including dead letters."""
+        counts = dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        counts['dead'] = self.db.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+        return counts
+
+
+class SQSJobQueue(JobQueue):
+    """JobQueue kept in an SQS queue, so it outlives any one process or Lambda invocation.
+
+    SQS only deduplicates within its five minute window, and only for FIFO
+    queues, which get the groupid as their deduplication ID; a graph
+    enqueued again after that is analyzed again. Dead-lettering is left
+    to the queue's redrive policy, whose maxReceiveCount plays the part
+    of max_attempts.
+    """
+
+    # Most messages SQS hands out in one receive.
+    RECEIVE_LIMIT = 10
+
+    def __init__(self, queue_url, retry_delay=RETRY_DELAY, sqs_client=None):
+        """Use the queue at queue_url."""
+        self.queue_url = queue_url
+        self.retry_delay = retry_delay
+        self.sqs = sqs_client or boto3.client('sqs')
+        self.fifo = queue_url.endswith('.fifo')
+
+    @classmethod
+    def from_name(cls, name, **kwargs):
+        """Open a queue by name."""
+        sqs = kwargs.pop('sqs_client', None) or boto3.client('sqs')
+        return cls(sqs.get_queue_url(QueueName=name)['QueueUrl'], sqs_client=sqs, **kwargs)
+
+    def enqueue(self, groupid, payload):
+        """Send a job. Repeats are only dropped by FIFO queues, within their deduplication window."""
+        message = {'QueueUrl': self.queue_url, 'MessageBody': json.dumps({'groupid': groupid, 'payload': payload})}
+        if self.fifo:
+            message.update({'MessageGroupId': groupid, 'MessageDeduplicationId': groupid})
+        self.sqs.send_message(**message)
+        return True
+
+    def lease(self, count=1, visibility_timeout=VISIBILITY_TIMEOUT):
+        """Receive up to count messages, hiding them for visibility_timeout seconds."""
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(count, self.RECEIVE_LIMIT)),
+            VisibilityTimeout=visibility_timeout,
+            AttributeNames=['ApproximateReceiveCount'],
+        )
+        leased = list()
+        for message in response.get('Messages', []):
+            body = json.loads(message['Body'])
+            attempts = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+            leased.append(Job(body['groupid'], body['payload'], attempts, message['ReceiptHandle']))
+        return leased
+
+    def complete(self, job):
+        """Delete a leased job's message."""
+        try:
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=job.lease_token)
+        except ClientError as e:
+            log.warning("Lease on %s was lost before it completed: %s", job.groupid, e)
+            return False
+        return True
+
+    def fail(self, job, error):
+        """Make a leased job visible again after the retry delay; the redrive policy dead-letters it."""
+        log.warning("Analysis of %s failed on attempt %d: %s", job.groupid, job.attempts, error)
+        try:
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url, ReceiptHandle=job.lease_token, VisibilityTimeout=self.retry_delay,
+            )
+        except ClientError as e:
+            log.warning("Lease on %s was lost before it failed: %s", job.groupid, e)
+
+    def dead_letters(self):
+        """List (groupid, attempts, error) for the jobs in the redrive queue, without taking them."""
+        attributes = self.sqs.get_queue_attributes(QueueUrl=self.queue_url, AttributeNames=['RedrivePolicy'])
+        policy = attributes.get('Attributes', {}).get('RedrivePolicy')
+        if not policy:
+            return list()
+        name = json.loads(policy)['deadLetterTargetArn'].split(':')[-1]
+        dead = SQSJobQueue.from_name(name, sqs_client=self.sqs)
+        return [(job.groupid, job.attempts, None) for job in dead.lease(count=self.RECEIVE_LIMIT, visibility_timeout=0)]
+
+    def counts(self):
+        """Approximate number of jobs waiting and leased."""
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'],
+        )['Attributes']
+        return {
+            'ready': int(attributes['ApproximateNumberOfMessages']),
+            'leased': int(attributes['ApproximateNumberOfMessagesNotVisible']),
+        }
+
+
+def open_job_queue(url):
+    """Open a job queue from a location such as 'sqlite:///path/queue.db', 'sqs://name' or a plain path."""
+    if url.startswith('sqlite://'):
+        return SQLiteJobQueue(url[len('sqlite://'):])
+    if url.startswith('sqs://'):
+        return SQSJobQueue.from_name(url[len('sqs://'):])
+    if url.startswith('https://sqs.'):
+        return SQSJobQueue(url)
+    if '://' in url:
+        raise ValueError("No job queue backend for {}".format(url))
+    return SQLiteJobQueue(url)
@@ -0,0 +1,107 @@
+"""How cost outputs are laid out in parquet, so queries can skip most of them.
+
+Cost outputs are written with:
+
+    timestamps      graph_date as a real timestamp rather than a string or
+                    an epoch, so Athena can compare it without casting
+    sorting         rows in graph_date order, so each row group covers a
+                    narrow range of dates
+    row groups      of a fixed number of rows, with min/max statistics for
+                    every column, so a date predicate can skip row groups
+                    whose range it can't match
+    dictionaries    only for the low-cardinality columns: dictionaries of
+                    task graph IDs or costs take space and save nothing
+
+Only the partitioned cost dataset gets the timestamps. The single-file
+outputs keep graph_date as whatever type they already hold, since the
+tables over them were defined with it; they still get the rest.
+
+The codec and row group size can be set in the config, as
+parquet_compression and parquet_row_group_size; see
+one_offs/benchmark_layout.py for how the choices compare.
+"""
+import logging
+import numbers
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .files import open_wrapper
+
+log = logging.getLogger()
+
+DICTIONARY_COLUMNS = ['project', 'product', 'category', 'phase']
+TIMESTAMP_COLUMNS = ['graph_date']
+SORT_COLUMNS = ['graph_date']
+COMPRESSION = 'gzip'
+ROW_GROUP_SIZE = 10000
+
+
+def layout_options(config):
+    """Parquet writing options from a scanner config."""
+    return {
+        'compression': config.get('parquet_compression', COMPRESSION),
+        'row_group_size': config.get('parquet_row_group_size', ROW_GROUP_SIZE),
+    }
+
+
+def to_timestamp(value):
+    """Convert a graph date to a Timestamp.
+
+    Graph dates may already be timestamps, YYYY-MM-DD strings, or, from the
+    pushlog, epoch seconds.
+    """
+    if value is None or pd.isnull(value):
+        return pd.NaT
+    if isinstance(value, numbers.Number):
+        return pd.Timestamp(value, unit='s')
+    return pd.Timestamp(value)
+
+
+def prepare_frame(costs, convert_types=True):
+    """Convert a frame of costs to the stored types, sorted by graph date.
+
+    Args:
+        convert_types (bool): whether to store graph dates as timestamps
+    """
+    costs = costs.copy()
+    for column in TIMESTAMP_COLUMNS if convert_types else []:
+        if column in costs.columns:
+            costs[column] = pd.to_datetime(costs[column].map(to_timestamp))
+    sort_columns = [c for c in SORT_COLUMNS if c in costs.columns]
+    if sort_columns:
+        costs = costs.sort_values(sort_columns, kind='mergesort', na_position='last')
+    return costs.reset_index(drop=True)
+
+
+def costs_table(costs, convert_types=True):
+    """Arrow table of a frame of costs, as it will be stored."""
+    return pa.Table.from_pandas(prepare_frame(costs, convert_types=convert_types), preserve_index=False)
+
+
+def write_table(table, filename, compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE):
+    """Write an Arrow table of costs to a local or s3:// parquet file."""
+    with open_wrapper(filename, 'wb') as f:
+        pq.write_table(
+            table, f,
+            compression=compression,
+            row_group_size=row_group_size,
+            use_dictionary=[c for c in DICTIONARY_COLUMNS if c in table.schema.names],
+            write_statistics=True,
+            # Milliseconds, as Athena reads them; nanoseconds need a newer
+            # parquet format version.
+            coerce_timestamps='ms',
+            allow_truncated_timestamps=True,
+        )
+
+
+def write_cost_file(costs, filename, compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE, convert_types=True):
+    """Write a frame of costs to a local or s3:// parquet file in the stored layout.
+
+    Args:
+        convert_types (bool): whether to store graph dates as timestamps.
+            False for the single-file outputs, which keep their types.
+    """
+    write_table(costs_table(costs, convert_types=convert_types), filename,
+                compression=compression, row_group_size=row_group_size)
@@ -0,0 +1,102 @@
+"""A catalog of the files staged for collation.
+
+Each analyzer stages its costs under a name no other run will use, then
+adds an entry for that file to the staging area's manifest:
+
+    {staging_output}/{groupid}.{id}.parquet
+    {staging_output}/_manifest/{groupid}.{id}.parquet.json
+
+s3 has no append, so each entry is an object of its own, added only
+once its file is complete. An entry's name says which graph and file it
+is for, so the manifest can be read with one listing of its own prefix,
+however much else is in the staging area.
+
+The collator takes a snapshot of the entries, collates just those files,
+and then removes just those entries and files. A file staged while
+collation is running has an entry outside the snapshot, so it is left
+for the next run rather than being deleted unread.
+"""
+import json
+import logging
+import os
+import time
+import urllib.parse
+import uuid
+from datetime import datetime
+
+import boto3
+
+from .files import list_files, make_dirs, open_wrapper, remove_files_in_batches
+from .utils import list_s3_objects
+
+log = logging.getLogger()
+
+MANIFEST_DIR = '_manifest'
+ENTRY_SUFFIX = '.json'
+
+
+def manifest_url(staging_output):
+    """Where the manifest of a staging area lives."""
+    return os.path.join(staging_output, MANIFEST_DIR, '')
+
+
+def staged_file_name(groupid):
+    """A name for a graph's staged file that no other run will use.
+
+    Names for the same graph sort in the order they were made, so if a
+    graph is staged twice before collation the later costs win.
+    """
+    return '{}.{}-{}'.format(groupid, datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex)
+
+
+def add_manifest_entry(staging_output, groupid, staged_file):
+    """Add a complete staged file to the manifest."""
+    directory = manifest_url(staging_output)
+    make_dirs(directory)
+    entry = os.path.join(directory, os.path.basename(staged_file) + ENTRY_SUFFIX)
+    with open_wrapper(entry, 'w') as f:
+        json.dump({'groupid': groupid, 'file': staged_file, 'staged': time.time()}, f)
+    return entry
+
+
+def parse_entry(staging_output, entry):
+    """Graph and staged file of a manifest entry, from its name alone."""
+    name = os.path.basename(entry)[:-len(ENTRY_SUFFIX)]
+    return {
+        'groupid': name.split('.')[0],
+        'file': os.path.join(staging_output, name),
+        'entry': entry,
+    }
+
+
+async def list_manifest_entries(staging_output):
+    """List the entry files in a staging area's manifest."""
+    directory = manifest_url(staging_output)
+    if not directory.startswith('s3://'):
+        return [os.path.join(directory, name) for name in list_files(directory)]
+    url = urllib.parse.urlparse(directory)
+    objects = await list_s3_objects(boto3.client('s3'), url.netloc, url.path.lstrip('/'))
+    return ['s3://{}/{}'.format(url.netloc, o['Key']) for o in objects]
+
+
+async def read_manifest(staging_output):
+    """Take a snapshot of a staging area's manifest.
+
+    Returns:
+        list of dicts with the groupid, staged file and manifest entry
+        of each file staged so far, in order of groupid and then of
+        staging.
+    """
+    entries = await list_manifest_entries(staging_output)
+    return [parse_entry(staging_output, entry) for entry in sorted(entries) if entry.endswith(ENTRY_SUFFIX)]
+
+
+def remove_manifest_entries(entries):
+    """Remove collated entries and then their staged files.
+
+    Entries go first, so an interrupted clean up leaves files with no
+    entry, which are ignored, rather than entries with no file.
+    """
+    remove_files_in_batches([entry['entry'] for entry in entries])
+    remove_files_in_batches([entry['file'] for entry in entries])
+    log.info("Removed %d collated files from the staging manifest", len(entries))
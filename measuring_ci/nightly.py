@@ -1,14 +1,23 @@
 import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import aiohttp
 import taskcluster.aio
 import yaml
 
-from .utils import tc_options
+from .ratelimit import take_token, taskcluster_client
+from .utils import semaphore_wrapper
 
 log = logging.getLogger()
 
+# Prefer the C yaml parser if pyyaml was built with libyaml.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+FETCH_CONCURRENCY = 20
+
+# app_version by decision task ID
+_app_versions = dict()
+
 
 def sanitize_date(date):
     """Attempt to sanitize a date format.
@@ -20,8 +29,63 @@ def sanitize_date(date):
     return date
 
 
-async def fetch_nightlies(date, project='mozilla-central'):
-    """Fetch nightly task group IDs by date."""
+async def find_build_group(idx, queue, namespace):
+    """Find the task group for an indexed nightly build task.
+
+    Returns:
+        (taskGroupId, revision, product), or None if the task can't be found.
+    """
+    log.debug('Looking for taskId via task %s', namespace)
+    try:
+        build_task = await idx.findTask(namespace)
+        task_def = await queue.task(build_task['taskId'])
+    except taskcluster.exceptions.TaskclusterRestFailure as e:
+        log.warning(e)
+        return None
+    revision, product = namespace.split('.')[-3:-1]
+    return task_def['taskGroupId'], revision, product
+
+
+def parse_app_version(parameters_text):
+    """Extract app_version from the text of a parameters.yml file."""
+    parameters = yaml.load(parameters_text, Loader=YAML_LOADER)
+    return parameters.get('app_version', '')
+
+
+async def fetch_app_version(session, queue, decision_task_id):
+    """Find the version, hidden in the parameters of the decision task's artifacts.
+
+    Results are cached per decision task, as they never change.
+
+    Returns:
+        the version, or None if the parameters couldn't be fetched or read.
+    """
+    if decision_task_id in _app_versions:
+        return _app_versions[decision_task_id]
+    url = queue.buildUrl('getLatestArtifact', decision_task_id, 'public/parameters.yml')
+    try:
+        await take_token(queue)
+        async with session.get(url) as response:
+            response.raise_for_status()
+            parameters_text = await response.text()
+        # Parsing a large parameters file is CPU-bound, so keep it off the event loop.
+        loop = asyncio.get_event_loop()
+        version = await loop.run_in_executor(None, parse_app_version, parameters_text)
+    except (aiohttp.ClientError, asyncio.TimeoutError, yaml.YAMLError, AttributeError) as e:
+        log.warning("Couldn't find app_version for %s: %s", decision_task_id, e)
+        return None
+    _app_versions[decision_task_id] = version
+    return version
+
+
+def date_range(start_date, end_date):
+    """List each day from start_date to end_date, inclusive."""
+    days = (end_date - start_date).days
+    return [start_date + timedelta(days=n) for n in range(days + 1)]
+
+
+async def find_nightly_build_tasks(idx, date, project='mozilla-central'):
+    """List one indexed build task namespace per product and platform for a day."""
     index = "gecko.v2.{project}.nightly.{date}.revision"
 
     index = index.format(
@@ -29,10 +93,11 @@ async def fetch_nightlies(date, project='mozilla-central'):
         date=sanitize_date(date),
     )
 
-    idx = taskcluster.aio.Index(options=tc_options())
-    queue = taskcluster.aio.Queue(options=tc_options())
-
-    ret = await idx.listNamespaces(index)
+    try:
+        ret = await idx.listNamespaces(index)
+    except taskcluster.exceptions.TaskclusterRestFailure as e:
+        log.warning(e)
+        return list()
 
     revision_namespaces = [n['namespace'] for n in ret['namespaces']]
 
@@ -52,30 +117,55 @@ async def fetch_nightlies(date, project='mozilla-central'):
         # that fall under the same task group ID, so we can just
         # get the first one and use that.
         build_tasks.append(platform['tasks'][0]['namespace'])
+    return build_tasks
+
 
-    results = dict()
-    for task in build_tasks:
-        log.debug('Looking for taskId via task %s', task)
-        try:
-            build_task = await idx.findTask(task)
-            task_def = await queue.task(build_task['taskId'])
-            revision, product = task.split('.')[-3:-1]
-            results[task_def['taskGroupId']] = {
+async def fetch_nightlies(start_date, end_date=None, project='mozilla-central', concurrency=FETCH_CONCURRENCY):
+    """Fetch nightly task group IDs for each day from start_date to end_date.
+
+    Args:
+        start_date (datetime): first day to look at
+        end_date (datetime): last day to look at, inclusive. Defaults to start_date.
+        project (str): mozilla-central or similar
+        concurrency (int): number of task lookups in flight
+
+    Returns:
+        dict of task group ID to product, revision and version, with
+        each task group appearing once however many days it is indexed under.
+    """
+    days = date_range(start_date, end_date or start_date)
+
+    async with aiohttp.ClientSession() as session:
+        idx = taskcluster_client('Index', session=session)
+        queue = taskcluster_client('Queue', session=session)
+
+        ret = await asyncio.gather(*[find_nightly_build_tasks(idx, day, project) for day in days])
+        build_tasks = [task for day in ret for task in day]
+        log.debug("Found %d build tasks over %d days", len(build_tasks), len(days))
+
+        # Each task group's parameters are fetched as soon as the group is first
+        # seen, while the remaining build tasks are still being looked up.
+        semaphore = asyncio.Semaphore(concurrency)
+        results = dict()
+        versions = dict()
+        lookups = [asyncio.ensure_future(semaphore_wrapper(semaphore, find_build_group(idx, queue, task)))
+                   for task in build_tasks]
+        for lookup in asyncio.as_completed(lookups):
+            found = await lookup
+            if not found:
+                continue
+            group_id, revision, product = found
+            if group_id in results:
+                continue
+            results[group_id] = {
                 'product': product,
                 'revision': revision,
             }
-            # Find the version, hidden in the parameters of the
-            # decision task's artifacts
-            sync_queue = taskcluster.Queue(options=tc_options())
-            parameters_response = sync_queue.getLatestArtifact(taskId=task_def['taskGroupId'], name='public/parameters.yml')
-            # print(parameters_response)
-
-            parameters = yaml.load(parameters_response['response'].text)
-            # async variant
-            # parameters = yaml.loads(await parameters_response['response'].text())
-            results[task_def['taskGroupId']]['version'] = parameters.get('app_version', '')
-
-        except taskcluster.exceptions.TaskclusterRestFailure as e:
-            log.warning(e)
+            versions[group_id] = asyncio.ensure_future(
+                semaphore_wrapper(semaphore, fetch_app_version(session, queue, group_id)),
+            )
+
+        for group_id, version in versions.items():
+            results[group_id]['version'] = await version
 
     return results
@@ -0,0 +1,77 @@
+"""Reading many small parquet files quickly."""
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import s3fs
+
+log = logging.getLogger()
+
+READ_WORKERS = 32
+
+
+def read_table(filename, fs=None, columns=None):
+    """Read a local or s3:// parquet file as an Arrow table."""
+    if filename.startswith('s3://'):
+        with fs.open(filename, 'rb') as f:
+            return pq.read_table(f, columns=columns, use_threads=False)
+    return pq.read_table(filename, columns=columns, use_threads=False)
+
+
+def read_tables(filenames, fs=None, max_workers=READ_WORKERS, columns=None):
+    """Read parquet files concurrently, sharing one s3 filesystem handle.
+
+    Each file is a round trip to s3, so they're read in a thread pool;
+    pyarrow releases the GIL while decoding.
+
+    Returns:
+        list of Arrow tables, in the order of filenames.
+    """
+    if fs is None and any(f.startswith('s3://') for f in filenames):
+        fs = s3fs.S3FileSystem()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda filename: read_table(filename, fs=fs, columns=columns), filenames))
+
+
+def tables_to_frame(tables):
+    """Concatenate Arrow tables, converting to pandas only once per schema.
+
+    Tables are concatenated in Arrow, one conversion per distinct schema:
+    staged files can differ where a column was all null in one of them.
+    Rows come back in the order of the tables, as callers keep the last
+    row written for each graph.
+
+    Returns:
+        DataFrame, or None if there were no tables.
+    """
+    by_schema = OrderedDict()
+    for position, table in enumerate(tables):
+        fields = tuple((field.name, str(field.type)) for field in table.schema)
+        by_schema.setdefault(fields, list()).append((position, table))
+    frames = list()
+    positions = list()
+    for group in by_schema.values():
+        # pandas metadata can differ in details between files with the same
+        # columns, so concatenate without it and keep the first file's.
+        metadata = group[0][1].schema.metadata
+        table = pa.concat_tables([t.replace_schema_metadata(None) for _, t in group])
+        frames.append(table.replace_schema_metadata(metadata).to_pandas())
+        positions.extend(np.repeat(position, t.num_rows) for position, t in group)
+    if not frames:
+        return None
+    if len(frames) == 1:
+        return frames[0]
+    log.debug("Combining %d schemas", len(frames))
+    combined = pd.concat(frames, sort=True, ignore_index=True)
+    # Back into the order of the tables; a stable sort keeps each table's own order.
+    order = np.argsort(np.concatenate(positions), kind='mergesort')
+    return combined.iloc[order].reset_index(drop=True)
+
+
+def read_parquet_files(filenames, fs=None, max_workers=READ_WORKERS, columns=None):
+    """Read many parquet files into one DataFrame, or None if there were none."""
+    return tables_to_frame(read_tables(filenames, fs=fs, max_workers=max_workers, columns=columns))
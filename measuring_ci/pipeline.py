@@ -0,0 +1,154 @@
+"""Run work through stages connected by bounded queues.
+
+Each stage has its own workers, so while one stage waits on the network
+another can be computing, and throughput is set by the slowest stage
+rather than the sum of them all. Queues between stages are bounded, so
+a fast stage can't run far ahead of a slow one and fill memory with
+half-processed items.
+"""
+import asyncio
+import gc
+import logging
+
+from .utils import rss_bytes
+
+log = logging.getLogger()
+
+QUEUE_SIZE = 10
+MEMORY_POLL_INTERVAL = 1
+
+# Marks the end of a stage's input.
+_DONE = object()
+
+
+class Stage:
+    """One step of a pipeline.
+
+    Args:
+        name (str): for log messages
+        function: called with each item, returning the item for the next
+            stage, or None to drop it. A coroutine function, unless blocking.
+        workers (int): items worked on at once
+        blocking (bool): whether function is an ordinary, blocking function,
+            to be run in the event loop's default executor
+    """
+
+    def __init__(self, name, function, workers=1, blocking=False):
+        """Describe the stage."""
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.blocking = blocking
+
+
+class Window:
+    """Limit how many items are in flight between two points of a pipeline.
+
+    Stages call enter() before taking on an item's large data, and
+    leave() once they are done with it. As well as a fixed count, a
+    memory ceiling can be given: while the process's resident memory is
+    above it, no more items enter until those already in flight leave.
+    One item is always let through, so the pipeline can't stall.
+
+    Args:
+        size (int): items in flight at once
+        memory_limit (int): ceiling on resident memory, in bytes
+    """
+
+    def __init__(self, size, memory_limit=None):
+        """Set the limits."""
+        self.semaphore = asyncio.Semaphore(size)
+        self.memory_limit = memory_limit
+        self.active = 0
+
+    def over_memory_limit(self):
+        """Whether resident memory is above the ceiling."""
+        if not self.memory_limit:
+            return False
+        rss = rss_bytes()
+        return rss is not None and rss > self.memory_limit
+
+    async def enter(self):
+        """Wait for room for another item."""
+        await self.semaphore.acquire()
+        while self.active and self.over_memory_limit():
+            gc.collect()
+            if not self.over_memory_limit():
+                break
+            log.debug("Over the memory limit with %d items in flight, waiting", self.active)
+            await asyncio.sleep(MEMORY_POLL_INTERVAL)
+        self.active += 1
+
+    def leave(self):
+        """Let another item in."""
+        self.active -= 1
+        self.semaphore.release()
+
+
+async def _run_stage(stage, inbox, outbox, failures):
+    loop = asyncio.get_event_loop()
+    while True:
+        item = await inbox.get()
+        if item is _DONE:
+            return
+        try:
+            if stage.blocking:
+                result = await loop.run_in_executor(None, stage.function, item)
+            else:
+                result = await stage.function(item)
+        except Exception as e:
+            log.warning("%s failed for %s: %s", stage.name, item, e)
+            failures.append((stage.name, item, e))
+            continue
+        if result is not None:
+            await outbox.put(result)
+
+
+async def _feed(items, queue, workers):
+    for item in items:
+        await queue.put(item)
+    for _ in range(workers):
+        await queue.put(_DONE)
+
+
+async def _close_after(workers, queue, next_workers):
+    await asyncio.gather(*workers)
+    for _ in range(next_workers):
+        await queue.put(_DONE)
+
+
+async def run_pipeline(items, stages, queue_size=QUEUE_SIZE):
+    """Pass each item through every stage in turn.
+
+    An item whose stage raises is dropped and reported, rather than
+    stopping the pipeline.
+
+    Args:
+        items (iterable): inputs to the first stage
+        stages (list): Stage for each step
+        queue_size (int): items waiting between one stage and the next
+
+    Returns:
+        (results, failures): the last stage's outputs, in the order they
+        finished, and a list of (stage name, item, exception).
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    results = asyncio.Queue()
+    failures = list()
+
+    runners = [asyncio.ensure_future(_feed(items, queues[0], stages[0].workers))]
+    for index, stage in enumerate(stages):
+        outbox = queues[index + 1] if index + 1 < len(stages) else results
+        workers = [asyncio.ensure_future(_run_stage(stage, queues[index], outbox, failures))
+                   for _ in range(stage.workers)]
+        next_workers = stages[index + 1].workers if index + 1 < len(stages) else 0
+        runners.append(asyncio.ensure_future(_close_after(workers, outbox, next_workers)))
+
+    await asyncio.gather(*runners)
+
+    outputs = list()
+    while not results.empty():
+        outputs.append(results.get_nowait())
+    if failures:
+        log.warning("%d items failed to get through the pipeline", len(failures))
+    return outputs, failures
@@ -1,22 +1,290 @@
 import asyncio
+import codecs
 import json
 import logging
 
 import aiodns  # noqa
 import aiohttp
 
-from .files import open_wrapper
+from .pushlog_cache import PushlogCache
 from .revision import find_taskgroup_by_revision
+from .utils import semaphore_wrapper
 
 log = logging.getLogger()
 
+# Pushes per json-pushes request when backfilling, and how many requests to run at once.
+BACKFILL_CHUNK_SIZE = 250
+BACKFILL_CONCURRENCY = 4
+BACKFILL_STATE = 'backfill'
+# Push ranges fetched by backfills, which the pushlog scanner looks for
+# graphs in until it has analyzed them all.
+BACKFILLED_STATE = 'backfilled'
+# Task graph lookups in flight while a pushlog response is still being read.
+RESOLVE_CONCURRENCY = 10
+CHUNK_TIMEOUT = aiohttp.ClientTimeout(total=60 * 10)
+SCAN_TIMEOUT = aiohttp.ClientTimeout(total=60 * 60 * 3)
+
+
+def new_session(limit=100):
+    """Create a session for pushlog and Taskcluster requests, with a connection limit."""
+    connector = aiohttp.TCPConnector(limit=limit,
+                                     resolver=aiohttp.resolver.AsyncResolver())
+    return aiohttp.ClientSession(connector=connector)
+
+
+class PushStreamParser:
+    """Incremental parser for version 2 json-pushes responses.
+
+    Text is fed in as it arrives, and each complete push is returned as
+    soon as it has been read, as (pushid, date, final changeset). Only one
+    push's changeset list is held in memory at a time.
+    """
+
+    def __init__(self):
+        """Start expecting the opening brace of the response."""
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._state = 'start'
+
+    def _skip(self, pos, separators=' \t\r\n'):
+        while pos < len(self._buffer) and self._buffer[pos] in separators:
+            pos += 1
+        return pos
+
+    def _decode(self, pos, final):
+        """Decode one JSON value at pos, or return None if more text is needed."""
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, pos)
+        except ValueError:
+            if final:
+                raise
+            return None
+        # A number at the end of the buffer may continue in the next chunk;
+        # anything else is already complete.
+        if end == len(self._buffer) and not final and isinstance(value, (int, float)) and not isinstance(value, bool):
+            return None
+        return value, end
+
+    def feed(self, text, final=False):
+        """Consume more response text, returning any pushes now complete."""
+        self._buffer += text
+        pushes = list()
+        pos = 0
+        while True:
+            pos = self._skip(pos, ' \t\r\n,' if self._state != 'start' else ' \t\r\n')
+            if pos >= len(self._buffer):
+                break
+            char = self._buffer[pos]
+            if self._state == 'start':
+                if char != '{':
+                    raise ValueError("Expected a JSON object from json-pushes")
+                self._state = 'key'
+                pos += 1
+            elif self._state in ('key', 'push') and char == '}':
+                self._state = 'key' if self._state == 'push' else 'done'
+                pos += 1
+            elif self._state == 'pushes':
+                if char != '{':
+                    raise ValueError("Expected 'pushes' to be a JSON object")
+                self._state = 'push'
+                pos += 1
+            elif self._state in ('key', 'push'):
+                key = self._decode(pos, final)
+                if key is None:
+                    break
+                colon = self._skip(key[1])
+                if colon >= len(self._buffer):
+                    break
+                if self._buffer[colon] != ':':
+                    raise ValueError("Expected ':' after a key in json-pushes response")
+                if self._state == 'key' and key[0] == 'pushes':
+                    self._state = 'pushes'
+                    pos = colon + 1
+                    continue
+                value = self._decode(self._skip(colon + 1), final)
+                if value is None:
+                    break
+                if self._state == 'push':
+                    pushes.append((int(key[0]), value[0]['date'], value[0]['changesets'][-1]))
+                pos = value[1]
+            else:
+                raise ValueError("Unexpected data after json-pushes response")
+        self._buffer = self._buffer[pos:]
+        return pushes
+
+    def close(self):
+        """Finish parsing, raising if the response was incomplete."""
+        pushes = self.feed('', final=True)
+        if self._state != 'done':
+            raise ValueError("Truncated json-pushes response")
+        return pushes
+
+
+async def iter_pushes(response, chunk_size=64 * 1024):
+    """Yield (pushid, date, final changeset) from a json-pushes response as it downloads."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parser = PushStreamParser()
+    async for chunk in response.content.iter_chunked(chunk_size):
+        for push in parser.feed(decoder.decode(chunk)):
+            yield push
+    for push in parser.feed(decoder.decode(b'', final=True)):
+        yield push
+    for push in parser.close():
+        yield push
+
+
+async def resolve_push(pushid, epoch, final_cset, project, product, session=None):
+    """Build a cache entry for a push, looking up its task graph ID."""
+    # final_cset is the cset used for CI indexing.
+    graph_id = await find_taskgroup_by_revision(
+        revision=final_cset,
+        project=project,
+        product=product,
+        session=session,
+    )
+    if not graph_id:
+        log.warning("Couldn't find task graph for {} revision {}".format(project,
+                                                                         final_cset))
+        graph_id = ""
+    return {
+        "pushid": pushid,
+        "date": epoch,
+        "changeset": final_cset,
+        "taskgraph": graph_id,
+    }
+
+
+async def read_pushes(response, project, product, concurrency=RESOLVE_CONCURRENCY, session=None):
+    """Stream pushes out of a json-pushes response, resolving task graphs as they arrive."""
+    semaphore = asyncio.Semaphore(concurrency)
+    lookups = list()
+    async for pushid, epoch, final_cset in iter_pushes(response):
+        log.debug("Inspecting push %s", pushid)
+        lookups.append(asyncio.ensure_future(semaphore_wrapper(
+            semaphore, resolve_push(pushid, epoch, final_cset, project, product, session=session),
+        )))
+    return await asyncio.gather(*lookups)
+
+
+def backfill_chunks(cache, start, end, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Split the inclusive push range [start, end] into chunks not yet fully cached.
+
+    Returns:
+        list of (startID, endID) tuples in json-pushes terms, where
+        startID is exclusive and endID inclusive.
+    """
+    chunks = list()
+    for chunk_start in range(start, end + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, end)
+        if cache.missing_pushes(chunk_start, chunk_end):
+            chunks.append((chunk_start - 1, chunk_end))
+    return chunks
+
+
+async def fetch_push_chunk(session, url, start_id, end_id, cache, project, product):
+    """Fetch one range of pushes and checkpoint it to the cache."""
+    chunk_url = url + "&startID={}&endID={}".format(start_id, end_id)
+    log.debug("Querying push url %s", chunk_url)
+    async with session.get(chunk_url, timeout=CHUNK_TIMEOUT) as response:
+        response.raise_for_status()
+        entries = await read_pushes(response, project, product, session=session)
+    cache.add_pushes(entries)
+    log.info("Backfilled pushes %d-%d (%d found)", start_id + 1, end_id, len(entries))
+
+
+async def backfill_pushlog(pushlog_url,
+                           cache,
+                           start,
+                           end,
+                           project='mozilla-central',
+                           product='firefox',
+                           chunk_size=BACKFILL_CHUNK_SIZE,
+                           concurrency=BACKFILL_CONCURRENCY,
+                           session=None):
+    """Fetch the inclusive push range [start, end] in concurrent, checkpointed chunks.
+
+    Each chunk is written to the cache as soon as it completes, and the
+    range being filled is recorded in the cache, so a run that is cut short
+    picks up the remaining chunks next time, via resume_backfill.
+
+    Args:
+        pushlog_url (str): url template for pushlog, including {project}
+        cache (PushlogCache): cache to fill in
+        start (int): first push ID wanted
+        end (int): last push ID wanted
+        project (str): mozilla-central, releases/mozilla-release or similar
+        product (str): Used for finding the taskgraph. e.g. 'firefox'
+        chunk_size (int): pushes to request at once
+        concurrency (int): number of chunks in flight
+        session (aiohttp.ClientSession): session to share. Default: a new one.
+
+    Returns:
+        list of (startID, endID) chunks which failed.
+    """
+    start = max(start, 1)
+    cache.write_state(BACKFILL_STATE, {'start': start, 'end': end})
+    record_backfilled(cache, start, end)
+    chunks = backfill_chunks(cache, start, end, chunk_size)
+    log.info("Backfilling %s pushes %d-%d in %d chunks", project, start, end, len(chunks))
+
+    url = pushlog_url.format(project=project)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    own_session = session is None
+    if own_session:
+        session = new_session(limit=concurrency * RESOLVE_CONCURRENCY)
+    try:
+        results = await asyncio.gather(
+            *[semaphore_wrapper(semaphore, fetch_push_chunk(session, url, start_id, end_id,
+                                                            cache, project, product))
+              for start_id, end_id in chunks],
+            return_exceptions=True,
+        )
+    finally:
+        if own_session:
+            await session.close()
+
+    failed = list()
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            log.error("Backfill of pushes %d-%d failed: %s", chunk[0] + 1, chunk[1], result)
+            failed.append(chunk)
+    if not failed:
+        cache.write_state(BACKFILL_STATE, None)
+    return failed
+
+
+def record_backfilled(cache, start, end):
+    """Note that the inclusive push range [start, end] was backfilled."""
+    ranges = (cache.read_state(BACKFILLED_STATE) or {}).get('ranges', [])
+    if [start, end] not in ranges:
+        ranges.append([start, end])
+        cache.write_state(BACKFILLED_STATE, {'ranges': ranges})
+
+
+async def resume_backfill(pushlog_url, cache, project='mozilla-central', product='firefox', **kwargs):
+    """Finish any backfill left incomplete by an earlier run.
+
+    Returns:
+        True if there was a backfill to resume.
+    """
+    state = cache.read_state(BACKFILL_STATE)
+    if not state:
+        return False
+    log.info("Resuming backfill of %s pushes %d-%d", project, state['start'], state['end'])
+    await backfill_pushlog(pushlog_url, cache, state['start'], state['end'],
+                           project=project, product=product, **kwargs)
+    return True
+
 
 async def scan_pushlog(pushlog_url,
                        project='mozilla-central',
                        product='firefox',
                        starting_push=None,
                        backfill_count=None,
-                       cache_file=None):
+                       cache=None,
+                       backfill_chunk_size=BACKFILL_CHUNK_SIZE,
+                       session=None):
     """Scan through the pushlog for entries.
 
     Args:
@@ -25,79 +293,54 @@ async def scan_pushlog(pushlog_url,
         product (str): Used for finding the taskgraph. e.g. 'firefox'
         starting_push (int): push ID to start from. Defaults to most recent 10
         backfill_count (int): number of older pushes to retrieve, prior to the oldest known push
-        cache_file (str): Path to cached results. Understands s3:// syntax
+        cache (PushlogCache): Previously scanned pushes. New pushes are appended to it.
+        backfill_chunk_size (int): pushes per request when backfilling
+        session (aiohttp.ClientSession): session to share with other scans,
+            so they can all be held to one connection limit. Default: a new one.
 
     Returns:
-        Flattened structure of:
-        {
-            "pushid": {
-                "date": epoch time,
-                "changeset": most recent changeset,
-                "taskgraph": "task graph id"
-            },
-            ...
-        }
+        PushlogCache holding, per integer push ID, the push date as epoch time,
+        the most recent changeset and the task graph ID.
     """
-    pushes = dict()
-    if cache_file:
-        try:
-            log.debug('Loading pushlog cache')
-            with open_wrapper(cache_file, 'r') as f:
-                pushes = json.load(f)
-        except Exception as e:
-            log.error(e)
-
-    if pushes.get(project) and not starting_push:
-        starting_push = max(pushes[project].keys())
-        log.debug("Setting starting_push to {}".format(starting_push))
+    if cache is None:
+        cache = PushlogCache()
 
-    if project not in pushes:
-        pushes[project] = dict()
+    if await resume_backfill(pushlog_url, cache, project=project, product=product,
+                             chunk_size=backfill_chunk_size, session=session):
+        return cache
 
-    loop = asyncio.get_event_loop()
-    connector = aiohttp.TCPConnector(limit=100,
-                                     resolver=aiohttp.resolver.AsyncResolver())
-    timeout = aiohttp.ClientTimeout(total=60 * 60 * 3)
+    if not starting_push:
+        starting_push = cache.last_push
+        log.debug("Setting starting_push to {}".format(starting_push))
+
+    if backfill_count:
+        if starting_push:
+            log.info('Backfilling {} earlier pushes'.format(backfill_count))
+            first_known = cache.first_push
+            await backfill_pushlog(pushlog_url, cache,
+                                   start=first_known - backfill_count,
+                                   end=first_known - 1,
+                                   project=project,
+                                   product=product,
+                                   chunk_size=backfill_chunk_size,
+                                   session=session)
+            return cache
+        log.warning("Can't backfill until we have some pushlog data already cached, "
+                    "ignoring backfill_count on this run and polling tipmost pushes")
 
-    async with aiohttp.ClientSession(loop=loop,
-                                     connector=connector,
-                                     timeout=timeout) as session:
+    own_session = session is None
+    if own_session:
+        session = new_session()
+    try:
         url = pushlog_url.format(project=project)
-        if backfill_count:
-            if starting_push:
-                log.info('Backfilling {} earlier pushes'.format(backfill_count))
-                first_known = int(min(pushes[project].keys()))
-                url += "&startID={}&endID={}".format(first_known - backfill_count - 1,
-                                                     first_known - 1)
-            else:
-                log.warning("Can't backfill until we have some pushlog data already cached, "
-                            "ignoring backfill_count on this run and polling tipmost pushes")
-        elif starting_push:
+        if starting_push:
             url += "&startID={}".format(starting_push)
         log.debug("Querying push url %s", url)
-        response = await session.get(url)
-        new_pushes = await response.json()
-        for push in new_pushes.get('pushes', list()):
-            log.debug("Inspecting push %s", push)
-            epoch = new_pushes['pushes'][push]['date']
-            # This is the cset used for CI indexing.
-            final_cset = new_pushes['pushes'][push]['changesets'][-1]
-
-            graph_id = await find_taskgroup_by_revision(
-                revision=final_cset,
-                project=project,
-                product=product,
-            )
-            if not graph_id:
-                log.warning("Couldn't find task graph for {} revision {}".format(project,
-                                                                                 final_cset))
-                graph_id = ""
-            pushes[project][push] = {
-                "date": epoch,
-                "changeset": final_cset,
-                "taskgraph": graph_id,
-            }
-    if cache_file:
-        with open_wrapper(cache_file, 'w') as f:
-            json.dump(pushes, f, indent=4, sort_keys=True)
-    return pushes
+        async with session.get(url, timeout=SCAN_TIMEOUT) as response:
+            response.raise_for_status()
+            entries = await read_pushes(response, project, product, session=session)
+    finally:
+        if own_session:
+            await session.close()
+    cache.add_pushes(entries)
+    return cache
@@ -0,0 +1,340 @@
+"""Segmented, columnar storage for pushlog scan results.
+
+Each project's cache is a directory, local or s3://, of parquet files:
+
+    base-<first>-<last>-<written>.parquet      compacted history
+    segment-<first>-<last>-<written>.parquet   pushes appended since the last compaction
+
+The push ID range is in each file name, so finding the newest and oldest
+known pushes is a directory listing rather than a download. Files are
+sorted by push ID and written in row groups with statistics, so a range
+of pushes or of dates is read from just the row groups that can hold it,
+and reading recent pushes costs the same however long the history is.
+
+Files can overlap, for example when a backfill refetches pushes. Where
+they do, the file written last wins: the base is older than every
+segment, and segments are ordered by the time in their names. Files
+from before the time was added are taken as the oldest.
+"""
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .files import list_files, make_dirs, open_wrapper, remove_files
+
+log = logging.getLogger()
+
+PUSH_COLUMNS = ['pushid', 'date', 'changeset', 'taskgraph']
+FILE_RE = re.compile(r'^(base|segment)-(\d+)-(\d+)(?:-(\d+))?\.parquet$')
+# Merge segments into the base once there are this many of them.
+COMPACT_AFTER = 24
+ROW_GROUP_SIZE = 5000
+
+
+def empty_pushes():
+    """Return an empty push frame with the right column types."""
+    return pd.DataFrame({
+        'pushid': pd.Series([], dtype='int64'),
+        'date': pd.Series([], dtype='int64'),
+        'changeset': pd.Series([], dtype='object'),
+        'taskgraph': pd.Series([], dtype='object'),
+    }).set_index('pushid')
+
+
+def file_order(name):
+    """Sort key putting cache files in the order they were written."""
+    match = FILE_RE.match(name)
+    return (0 if match.group(1) == 'base' else 1, int(match.group(4) or 0), name)
+
+
+def row_group_overlaps(metadata, index, column, low=None, high=None):
+    """Whether a row group's statistics allow values of column in [low, high]."""
+    if column is None:
+        return True
+    row_group = metadata.row_group(index)
+    for position in range(row_group.num_columns):
+        chunk = row_group.column(position)
+        if chunk.path_in_schema != column:
+            continue
+        statistics = chunk.statistics
+        if statistics is None or not statistics.has_min_max:
+            return True
+        return not ((low is not None and statistics.max < low) or (high is not None and statistics.min > high))
+    return True
+
+
+def overlaps(first, last, low=None, high=None):
+    """Whether the inclusive ranges [first, last] and [low, high] meet."""
+    return not ((low is not None and last < low) or (high is not None and first > high))
+
+
+class PushlogCache:
+    """Pushlog entries for one project, indexed by push, task graph and date."""
+
+    def __init__(self, url=None, compact_after=COMPACT_AFTER):
+        """Open a cache directory without reading any pushes yet.
+
+        Args:
+            url (str): Directory holding the cache. Understands s3:// syntax.
+                If None, the cache only lives in memory.
+            compact_after (int): Number of segments to allow before compacting.
+        """
+        self.url = url.rstrip('/') + '/' if url else None
+        self.compact_after = compact_after
+        self._files = None
+        self._frame = None
+        self._by_graph = None
+        self._by_date = None
+        self._ranges = dict()
+        self._state = dict()
+
+    def _path(self, name):
+        return self.url + name
+
+    @property
+    def files(self):
+        """Map of cache file name to the (first, last) push IDs it holds."""
+        if self._files is None:
+            self._files = dict()
+            if self.url:
+                for name in list_files(self.url):
+                    match = FILE_RE.match(name)
+                    if match:
+                        self._files[name] = (int(match.group(2)), int(match.group(3)))
+        return self._files
+
+    @property
+    def segments(self):
+        """Names of the segment files written since the last compaction."""
+        return sorted(name for name in self.files if name.startswith('segment-'))
+
+    @property
+    def first_push(self):
+        """Oldest push ID held, or None if empty."""
+        if self._frame is not None:
+            return int(self._frame.index.min()) if len(self._frame) else None
+        return min((first for first, _ in self.files.values()), default=None)
+
+    @property
+    def last_push(self):
+        """Newest push ID held, or None if empty."""
+        if self._frame is not None:
+            return int(self._frame.index.max()) if len(self._frame) else None
+        return max((last for _, last in self.files.values()), default=None)
+
+    @property
+    def pushes(self):
+        """All pushes as a frame indexed by integer push ID, loading if needed."""
+        if self._frame is None:
+            self.load()
+        return self._frame
+
+    def load(self):
+        """Read every cache file into memory."""
+        self._set_frame(self._read())
+        return self
+
+    def _read_file(self, name, column=None, low=None, high=None):
+        """Read the row groups of one file that may hold values of column in [low, high]."""
+        with open_wrapper(self._path(name), 'rb') as f:
+            parquet = pq.ParquetFile(f)
+            wanted = [index for index in range(parquet.num_row_groups)
+                      if row_group_overlaps(parquet.metadata, index, column, low, high)]
+            log.debug('Reading %d of %d row groups of pushlog cache file %s', len(wanted), parquet.num_row_groups, name)
+            return [parquet.read_row_group(index, columns=PUSH_COLUMNS).to_pandas() for index in wanted]
+
+    def _read(self, column=None, low=None, high=None):
+        """Read the pushes with values of column in [low, high], or every push.
+
+        Returns:
+            frame indexed by push ID, the last file written winning where
+            files overlap.
+        """
+        names = self.files
+        if column == 'pushid':
+            names = [name for name in names if overlaps(*self.files[name], low, high)]
+        frames = list()
+        for name in sorted(names, key=file_order):
+            frames.extend(self._read_file(name, column, low, high))
+        if not frames:
+            return empty_pushes()
+        frame = pd.concat(frames, ignore_index=True)
+        frame['pushid'] = frame['pushid'].astype('int64')
+        frame['date'] = frame['date'].astype('int64')
+        # Row groups can hold values either side of the range as well.
+        if low is not None:
+            frame = frame[frame[column] >= low]
+        if high is not None:
+            frame = frame[frame[column] <= high]
+        return frame.drop_duplicates(subset=['pushid'], keep='last').set_index('pushid').sort_index()
+
+    def _read_range(self, column, low=None, high=None):
+        """Pushes with values of column in [low, high], from memory if everything is loaded."""
+        if self._frame is not None or not self.url:
+            frame = self.pushes.reset_index()
+            if low is not None:
+                frame = frame[frame[column] >= low]
+            if high is not None:
+                frame = frame[frame[column] <= high]
+            return frame.set_index('pushid')
+        key = (column, low, high)
+        if key not in self._ranges:
+            self._ranges[key] = self._read(column, low, high)
+        return self._ranges[key]
+
+    def _set_frame(self, frame):
+        self._frame = frame.sort_index()
+        self._by_graph = None
+        self._by_date = None
+        self._ranges = dict()
+
+    def __len__(self):
+        """Return the number of pushes held. Reads every file."""
+        return len(self.pushes)
+
+    def __contains__(self, pushid):
+        """Check whether a push ID is held."""
+        return int(pushid) in self.pushes_in(int(pushid), int(pushid)).index
+
+    def get(self, pushid):
+        """Return the cached entry for a push as a dict, or None."""
+        try:
+            row = self.pushes_in(int(pushid), int(pushid)).loc[int(pushid)]
+        except KeyError:
+            return None
+        return {'date': int(row['date']), 'changeset': row['changeset'], 'taskgraph': row['taskgraph']}
+
+    def pushes_in(self, first=None, last=None):
+        """Return pushes with IDs in the inclusive range [first, last]."""
+        return self._read_range('pushid', first, last)
+
+    def find_push_by_group(self, group_id):
+        """Find the push ID that created a task graph, or None.
+
+        Graph IDs say nothing about where a push is, so this reads every
+        file; prefer looking graphs up in a range of pushes already read.
+        """
+        if self._by_graph is None:
+            with_graph = self.pushes[self.pushes['taskgraph'] != '']
+            self._by_graph = pd.Series(with_graph.index, index=with_graph['taskgraph'])
+            self._by_graph = self._by_graph[~self._by_graph.index.duplicated(keep='last')]
+        pushid = self._by_graph.get(group_id)
+        return None if pushid is None else int(pushid)
+
+    def pushes_between(self, start=None, end=None):
+        """Return pushes whose date (epoch) is within [start, end), in date order."""
+        if start is None and end is None:
+            if self._by_date is None:
+                self._by_date = self.pushes.sort_values('date', kind='mergesort')
+            return self._by_date
+        pushes = self._read_range('date', start, None if end is None else end - 1)
+        return pushes.sort_values('date', kind='mergesort')
+
+    def missing_pushes(self, start, end):
+        """Return the push IDs in the inclusive range [start, end] not yet held."""
+        held = self.pushes_in(start, end).index
+        wanted = pd.RangeIndex(start, end + 1)
+        return wanted[~wanted.isin(held)].tolist()
+
+    def read_state(self, name):
+        """Read a small JSON state object kept alongside the cache, or None."""
+        if self.url:
+            try:
+                with open_wrapper(self._path(name + '.json'), 'r') as f:
+                    return json.load(f)
+            except (FileNotFoundError, ValueError):
+                return None
+        return self._state.get(name)
+
+    def write_state(self, name, state):
+        """Write, or with state=None remove, a JSON state object."""
+        if self.url:
+            if state is None:
+                remove_files([self._path(name + '.json')])
+                return
+            make_dirs(self.url)
+            with open_wrapper(self._path(name + '.json'), 'w') as f:
+                json.dump(state, f)
+        else:
+            self._state[name] = state
+
+    def add_pushes(self, entries):
+        """Append new pushes and write them out as a single segment.
+
+        Args:
+            entries (list): dicts with pushid, date, changeset and taskgraph keys.
+        """
+        if not entries:
+            return
+        new = pd.DataFrame(entries, columns=PUSH_COLUMNS)
+        new['pushid'] = new['pushid'].astype('int64')
+        new['date'] = new['date'].astype('int64')
+        new['taskgraph'] = new['taskgraph'].fillna('')
+        new = new.drop_duplicates(subset=['pushid'], keep='last')
+
+        first, last = int(new['pushid'].min()), int(new['pushid'].max())
+        if self.url:
+            name = self._file_name('segment', first, last)
+            make_dirs(self.url)
+            log.debug('Writing pushlog cache segment %s', name)
+            self._write_file(name, new)
+            self.files[name] = (first, last)
+        self._ranges = dict()
+
+        if self._frame is not None or not self.url:
+            current = self._frame if self._frame is not None else empty_pushes()
+            new = new.set_index('pushid')
+            current = current[~current.index.isin(new.index)]
+            self._set_frame(pd.concat([current, new]))
+
+        if len(self.segments) > self.compact_after:
+            self.compact()
+
+    def compact(self):
+        """Merge the base and all segments into a new base file."""
+        if not self.url:
+            return
+        old_files = list(self.files)
+        frame = self.pushes
+        if frame.empty:
+            return
+        first, last = int(frame.index.min()), int(frame.index.max())
+        name = self._file_name('base', first, last)
+        log.info('Compacting %d pushlog cache files into %s', len(old_files), name)
+        self._write_file(name, frame.reset_index())
+        remove_files([self._path(f) for f in old_files if f != name])
+        self._files = {name: (first, last)}
+
+    @staticmethod
+    def _file_name(kind, first, last):
+        """Name for a new cache file, sorting after every file already written."""
+        written = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+        return '{}-{:010d}-{:010d}-{}.parquet'.format(kind, first, last, written)
+
+    def _write_file(self, name, frame):
+        """Write pushes sorted by ID, in row groups whose statistics let readers skip them."""
+        table = pa.Table.from_pandas(frame.sort_values('pushid')[PUSH_COLUMNS], preserve_index=False)
+        with open_wrapper(self._path(name), 'wb') as f:
+            pq.write_table(table, f, compression='gzip', row_group_size=ROW_GROUP_SIZE)
+
+    def import_legacy_json(self, filename, project):
+        """Seed an empty cache from the older whole-file JSON cache format."""
+        try:
+            with open_wrapper(filename, 'r') as f:
+                legacy = json.load(f).get(project, dict())
+        except Exception as e:
+            log.warning("Couldn't import legacy pushlog cache %s: %s", filename, e)
+            return
+        log.info('Importing %d pushes from %s', len(legacy), os.path.basename(filename))
+        self.add_pushes([
+            {'pushid': int(pushid), 'date': entry['date'],
+             'changeset': entry['changeset'], 'taskgraph': entry['taskgraph']}
+            for pushid, entry in legacy.items()
+        ])
+        self.compact()
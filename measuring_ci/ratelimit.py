@@ -0,0 +1,232 @@
+"""Keep Taskcluster API calls within a shared budget.
+
+Every Taskcluster client made through taskcluster_client() takes a token
+from a token bucket before each API call; requests made from a client's
+buildUrl, such as artifact downloads, take one with take_token(client). The bucket refills at a steady
+rate up to a burst size, so callers proceed at full speed until they use
+up the burst and are then spaced out, rather than all being answered
+with 429s and retrying at once.
+
+The bucket can be shared between analyzers through a backend:
+
+    local               within this process only
+    file:///path        a small state file, locked with fcntl, for processes on one machine
+    sqlite:///path      a SQLite database, for processes on one machine
+
+Set up through the environment, so that analyzers started by any of the
+executors pick it up:
+
+    TASKCLUSTER_RATE_LIMIT          tokens per second; unset or 0 for no limit
+    TASKCLUSTER_RATE_LIMIT_BURST    bucket size. Default: one second's worth
+    TASKCLUSTER_RATE_LIMIT_BACKEND  one of the above. Default: local
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import taskcluster.aio
+
+from .utils import tc_options
+
+log = logging.getLogger()
+
+# One bucket per process for each backend, made on first use.
+_buckets = dict()
+
+
+def take_tokens(tokens, updated, now, rate, burst, count=1):
+    """Refill a bucket and reserve tokens from it.
+
+    Reserving may leave the bucket in debt; the caller then waits until
+    the debt would have been paid off. That keeps waiting callers in the
+    order they asked, without each one polling.
+
+    Returns:
+        (tokens, updated, wait): the bucket's new state, and how many
+        seconds the caller must wait before making its call.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate) - count
+    wait = -tokens / rate if tokens < 0 else 0.0
+    return tokens, now, wait
+
+
+class TokenBucket:
+    """Base class for token buckets. Subclasses keep the state somewhere."""
+
+    # Whether reserve() can block, waiting on other processes, so must be
+    # kept off the event loop.
+    blocking = True
+
+    def __init__(self, rate, burst=None):
+        """Refill at rate tokens per second, holding at most burst tokens."""
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+
+    def reserve(self, count=1):
+        """Reserve tokens, returning how long to wait before using them."""
+        raise NotImplementedError
+
+    async def acquire(self, count=1):
+        """Wait until count tokens are available."""
+        if self.blocking:
+            wait = await asyncio.get_event_loop().run_in_executor(None, self.reserve, count)
+        else:
+            wait = self.reserve(count)
+        if wait > 0:
+            log.debug("Rate limited, waiting %.2fs", wait)
+            await asyncio.sleep(wait)
+
+
+class LocalTokenBucket(TokenBucket):
+    """Token bucket shared by everything in this process."""
+
+    blocking = False
+
+    def __init__(self, rate, burst=None):
+        """Start with a full bucket."""
+        super().__init__(rate, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, count=1):
+        """Reserve tokens, returning how long to wait before using them."""
+        self.tokens, self.updated, wait = take_tokens(
+            self.tokens, self.updated, time.monotonic(), self.rate, self.burst, count,
+        )
+        return wait
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket kept in a file, shared by processes on one machine."""
+
+    def __init__(self, path, rate, burst=None):
+        """Use the state file at path, creating it when first reserving."""
+        super().__init__(rate, burst)
+        self.path = path
+
+    def reserve(self, count=1):
+        """Reserve tokens under an exclusive lock on the state file."""
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {'tokens': self.burst, 'updated': time.time()}
+                tokens, updated, wait = take_tokens(
+                    state['tokens'], state['updated'], time.time(), self.rate, self.burst, count,
+                )
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({'tokens': tokens, 'updated': updated}))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """Token bucket kept in a SQLite database, shared by processes on one machine."""
+
+    def __init__(self, path, rate, burst=None):
+        """Open, creating if needed, the database at path."""
+        super().__init__(rate, burst)
+        # Reserved from executor threads, one at a time.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY, tokens REAL, updated REAL)')
+
+    def reserve(self, count=1):
+        """Reserve tokens inside a write transaction."""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = self.db.execute('SELECT tokens, updated FROM bucket WHERE id = 0').fetchone()
+                if row is None:
+                    row = (self.burst, now)
+                tokens, updated, wait = take_tokens(row[0], row[1], now, self.rate, self.burst, count)
+                self.db.execute('INSERT OR REPLACE INTO bucket (id, tokens, updated) VALUES (0, ?, ?)', (tokens, updated))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return wait
+
+
+def open_token_bucket(backend, rate, burst=None):
+    """Open a token bucket from a backend such as 'local', 'file:///path' or 'sqlite:///path'."""
+    if backend in (None, '', 'local'):
+        return LocalTokenBucket(rate, burst)
+    if backend.startswith('file://'):
+        return FileTokenBucket(backend[len('file://'):], rate, burst)
+    if backend.startswith('sqlite://'):
+        return SQLiteTokenBucket(backend[len('sqlite://'):], rate, burst)
+    raise ValueError("Unknown rate limit backend {}".format(backend))
+
+
+def default_bucket():
+    """The token bucket configured by the environment, or None for no limit."""
+    rate = float(os.environ.get('TASKCLUSTER_RATE_LIMIT') or 0)
+    if rate <= 0:
+        return None
+    burst = os.environ.get('TASKCLUSTER_RATE_LIMIT_BURST')
+    backend = os.environ.get('TASKCLUSTER_RATE_LIMIT_BACKEND', 'local')
+    key = (backend, rate, burst)
+    if key not in _buckets:
+        _buckets[key] = open_token_bucket(backend, rate, float(burst) if burst else None)
+    return _buckets[key]
+
+
+class RateLimitedClient:
+    """Wrap a taskcluster.aio client so that each API call first takes a token."""
+
+    def __init__(self, client, bucket):
+        """Wrap client, taking tokens from bucket."""
+        self._client = client
+        self._bucket = bucket
+
+    async def take_token(self):
+        """Wait for a token."""
+        await self._bucket.acquire()
+
+    def __getattr__(self, name):
+        """Pass attributes through, rate limiting API calls."""
+        attr = getattr(self._client, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            await self.take_token()
+            return await attr(*args, **kwargs)
+        return call
+
+
+async def take_token(client):
+    """Wait for a token before a request to one of client's URLs that doesn't go through its API methods.
+
+    Clients made without a rate limit go ahead at once.
+    """
+    if isinstance(client, RateLimitedClient):
+        await client.take_token()
+
+
+def taskcluster_client(service, session=None, bucket=None):
+    """Make a taskcluster.aio client, such as 'Queue' or 'Index', within the rate limit.
+
+    Args:
+        service (str): name of the client class in taskcluster.aio
+        session (aiohttp.ClientSession): session to share
+        bucket (TokenBucket): bucket to take tokens from. Default: default_bucket()
+    """
+    client = getattr(taskcluster.aio, service)(options=tc_options(), session=session)
+    bucket = bucket or default_bucket()
+    if bucket is None:
+        return client
+    return RateLimitedClient(client, bucket)
@@ -6,9 +6,15 @@ https://github.com/mozilla-releng/releasewarrior-data
 Lots of assumptions here about the directory structure inside releasewarrior-data.
 """
 import json
+import logging
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
-from github import Github
+log = logging.getLogger()
+
+RELEASEWARRIOR_URL = 'https://github.com/mozilla-releng/releasewarrior-data.git'
 
 
 def fetch_release_data(file_contents):
@@ -69,7 +75,12 @@ def read_release_taskgraph_ids(repository='mozilla-releng/releasewarrior-data',
     Args:
         repository (str): organisation/repo of releasewarrior-data repository.
         since (str|datetime): How much of the git history to examine. Default: all.
+
+    Needs PyGithub, which isn't deployed with the scanners; they read a
+    clone with read_release_taskgraph_ids_from_clone instead.
     """
+    from github import Github
+
     since = datetime.now() - timedelta(days=6)
 
     if token:
@@ -94,3 +105,128 @@ def read_release_taskgraph_ids(repository='mozilla-releng/releasewarrior-data',
             repo.get_file_contents(path).decoded_content,
         ))
     return graphs
+
+
+def git(path, *args, stdin=None):
+    """Run a git command in a repository, returning its output as bytes."""
+    return subprocess.run(
+        ['git', '-C', path] + list(args),
+        input=stdin,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
+def update_clone(path, url=RELEASEWARRIOR_URL, branch='master'):
+    """Clone or fetch releasewarrior-data, returning the newest commit on branch."""
+    if os.path.isdir(os.path.join(path, '.git')):
+        git(path, 'fetch', '--quiet', 'origin', branch)
+    else:
+        subprocess.run(['git', 'clone', '--quiet', '--no-checkout', url, path], check=True)
+    return git(path, 'rev-parse', 'origin/{}'.format(branch)).decode().strip()
+
+
+def has_commit(path, commit):
+    """Whether a clone has a commit."""
+    try:
+        git(path, 'cat-file', '-e', '{}^{{commit}}'.format(commit))
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def changed_archive_paths(path, head, since_commit=None, since=None):
+    """List archive/*.json files added or changed up to head.
+
+    Args:
+        path (str): local clone
+        head (str): newest commit to consider
+        since_commit (str): only consider commits after this one
+        since (str): if there is no since_commit, a git --since value such as '6 days ago'.
+            If neither is given, every archived file is listed.
+    """
+    if since_commit:
+        output = git(path, 'log', '--name-only', '--format=', '--diff-filter=AMR',
+                     '{}..{}'.format(since_commit, head), '--', 'archive/')
+    elif since:
+        output = git(path, 'log', '--name-only', '--format=', '--diff-filter=AMR',
+                     '--since={}'.format(since), head, '--', 'archive/')
+    else:
+        output = git(path, 'ls-tree', '-r', '--name-only', head, '--', 'archive/')
+    # archive/ guarantees completed taskgraphs.
+    return sorted({p for p in output.decode().splitlines() if p.endswith('.json')})
+
+
+def read_blobs(path, head, filenames):
+    """Read several files as they are at head with one git process."""
+    if not filenames:
+        return dict()
+    batch = ''.join('{}:{}\n'.format(head, f) for f in filenames).encode()
+    output = git(path, 'cat-file', '--batch', stdin=batch)
+    contents = dict()
+    pos = 0
+    for filename in filenames:
+        header_end = output.index(b'\n', pos)
+        header = output[pos:header_end].split()
+        pos = header_end + 1
+        if header[-1] == b'missing':
+            continue
+        size = int(header[2])
+        contents[filename] = output[pos:pos + size]
+        pos += size + 1
+    return contents
+
+
+def parse_release_file(item):
+    """Parse one (path, contents) pair, returning no graphs if the format is unknown."""
+    filename, contents = item
+    try:
+        return fetch_release_data(contents)
+    except (NotImplementedError, KeyError, ValueError) as e:
+        log.warning("Couldn't read release data from %s: %s", filename, e)
+        return dict()
+
+
+def read_release_taskgraph_ids_from_clone(path, url=RELEASEWARRIOR_URL, branch='master',
+                                          since_commit=None, since=None, max_workers=None):
+    """Find release graphs from a local clone of releasewarrior-data.
+
+    Only files changed since since_commit are read, falling back to the
+    `since` period when there isn't one. No GitHub API calls are made.
+
+    Args:
+        path (str): local clone, created if it doesn't exist
+        url (str): repository to clone
+        branch (str): branch to follow
+        since_commit (str): newest commit already processed, as returned
+            by the previous run. The clone may be thrown away between runs,
+            so callers keep it with their other state.
+        since (str): git --since value used when nothing has been processed yet
+        max_workers (int): processes used to parse files. 0 parses in-process,
+            for environments such as Lambda without multiprocessing support.
+
+    Returns:
+        (graphs, head) where head should be saved as the next since_commit
+        once the graphs have been dealt with.
+    """
+    head = update_clone(path, url=url, branch=branch)
+    if since_commit == head:
+        return dict(), head
+    if since_commit and not has_commit(path, since_commit):
+        log.warning("Processed releasewarrior commit %s is no longer in the history, reading since %s",
+                    since_commit, since)
+        since_commit = None
+
+    paths = changed_archive_paths(path, head, since_commit=since_commit, since=since)
+    log.info("Reading %d changed releasewarrior files", len(paths))
+    contents = read_blobs(path, head, paths)
+
+    graphs = dict()
+    if max_workers == 0:
+        for result in map(parse_release_file, contents.items()):
+            graphs.update(result)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for result in pool.map(parse_release_file, contents.items(), chunksize=16):
+                graphs.update(result)
+    return graphs, head
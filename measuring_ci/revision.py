@@ -2,15 +2,18 @@ import logging
 
 import taskcluster.aio
 
-from .utils import tc_options
+from .ratelimit import taskcluster_client
 
 log = logging.getLogger()
 
 
 async def find_taskgroup_by_revision(
-    revision, project, product, nightly=False,
+    revision, project, product, nightly=False, session=None,
 ):
-    """Use the index to find a task group ID from a cset revision."""
+    """Use the index to find a task group ID from a cset revision.
+
+    An aiohttp session may be given, to share its connection pool.
+    """
     if nightly:
         index = (  # collapse string
             "gecko.v2.{project}.nightly.revision."
@@ -26,8 +29,8 @@ async def find_taskgroup_by_revision(
         product=product,
     )
 
-    idx = taskcluster.aio.Index(options=tc_options())
-    queue = taskcluster.aio.Queue(options=tc_options())
+    idx = taskcluster_client('Index', session=session)
+    queue = taskcluster_client('Queue', session=session)
 
     log.debug('Looking for taskId via index {}'.format(index))
     try:
@@ -0,0 +1,191 @@
+"""Estimate costs over a long history from a stratified sample of pushes.
+
+Pushes are grouped into strata by project, ISO week and graph size, where
+size is the length of the decision task's task-graph.json: a cheap HEAD
+request that tracks how many tasks the graph has. A fixed fraction of
+each stratum is sampled, with a minimum per stratum, and only those
+graphs are analyzed.
+
+Once their costs have been collated, each week's total is estimated as
+the sum over its strata of stratum size times sample mean, with the
+usual stratified variance and a normal 95% confidence interval.
+
+A stratum none of whose sampled graphs have been analyzed yet is filled
+in from the same size bucket in other weeks: the mean cost per graph
+goes into the estimate, and the interval is widened to run from nothing
+to the largest cost per graph seen, so that it still covers the total.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import random
+from datetime import datetime
+
+import aiohttp
+import pandas as pd
+
+from .ratelimit import take_token, taskcluster_client
+from .utils import semaphore_wrapper
+
+log = logging.getLogger()
+
+# Upper bounds, in bytes of task-graph.json, of every size bucket but the last.
+SIZE_BUCKETS = [1 * 1024 * 1024, 5 * 1024 * 1024, 20 * 1024 * 1024]
+SAMPLE_FRACTION = 0.1
+# At least two per stratum, so that each has a sample variance.
+SAMPLE_MINIMUM = 2
+SIZE_CONCURRENCY = 20
+Z_95 = 1.96
+ESTIMATED_COLUMNS = ['totalcost', 'idealcost']
+STRATUM = ['project', 'week', 'size_bucket']
+
+
+async def fetch_graph_size(session, queue, group_id):
+    """Find the size of a graph's task-graph.json without downloading it, or None."""
+    url = queue.buildUrl('getLatestArtifact', group_id, 'public/task-graph.json')
+    try:
+        await take_token(queue)
+        async with session.head(url, allow_redirects=True) as response:
+            response.raise_for_status()
+            return response.content_length
+    except aiohttp.ClientError as e:
+        log.debug("Couldn't find size of %s: %s", group_id, e)
+        return None
+
+
+def size_bucket(size):
+    """Size bucket for a task-graph.json length; -1 if it is unknown."""
+    if size is None:
+        return -1
+    return bisect.bisect_right(SIZE_BUCKETS, size)
+
+
+def iso_week(epoch):
+    """ISO year and week of a push date, such as '2019-W07'."""
+    year, week, _ = datetime.utcfromtimestamp(epoch).isocalendar()
+    return '{}-W{:02d}'.format(year, week)
+
+
+async def stratify_pushes(pushes, project, session, concurrency=SIZE_CONCURRENCY):
+    """Assign each push that has a task graph to a stratum.
+
+    Args:
+        pushes (DataFrame): from PushlogCache, indexed by push ID
+        project (str): project the pushes are from
+        session (aiohttp.ClientSession): session for the size requests
+        concurrency (int): size requests in flight
+
+    Returns:
+        DataFrame with one row per graph: project, week, size_bucket,
+        groupid, pushid and date.
+    """
+    with_graph = pushes[pushes['taskgraph'] != '']
+    queue = taskcluster_client('Queue', session=session)
+    semaphore = asyncio.Semaphore(concurrency)
+    sizes = await asyncio.gather(*[
+        semaphore_wrapper(semaphore, fetch_graph_size(session, queue, group_id))
+        for group_id in with_graph['taskgraph']
+    ])
+    return pd.DataFrame({
+        'project': project,
+        'week': [iso_week(date) for date in with_graph['date']],
+        'size_bucket': [size_bucket(size) for size in sizes],
+        'groupid': with_graph['taskgraph'].values,
+        'pushid': with_graph.index.values,
+        'date': with_graph['date'].values,
+    })
+
+
+def sample_strata(strata, fraction=SAMPLE_FRACTION, minimum=SAMPLE_MINIMUM, seed=None):
+    """Draw a sample from each stratum.
+
+    Args:
+        seed (int): seed for the draw. Default: a random one, which is
+            recorded in the plan so the draw can be repeated.
+
+    Returns:
+        DataFrame of the sampled rows, with population, the number of
+        graphs in the stratum, sampled, the number drawn from it, and the
+        seed used.
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+    samples = list()
+    for _, group in strata.groupby(STRATUM):
+        count = min(len(group), max(minimum, int(math.ceil(fraction * len(group)))))
+        sample = group.sample(n=count, random_state=seed)
+        sample = sample.assign(population=len(group), sampled=count)
+        samples.append(sample)
+    if not samples:
+        return strata.assign(population=0, sampled=0, seed=seed)
+    return pd.concat(samples, ignore_index=True).assign(seed=seed)
+
+
+def estimate_totals(plan, costs):
+    """Estimate per-week totals from a sample plan and the sampled graphs' costs.
+
+    Strata none of whose graphs have been analyzed yet are counted in
+    missing_strata and missing_population, and filled in from their size
+    bucket's other weeks, widening the interval to cover them. If their
+    bucket has nothing analyzed in any week, the upper bounds are NaN.
+
+    Args:
+        plan (DataFrame): from sample_strata
+        costs (DataFrame): cost output with groupid and the estimated columns
+
+    Returns:
+        DataFrame with one row per project and week: for each estimated
+        column its estimate and the bounds of a 95% confidence interval,
+        plus the graphs in the population and the sampled graphs analyzed.
+    """
+    analyzed = plan.merge(costs[['groupid'] + ESTIMATED_COLUMNS].drop_duplicates(subset=['groupid'], keep='last'),
+                          on='groupid', how='inner')
+    # Cost per graph of each size bucket over every week, for missing strata.
+    per_graph = analyzed.groupby(['project', 'size_bucket'])[ESTIMATED_COLUMNS].agg(['mean', 'max'])
+
+    rows = list()
+    for (project, week), week_plan in plan.groupby(['project', 'week']):
+        row = {
+            'project': project,
+            'week': week,
+            'population': int(week_plan.drop_duplicates(subset=['size_bucket'])['population'].sum()),
+            'analyzed': 0,
+            'missing_strata': 0,
+            'missing_population': 0,
+        }
+        # Per column: estimate, variance, and what missing strata add to
+        # the estimate and the upper bound.
+        estimates = {column: [0.0, 0.0, 0.0, 0.0] for column in ESTIMATED_COLUMNS}
+        week_analyzed = analyzed[(analyzed['project'] == project) & (analyzed['week'] == week)]
+        for bucket in week_plan['size_bucket'].unique():
+            stratum = week_analyzed[week_analyzed['size_bucket'] == bucket]
+            if not len(stratum):
+                population = week_plan[week_plan['size_bucket'] == bucket]['population'].iloc[0]
+                row['missing_strata'] += 1
+                row['missing_population'] += int(population)
+                for column in ESTIMATED_COLUMNS:
+                    if (project, bucket) in per_graph.index:
+                        estimates[column][2] += population * per_graph.loc[(project, bucket), (column, 'mean')]
+                        estimates[column][3] += population * per_graph.loc[(project, bucket), (column, 'max')]
+                    else:
+                        estimates[column][3] = float('nan')
+                continue
+            population = stratum['population'].iloc[0]
+            count = len(stratum)
+            row['analyzed'] += count
+            for column in ESTIMATED_COLUMNS:
+                values = stratum[column].astype(float)
+                variance = values.var(ddof=1) if count > 1 else 0.0
+                estimates[column][0] += population * values.mean()
+                estimates[column][1] += population ** 2 * (1 - count / population) * variance / count
+        for column, (total, variance, missing, missing_high) in estimates.items():
+            margin = Z_95 * math.sqrt(variance)
+            row[column] = total + missing
+            row[column + '_low'] = max(0.0, total - margin)
+            row[column + '_high'] = total + margin + missing_high
+        if row['missing_strata']:
+            log.warning("%s %s: %d of %d graphs are in strata with nothing analyzed yet",
+                        project, week, row['missing_population'], row['population'])
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -1,20 +1,51 @@
 """Utilities for reading release graph data from ShipIt."""
+import asyncio
+import json
+import logging
+
+import aiohttp
+import dateutil.parser
 import requests
 
+from .files import open_wrapper
+
+log = logging.getLogger()
+
+SHIPIT_API_URL = 'https://shipit-api.mozilla-releng.net/releases'
+RELEASE_PROJECTS = [
+    'releases/mozilla-release',
+    'releases/mozilla-esr60',
+    'releases/mozilla-beta',
+]
+
+
+def release_graphs(release):
+    """Return the task graphs created by each phase of a release."""
+    graphs = dict()
+    for phase in release['phases']:
+        # The action task id will be the graphid of the task graph it creates.
+        graphs[phase['actionTaskId']] = {
+            'build_number': release['build_number'],
+            'version': release['version'],
+            'product': release['product'],
+            'phase': phase['name'].split('_')[0],  # ship_fennec -> ship
+        }
+    return graphs
 
-def fetch_shipit_taskgraph_ids(api_url='https://shipit-api.mozilla-releng.net/releases'):
+
+def release_timestamp(release):
+    """When a release was shipped, falling back to when it was created."""
+    timestamp = release.get('completed') or release.get('created')
+    return dateutil.parser.parse(timestamp) if timestamp else None
+
+
+def fetch_shipit_taskgraph_ids(api_url=SHIPIT_API_URL):
     """Find release taskgraph IDs from ShipIt.
 
     https://shipit-api.mozilla-releng.net/releases?branch=releases%2Fmozilla-release&status=shipped
     """
-
-    release_projects = [
-        'releases/mozilla-release',
-        'releases/mozilla-esr60',
-        'releases/mozilla-beta',
-    ]
     graphs = dict()
-    for project in release_projects:
+    for project in RELEASE_PROJECTS:
         query = {
             'status': 'shipped',
             'branch': project,
@@ -22,14 +53,74 @@ def fetch_shipit_taskgraph_ids(api_url='https://shipit-api.mozilla-releng.net/re
         response = requests.get(api_url, params=query)
         response.raise_for_status()
         for release in response.json():
-
-            for phase in release['phases']:
-                # The action task id will be the graphid of the task graph it creates.
-                graphs[phase['actionTaskId']] = {
-                    'build_number': release['build_number'],
-                    'version': release['version'],
-                    'product': release['product'],
-                    'phase': phase['name'].split('_')[0],  # ship_fennec -> ship
-                }
+            graphs.update(release_graphs(release))
 
     return graphs
+
+
+async def fetch_branch_releases(session, api_url, branch):
+    """Fetch the shipped releases for one branch."""
+    query = {
+        'status': 'shipped',
+        'branch': branch,
+    }
+    async with session.get(api_url, params=query) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def fetch_new_shipit_taskgraph_ids(api_url=SHIPIT_API_URL, high_water_marks=None):
+    """Find taskgraph IDs for releases shipped since the last run.
+
+    All branches are queried concurrently.
+
+    Args:
+        api_url (str): ShipIt releases endpoint.
+        high_water_marks (dict): branch to ISO timestamp of the newest release
+            already processed. Older releases are skipped. Default: none skipped.
+
+    Returns:
+        (graphs, high_water_marks), with the marks moved on to the newest
+        release seen on each branch.
+    """
+    high_water_marks = dict(high_water_marks or dict())
+
+    async with aiohttp.ClientSession() as session:
+        responses = await asyncio.gather(*[
+            fetch_branch_releases(session, api_url, branch) for branch in RELEASE_PROJECTS
+        ])
+
+    graphs = dict()
+    for branch, releases in zip(RELEASE_PROJECTS, responses):
+        mark = high_water_marks.get(branch)
+        mark = dateutil.parser.parse(mark) if mark else None
+        newest = mark
+        count = 0
+        for release in releases:
+            shipped = release_timestamp(release)
+            if mark and shipped and shipped <= mark:
+                continue
+            count += 1
+            graphs.update(release_graphs(release))
+            if shipped and (newest is None or shipped > newest):
+                newest = shipped
+        log.info("%d new releases on %s", count, branch)
+        if newest:
+            high_water_marks[branch] = newest.isoformat()
+
+    return graphs, high_water_marks
+
+
+def read_high_water_marks(filename):
+    """Load the per-branch high-water marks, or an empty set if there are none yet."""
+    try:
+        with open_wrapper(filename, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        log.info("No ShipIt high-water marks in %s (%s), fetching all releases", filename, e)
+        return dict()
+
+
+def write_high_water_marks(filename, high_water_marks):
+    with open_wrapper(filename, 'w') as f:
+        json.dump(high_water_marks, f, indent=4, sort_keys=True)
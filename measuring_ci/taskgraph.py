@@ -0,0 +1,172 @@
+"""TaskGraph loading, with the Taskcluster calls going through our own clients.
+
+When several analyzers want the same graph and it isn't cached yet, only
+one of them lists the task group. The first takes a lease by creating
+{groupid}.lease next to the cache file; the others wait for the cached
+{groupid}.json to appear, or for the lease to expire if its holder died.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+import aiohttp
+
+from taskhuddler.aio.graph import TaskGraph as HuddlerTaskGraph
+
+from .files import create_exclusive, make_dirs, open_wrapper, remove_files
+from .ratelimit import taskcluster_client
+
+log = logging.getLogger()
+
+# Long enough to list the largest graphs, short enough not to stall everyone if the holder dies.
+LEASE_TIMEOUT = 10 * 60
+LEASE_POLL_INTERVAL = 5
+
+
+def lease_path(cache_file):
+    """Where the lease for populating a cache file lives."""
+    return os.path.splitext(cache_file)[0] + '.lease'
+
+
+def read_lease(path):
+    """Read a lease, or None if there isn't a readable one."""
+    try:
+        with open_wrapper(path, 'r') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def take_lease(path, timeout=LEASE_TIMEOUT):
+    """Try to take the lease at path, breaking it if it has expired.
+
+    Returns:
+        our lease token, or None if someone else holds the lease.
+    """
+    make_dirs(os.path.dirname(path))
+    token = uuid.uuid4().hex
+    content = json.dumps({'owner': token, 'expires': time.time() + timeout})
+    if not create_exclusive(path, content):
+        lease = read_lease(path)
+        if lease is not None and lease.get('expires', 0) > time.time():
+            return None
+        # Two waiters breaking the same expired lease may both end up
+        # fetching; that costs a request, but nothing is lost.
+        log.info("Breaking expired lease %s", path)
+        remove_files([path])
+        if not create_exclusive(path, content):
+            return None
+    # Read back, as creating on s3 isn't atomic.
+    lease = read_lease(path)
+    if lease is None or lease.get('owner') != token:
+        return None
+    return token
+
+
+def release_lease(path, token):
+    """Give up a lease, if we still hold it."""
+    lease = read_lease(path)
+    if lease is not None and lease.get('owner') == token:
+        remove_files([path])
+
+
+def read_cache(cache_file):
+    """Read cached task definitions and statuses.
+
+    Returns:
+        list of tasks, which is empty for a cached empty group, or None
+        if nothing readable is cached.
+    """
+    try:
+        with open_wrapper(cache_file, 'r') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError) as e:
+        log.debug(e)
+        return None
+
+
+def write_cache(cache_file, tasks):
+    """Write task definitions and statuses to the cache."""
+    make_dirs(os.path.dirname(cache_file))
+    with open_wrapper(cache_file, 'w') as f:
+        f.write(json.dumps(tasks))
+
+
+class TaskGraph(HuddlerTaskGraph):
+    """taskhuddler's TaskGraph, listing each task group once and within the rate limit.
+
+    The cache is read and written with open_wrapper, so TC_CACHE_DIR may be on s3.
+    """
+
+    async def __init__(self, groupid, limit=None, session=None):
+        """Load a task group, listing it with session if given, else with a session of its own."""
+        self.session = session
+        await super().__init__(groupid, limit=limit)
+
+    async def _read_file_cache(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, read_cache, self.cache_file)
+
+    async def _write_file_cache(self):
+        # The cache was written before the lease was released, or is where
+        # the tasks came from.
+        if getattr(self, '_cache_written', False):
+            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, write_cache, self.cache_file, self.tasks(raw=True))
+
+    async def _fetch_tasks_from_queue(self, limit=None):
+        if not self.cache_file or limit:
+            return await self._list_task_group(limit)
+
+        loop = asyncio.get_event_loop()
+        lease = lease_path(self.cache_file)
+        while True:
+            tasks = await self._read_file_cache()
+            if tasks is not None:
+                log.debug("Task group %s was cached by another loader", self.groupid)
+                self._cache_written = True
+                return tasks
+
+            token = await loop.run_in_executor(None, take_lease, lease)
+            if token is not None:
+                break
+            log.debug("Waiting for another loader to cache %s", self.groupid)
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+
+        try:
+            tasks = await self._list_task_group()
+            await loop.run_in_executor(None, write_cache, self.cache_file, tasks)
+            self._cache_written = True
+        finally:
+            await loop.run_in_executor(None, release_lease, lease, token)
+        return tasks
+
+    async def _list_task_group(self, limit=None):
+        query = {}
+        if limit:
+            query['limit'] = min(limit, 1000)
+
+        if self.session is not None:
+            tasks = await self._list_pages(self.session, query, limit)
+        else:
+            async with aiohttp.ClientSession() as session:
+                tasks = await self._list_pages(session, query, limit)
+
+        if limit:
+            tasks = tasks[:limit]
+        return tasks
+
+    async def _list_pages(self, session, query, limit=None):
+        queue = taskcluster_client('Queue', session=session)
+        outcome = await queue.listTaskGroup(self.groupid, query=query)
+        tasks = outcome.get('tasks', [])
+
+        while (not limit or len(tasks) < limit) and outcome.get('continuationToken'):
+            query['continuationToken'] = outcome['continuationToken']
+            outcome = await queue.listTaskGroup(self.groupid, query=query)
+            tasks.extend(outcome.get('tasks', []))
+        return tasks
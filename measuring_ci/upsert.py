@@ -0,0 +1,113 @@
+"""Insert or replace cost rows by task graph ID.
+
+Rows are matched on a key column, groupid by default, and the incoming
+row always wins, including over earlier copies of itself in the same
+batch. Existing keys are looked up in a hash set rather than by
+comparing whole rows, so a graph whose costs have changed replaces its
+old row instead of sitting alongside it.
+
+For a partitioned dataset only the partitions the incoming rows fall in
+are looked at, and of those only the ones already holding one of the
+keys are rewritten; the rest just gain a new file.
+"""
+import logging
+
+import pandas as pd
+
+from .dataset import PARTITION_COLUMNS, list_partitions, new_file_name, partition_frame, partition_path, read_partition, write_partition_file
+from .files import remove_files
+from .layout import write_cost_file
+from .parquet import read_parquet_files
+
+log = logging.getLogger()
+
+
+def upsert_frame(existing, incoming, key='groupid'):
+    """Combine two frames of rows, incoming rows replacing existing ones with the same key.
+
+    Returns:
+        (DataFrame, int): the combined rows, and how many existing rows
+        were replaced.
+    """
+    incoming = incoming.drop_duplicates(subset=[key], keep='last')
+    if existing is None or existing.empty:
+        return incoming.reset_index(drop=True), 0
+    replaced = existing[key].isin(set(incoming[key]))
+    combined = pd.concat([existing[~replaced], incoming], sort=False, ignore_index=True)
+    return combined, int(replaced.sum())
+
+
+def upsert_file(filename, incoming, key='groupid', layout=None):
+    """Upsert rows into a single parquet file, creating it if needed.
+
+    A parquet file can't be changed in place, so the whole file is
+    rewritten. Column types are left as they are, as tables over the
+    single-file outputs expect them.
+
+    Returns:
+        the upserted rows, now in the file.
+    """
+    try:
+        existing = pd.read_parquet(filename)
+    except Exception as e:
+        log.info("Couldn't load %s, starting a new one (%s)", filename, e)
+        existing = None
+    combined, replaced = upsert_frame(existing, incoming, key=key)
+    log.info("Writing %d rows to %s, %d replaced", len(combined), filename, replaced)
+    write_cost_file(combined, filename, convert_types=False, **(layout or {}))
+    return combined
+
+
+def upsert_partition(dataset, values, files, rows, partition_cols=PARTITION_COLUMNS, key='groupid', layout=None):
+    """Upsert rows into one partition of a dataset.
+
+    Only the key column of the partition's files is read at first. If
+    none of the rows' keys are already there, they are appended as a new
+    file; otherwise the partition is rewritten, removing only the files
+    that were read, as compaction does.
+
+    Returns:
+        number of existing rows replaced.
+    """
+    if files:
+        keys = read_parquet_files(files, columns=[key])
+        existing_keys = set(keys[key]) if keys is not None else set()
+    else:
+        existing_keys = set()
+
+    if not existing_keys.intersection(rows[key]):
+        filename = new_file_name(partition_path(dataset, partition_cols, values))
+        write_partition_file(filename, rows, partition_cols, layout=layout)
+        return 0
+
+    existing = read_partition(files, values, partition_cols, dedupe_on=key)
+    combined, replaced = upsert_frame(existing, rows, key=key)
+    # A name of its own, so concurrent rewrites can't overwrite each other.
+    filename = new_file_name(partition_path(dataset, partition_cols, values))
+    write_partition_file(filename, combined, partition_cols, layout=layout)
+    remove_files(files)
+    log.info("Rewrote %s, replacing %d rows", partition_path(dataset, partition_cols, values), replaced)
+    return replaced
+
+
+def upsert_dataset(dataset, incoming, partition_cols=PARTITION_COLUMNS, key='groupid', layout=None):
+    """Upsert rows into a partitioned dataset.
+
+    Returns:
+        number of existing rows replaced.
+    """
+    if incoming is None or incoming.empty:
+        return 0
+    incoming = partition_frame(incoming.drop_duplicates(subset=[key], keep='last'), partition_cols)
+    groups = dict()
+    for values, rows in incoming.groupby(partition_cols):
+        groups[values if isinstance(values, tuple) else (values,)] = rows
+    filters = {column: sorted(set(values[i] for values in groups)) for i, column in enumerate(partition_cols)}
+    partitions = list_partitions(dataset, partition_cols, filters)
+
+    replaced = 0
+    for values, rows in groups.items():
+        replaced += upsert_partition(dataset, values, partitions.get(values, []), rows, partition_cols,
+                                     key=key, layout=layout)
+    log.info("Upserted %d rows into %d partitions of %s, %d replaced", len(incoming), len(groups), dataset, replaced)
+    return replaced
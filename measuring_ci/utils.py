@@ -13,6 +13,16 @@ def tc_options():
     }
 
 
+def rss_bytes():
+    """Resident memory of this process, from /proc; None where that isn't available."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
 async def semaphore_wrapper(semaphore, coro):
     async with semaphore:
         return await coro
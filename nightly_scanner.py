@@ -1,19 +1,24 @@
 import argparse
 import asyncio
 import copy
-import json
 import logging
 import os
 from datetime import datetime, timedelta
 
-import boto3
 import pandas as pd
 import yaml
 
+from measuring_ci.dataset import NULL_PARTITION, list_partitions, read_dataset
+from measuring_ci.dispatch import batch_size_from_config
+from measuring_ci.examined import find_examined_taskgraph_ids, months_between
+from measuring_ci.executors import EXECUTORS, get_executor
+from measuring_ci.layout import to_timestamp
 from measuring_ci.nightly import fetch_nightlies
-from measuring_ci.utils import find_staged_data_files
 
 LOG_LEVEL = logging.INFO
+# Limit how far back an automatic catch-up will go.
+MAX_SCAN_DAYS = 31
+NIGHTLY_PARTITIONS = ['product', 'month']
 
 # AWS artisinal log handling, they've already set up a handler by the time we get here
 log = logging.getLogger()
@@ -27,40 +32,84 @@ def parse_args():
     """Extract arguments."""
     parser = argparse.ArgumentParser(description="CI Costs")
     parser.add_argument('--config', type=str, default='nightlies.yml')
+    parser.add_argument('--start-date', type=str, default=None,
+                        help="First day to scan, YYYY-MM-DD. Default: the newest day already examined")
+    parser.add_argument('--end-date', type=str, default=None,
+                        help="Last day to scan, YYYY-MM-DD. Default: yesterday")
+    parser.add_argument('--executor', type=str, default='lambda', choices=sorted(EXECUTORS),
+                        help="Where to analyze task graphs")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Concurrent analyses for the inline and process-pool executors")
+    parser.add_argument('--job-queue', type=str, default=None,
+                        help="Job queue for the queue executor, e.g. sqlite:///tmp/analysis.db")
     return parser.parse_args()
 
 
-async def find_examined_taskgraph_ids(config):
-    """Find the task graph IDs we have examined already."""
+def read_newest_graph_dates(dataset, partition_cols):
+    """Read graph dates from only the newest month of a cost dataset."""
+    partitions = list_partitions(dataset, partition_cols)
+    months = [dict(zip(partition_cols, values))['month'] for values in partitions]
+    months = [month for month in months if month != NULL_PARTITION]
+    if not months:
+        return pd.DataFrame(columns=['graph_date'])
+    return read_dataset(dataset, partition_cols, filters={'month': [max(months)]}, columns=['graph_date'])
+
+
+def find_newest_examined_date(config):
+    """Find the date of the newest task graph already in the cost output."""
     try:
-        existing_costs = pd.read_parquet(config['total_cost_output'])
-        taskgraphs = existing_costs['groupid'].tolist()
+        if config.get('cost_dataset'):
+            existing_costs = read_newest_graph_dates(config['cost_dataset'],
+                                                     config.get('cost_partitions', NIGHTLY_PARTITIONS))
+        else:
+            existing_costs = pd.read_parquet(config['total_cost_output'], columns=['graph_date'])
+        # Older outputs hold dates as strings, newer ones as timestamps.
+        newest = existing_costs['graph_date'].map(to_timestamp).dropna().max()
     except Exception:
-        taskgraphs = list()
+        return None
+    if pd.isnull(newest):
+        return None
+    return datetime(newest.year, newest.month, newest.day)
+
 
-    staged_files = await find_staged_data_files(config['staging_output'])
-    staged_taskgraphs = [os.path.basename(f).replace('.parquet', '') for f in staged_files]
+def find_scan_dates(args, config):
+    """Choose the days to scan, covering any gap since the last examined graph."""
+    yesterday = datetime.now() - timedelta(days=1)
+    if args.get('end_date'):
+        end_date = datetime.strptime(args['end_date'], "%Y-%m-%d")
+    else:
+        end_date = yesterday
 
-    return taskgraphs + staged_taskgraphs
+    if args.get('start_date'):
+        return datetime.strptime(args['start_date'], "%Y-%m-%d"), end_date
+
+    earliest = end_date - timedelta(days=config.get('max_scan_days', MAX_SCAN_DAYS) - 1)
+    newest = find_newest_examined_date(config)
+    if newest is None:
+        start_date = end_date
+    else:
+        start_date = min(max(newest, earliest), end_date)
+    return start_date, end_date
 
 
 async def scan_nightlies(args, config):
     """Scan recent history for complete task graphs."""
     config = copy.deepcopy(config)
 
-    examined_taskgraph_ids = await find_examined_taskgraph_ids(config)
-
-    log.info("Looking up taskgraph IDs")
-    nightlies = await fetch_nightlies(datetime.now() - timedelta(days=1))
+    start_date, end_date = find_scan_dates(args, config)
+    examined_taskgraph_ids = await find_examined_taskgraph_ids(config, months=months_between(start_date, end_date))
+    log.info("Looking up taskgraph IDs from %s to %s",
+             start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+    nightlies = await fetch_nightlies(start_date, end_date)
     log.info("Found %d taskgraph IDs", len(nightlies))
 
-    lambda_client = boto3.client('lambda')
-
+    payloads = list()
     for graph_id in nightlies:
-        if str(graph_id) in examined_taskgraph_ids:
+        if graph_id in examined_taskgraph_ids:
             log.debug("Already examined taskgroup %s, skipping.", graph_id)
             continue
-        args.update({
+        payload = dict(args)
+        payload.update({
             'groupid': graph_id,
             'project': 'mozilla-central',
             'config': 'nightlies.yml',
@@ -78,12 +127,16 @@ async def scan_nightlies(args, config):
                 'artifact_projected_cost': None,
             },
         })
-        log.info("Invoking lambda for %s", graph_id)
-        lambda_client.invoke(
-            FunctionName='taskgraph_analyzer',
-            InvocationType='Event',
-            Payload=json.dumps(args),
-        )
+        payloads.append(payload)
+
+    executor = get_executor(args.get('executor', 'lambda'),
+                            workers=args.get('workers'),
+                            job_queue=args.get('job_queue'),
+                            batch_size=batch_size_from_config(config))
+    failures = await executor.submit(payloads)
+    if failures:
+        log.error("%d of %d graphs could not be analyzed",
+                  sum(len(groupids) for groupids, _ in failures), len(payloads))
 
 
 async def main(args):
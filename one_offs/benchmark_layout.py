@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Compare parquet codecs and layouts for a cost output.
+
+Writes the same costs once as pandas' defaults would, and once per codec
+in the layout from measuring_ci.layout, then reports for each: file size,
+time to write, time to scan a couple of columns, and how many row groups
+a one-month graph_date predicate could skip.
+
+    python one_offs/benchmark_layout.py s3://.../costs/autoland.parquet
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from measuring_ci.layout import ROW_GROUP_SIZE, costs_table, write_table
+
+CODECS = ['none', 'snappy', 'gzip', 'brotli', 'lz4', 'zstd']
+SCAN_COLUMNS = ['graph_date', 'totalcost']
+REPEATS = 3
+
+
+def parse_args():
+    """Extract arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark parquet layouts for a cost output")
+    parser.add_argument('costs', type=str, help="Local or s3:// parquet file of costs")
+    parser.add_argument('--codec', type=str, action='append', default=None,
+                        help="Codec to try; may be repeated. Default: {}".format(', '.join(CODECS)))
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument('--repeats', type=int, default=REPEATS,
+                        help="Best of this many timings is reported")
+    return parser.parse_args()
+
+
+def best_time(function, repeats):
+    """Shortest time taken by function over a few calls."""
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def skippable_row_groups(filename, month):
+    """Count the row groups whose graph_date statistics exclude a month."""
+    metadata = pq.ParquetFile(filename).metadata
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    if 'graph_date' not in names:
+        return 0, metadata.num_row_groups
+    column = names.index('graph_date')
+    start, end = month, month + pd.offsets.MonthBegin(1)
+    skipped = 0
+    for index in range(metadata.num_row_groups):
+        statistics = metadata.row_group(index).column(column).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+        low, high = pd.Timestamp(statistics.min), pd.Timestamp(statistics.max)
+        if high < start or low >= end:
+            skipped += 1
+    return skipped, metadata.num_row_groups
+
+
+def benchmark(name, write, filename, month, repeats):
+    """Time one way of writing the costs, and reading them back."""
+    write_time = best_time(write, repeats)
+    columns = [c for c in SCAN_COLUMNS if c in pq.read_schema(filename).names]
+    scan_time = best_time(lambda: pq.read_table(filename, columns=columns), repeats)
+    skipped, row_groups = skippable_row_groups(filename, month)
+    return {
+        'layout': name,
+        'size_kb': os.path.getsize(filename) / 1024,
+        'write_ms': write_time * 1000,
+        'scan_ms': scan_time * 1000,
+        'row_groups': row_groups,
+        'skippable': skipped,
+    }
+
+
+def main():
+    args = parse_args()
+    costs = pd.read_parquet(args.costs)
+    table = costs_table(costs)
+    dates = table.column('graph_date').to_pandas().dropna() if 'graph_date' in table.schema.names else []
+    month = pd.Timestamp(dates.iloc[len(dates) // 2]).to_period('M').to_timestamp() if len(dates) else pd.Timestamp.now()
+    print("{} rows; predicate is graph_date in {}".format(len(costs), month.strftime('%Y-%m')))
+
+    directory = tempfile.mkdtemp()
+    results = list()
+    try:
+        filename = os.path.join(directory, 'default.parquet')
+        results.append(benchmark('pandas gzip', lambda: costs.to_parquet(filename, compression='gzip'),
+                                 filename, month, args.repeats))
+        for codec in args.codec or CODECS:
+            filename = os.path.join(directory, '{}.parquet'.format(codec))
+            try:
+                results.append(benchmark(
+                    'layout ' + codec,
+                    lambda: write_table(table, filename, compression=codec, row_group_size=args.row_group_size),
+                    filename, month, args.repeats,
+                ))
+            except Exception as e:
+                print("Skipping {}: {}".format(codec, e))
+    finally:
+        shutil.rmtree(directory)
+
+    print(pd.DataFrame(results).set_index('layout').round(1).to_string())
+
+
+if __name__ == "__main__":
+    main()
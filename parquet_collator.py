@@ -3,10 +3,15 @@ import logging
 import sys
 import urllib.parse
 
-import boto3
-import pandas as pd
 import yaml
 
+from measuring_ci.dataset import PARTITION_COLUMNS
+from measuring_ci.examined import merge_examined
+from measuring_ci.files import remove_files_in_batches
+from measuring_ci.layout import layout_options
+from measuring_ci.manifest import read_manifest, remove_manifest_entries
+from measuring_ci.parquet import READ_WORKERS, read_parquet_files
+from measuring_ci.upsert import upsert_dataset, upsert_file
 from measuring_ci.utils import find_staged_data_files
 
 LOG_LEVEL = logging.INFO
@@ -22,26 +27,19 @@ log.setLevel(LOG_LEVEL)
 logging.getLogger("aiohttp").setLevel(logging.INFO)
 
 
-def load_parquet(filename, columns):
-    """Load existing parquet file or an empty one."""
-    try:
-        df = pd.read_parquet(filename)
-        log.info("Loaded %s", filename)
-    except Exception as exc:
-        log.info("Couldn't load %s, using empty data set (%s)", filename, exc)
-        df = pd.DataFrame(columns=columns)
-    return df
+async def find_staged_files(config):
+    """Find the staged files to collate, and their manifest entries if there is a manifest."""
+    if config.get('staging_manifest'):
+        entries = await read_manifest(config['staging_output'])
+        return [entry['file'] for entry in entries], entries
 
-
-def delete_parquet_files(url_list):
-    """Remove a series of s3 objects, which must be in the same bucket."""
-    s3_client = boto3.client('s3')
-    bucket = urllib.parse.urlparse(url_list[0]).netloc
-    delete_data = {
-        'Objects': [{'Key': urllib.parse.urlparse(p).path.lstrip('/')} for p in url_list],
-    }
-
-    s3_client.delete_objects(Bucket=bucket, Delete=delete_data)
+    staged_files = await find_staged_data_files(config['staging_output'])
+    url_parts = urllib.parse.urlparse(config['staging_output'])
+    bucket_url = '{}://{}'.format(url_parts.scheme, url_parts.netloc)
+    parquet_files = [
+        urllib.parse.urljoin(bucket_url, path) for path in staged_files if path.endswith('.parquet')
+    ]
+    return parquet_files, None
 
 
 async def collate_parquet_files(args, config):
@@ -52,43 +50,28 @@ async def collate_parquet_files(args, config):
         config['total_cost_output'] = config['total_cost_output'].format(project=short_project)
         config['staging_output'] = config['staging_output'].format(project=args['project'])
     log.info("Examining %s", config['staging_output'])
-    staged_files = await find_staged_data_files(config['staging_output'])
-    log.info("Found %d staged files", len(staged_files))
+    parquet_files, entries = await find_staged_files(config)
+    log.info("Found %d staged files", len(parquet_files))
 
-    if len(staged_files) == 0:
+    if len(parquet_files) == 0:
         log.info("Nothing to do")
         return
 
-    url_parts = urllib.parse.urlparse(config['staging_output'])
-    bucket_url = '{}://{}'.format(url_parts.scheme, url_parts.netloc)
-
-    parquet_files = [
-        urllib.parse.urljoin(bucket_url, path) for path in staged_files
-    ]
-
-    contents = [
-        pd.read_parquet(p) for p in parquet_files
-    ]
-    existing_costs = load_parquet(
-        filename=config['total_cost_output'],
-        columns=[],
-    )
-    if not existing_costs.empty:
-        contents.insert(0, existing_costs)
-    new_costs = pd.concat(contents, sort=True)
-    log.info("Dropping duplicates")
-    new_costs.drop_duplicates(subset=['groupid'], keep='last', inplace=True)
-
-    log.info("Writing parquet file %s", config['total_cost_output'])
-    new_costs.reset_index(drop=True, inplace=True)
-    new_costs.to_parquet(config['total_cost_output'], compression='gzip')
+    log.info("Reading staged files")
+    staged_costs = read_parquet_files(parquet_files, max_workers=config.get('read_workers', READ_WORKERS))
+    if config.get('cost_dataset'):
+        upsert_dataset(config['cost_dataset'], staged_costs,
+                       partition_cols=config.get('cost_partitions', PARTITION_COLUMNS),
+                       layout=layout_options(config))
+    else:
+        upsert_file(config['total_cost_output'], staged_costs, layout=layout_options(config))
+    merge_examined(config['total_cost_output'], staged_costs)
 
     log.info("Cleaning up")
-    # Chunk deletes due to parameter size in s3 call
-    chunk_size = 50
-    for chunk_index in range(len(parquet_files))[::chunk_size]:
-        chunk = parquet_files[chunk_index:chunk_index + chunk_size]
-        delete_parquet_files(chunk)
+    if entries is not None:
+        remove_manifest_entries(entries)
+    else:
+        remove_files_in_batches(parquet_files)
 
 
 async def main(args):
@@ -1,19 +1,32 @@
 import argparse
 import asyncio
 import copy
-import json
 import logging
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 
-import boto3
 import pandas as pd
 import yaml
 
-from measuring_ci.pushlog import scan_pushlog
-from measuring_ci.utils import find_staged_data_files
+from measuring_ci.completion import graph_finished
+from measuring_ci.dataset import PARTITION_COLUMNS, read_dataset
+from measuring_ci.dispatch import batch_size_from_config
+from measuring_ci.examined import find_examined_taskgraph_ids, months_between
+from measuring_ci.executors import EXECUTORS, get_executor
+from measuring_ci.pushlog import BACKFILL_CHUNK_SIZE, BACKFILLED_STATE, new_session, scan_pushlog
+from measuring_ci.pushlog_cache import PushlogCache
+from measuring_ci.sampling import SAMPLE_MINIMUM, estimate_totals, sample_strata, stratify_pushes
+from measuring_ci.utils import semaphore_wrapper
 
 LOG_LEVEL = logging.INFO
+HTTP_CONNECTION_LIMIT = 50
+COMPLETION_PROBE_CONCURRENCY = 10
+# Pushes before the checkpoint have all been analyzed or given up on; it
+# is kept alongside the pushlog cache.
+SCAN_CHECKPOINT = 'scan_checkpoint'
+# Never look further back than this for graphs to analyze.
+SCAN_WINDOW_DAYS = 14
 
 # AWS artisinal log handling, they've already set up a handler by the time we get here
 log = logging.getLogger()
@@ -29,24 +42,38 @@ def parse_args():
     parser.add_argument('--project', type=str, default='mozilla-central')
     parser.add_argument('--product', type=str, default='firefox')
     parser.add_argument('--config', type=str, default='scanner.yml')
+    parser.add_argument('--backfill-count', type=int, default=None,
+                        help="Number of pushes before the oldest cached push to fetch")
+    parser.add_argument('--backfill-chunk-size', type=int, default=None,
+                        help="Pushes per json-pushes request when backfilling")
+    parser.add_argument('--pushlog-url', type=str, default=None,
+                        help="Override the config's pushlog_url template, e.g. for a local stub")
+    parser.add_argument('--executor', type=str, default='lambda', choices=sorted(EXECUTORS),
+                        help="Where to analyze task graphs")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Concurrent analyses for the inline and process-pool executors")
+    parser.add_argument('--job-queue', type=str, default=None,
+                        help="Job queue for the queue executor, e.g. sqlite:///tmp/analysis.db")
+    parser.add_argument('--scan-window-days', type=int, default=None,
+                        help="Only look for graphs in pushes from this many days ago, default {}".format(SCAN_WINDOW_DAYS))
+    parser.add_argument('--incremental', action='store_true',
+                        help="Also analyze unfinished graphs, recording partial costs as they progress")
+    parser.add_argument('--sample-fraction', type=float, default=None,
+                        help="Only analyze this fraction of pushes, stratified by week and graph size")
+    parser.add_argument('--sample-minimum', type=int, default=None,
+                        help="Pushes to sample from each stratum at least")
+    parser.add_argument('--sample-seed', type=int, default=None)
+    parser.add_argument('--resample', action='store_true',
+                        help="Draw a new sample, replacing the saved sample plan even if its parameters match")
+    parser.add_argument('--sample-start', type=str, default=None,
+                        help="Sample pushes from this day on, YYYY-MM-DD")
+    parser.add_argument('--sample-end', type=str, default=None,
+                        help="Sample pushes before this day, YYYY-MM-DD")
+    parser.add_argument('--estimate', action='store_true',
+                        help="Estimate weekly totals from the costs of a previous sample, instead of scanning")
     return parser.parse_args()
 
 
-def probably_finished(timestamp):
-    """Guess at whether a revision's CI tasks have finished by now."""
-    timestamp = datetime.fromtimestamp(timestamp)
-    # Guess that if it's been over 24 hours then all the CI tasks
-    # have finished.
-    if datetime.now() - timestamp > timedelta(days=1):
-        return True
-    return False
-
-
-def find_push_by_group(group_id, project, pushes):
-    """Find the correct push for a task graph."""
-    return next(push for push in pushes[project] if pushes[project][push]['taskgraph'] == group_id)
-
-
 def load_parquet(filename, columns):
     """Load existing parquet file or an empty one."""
     try:
@@ -58,58 +85,229 @@ def load_parquet(filename, columns):
     return df
 
 
-async def find_examined_taskgraph_ids(config):
-    """Find the task graph IDs we have examined already."""
-    try:
-        existing_costs = pd.read_parquet(config['total_cost_output'])
-        taskgraphs = existing_costs['groupid'].tolist()
-    except Exception:
-        taskgraphs = list()
+def candidate_pushes(pushes, checkpoint=None, window_days=SCAN_WINDOW_DAYS, now=None):
+    """The pushes that might still have graphs to analyze.
+
+    Args:
+        pushes (PushlogCache): the project's pushes
+        checkpoint (int): push ID before which everything has been dealt with
+        window_days (int): ignore pushes older than this, checkpoint or not
+
+    Returns:
+        DataFrame of pushes, indexed by push ID.
+    """
+    now = now or time.time()
+    recent = pushes.pushes_between(start=int(now - window_days * 86400))
+    if checkpoint is not None:
+        recent = recent[recent.index >= checkpoint]
+    return recent
+
+
+def backfilled_pushes(pushes):
+    """The pushes in each backfilled range not yet fully analyzed.
+
+    Returns:
+        list of ([start, end], DataFrame of the range's pushes).
+    """
+    ranges = (pushes.read_state(BACKFILLED_STATE) or {}).get('ranges', [])
+    return [(push_range, pushes.pushes_in(*push_range)) for push_range in ranges]
+
+
+def remaining_backfills(backfills, pending):
+    """The backfilled ranges that still had graphs to analyze.
+
+    A range is dropped once a scan finds nothing left in it to submit;
+    until then, graphs that fail are retried by the next scan.
+    """
+    remaining = list()
+    for push_range, range_pushes in backfills:
+        if set(range_pushes['taskgraph']) & set(pending):
+            remaining.append(push_range)
+        else:
+            log.info("Every graph in backfilled pushes %d-%d has been analyzed", *push_range)
+    return remaining
+
+
+def graph_pushes(candidates):
+    """Map each task graph ID in a frame of pushes to its push ID."""
+    with_graph = candidates[candidates['taskgraph'] != '']
+    by_graph = pd.Series(with_graph.index, index=with_graph['taskgraph'])
+    return by_graph[~by_graph.index.duplicated(keep='last')]
+
+
+def next_checkpoint(candidates, pending, last_push):
+    """Push ID to start the next scan from.
+
+    Args:
+        candidates (DataFrame): the pushes scanned, indexed by push ID
+        pending (iterable): graph IDs that may need looking at again, such
+            as unfinished graphs and those just submitted
+        last_push (int): newest push scanned
+    """
+    by_graph = graph_pushes(candidates)
+    pending_pushes = [int(by_graph[graph_id]) for graph_id in pending if graph_id in by_graph.index]
+    if pending_pushes:
+        return min(pending_pushes)
+    return None if last_push is None else last_push + 1
 
-    staged_files = await find_staged_data_files(config['staging_output'])
-    staged_taskgraphs = [os.path.basename(f).replace('.parquet', '') for f in staged_files]
 
-    return taskgraphs + staged_taskgraphs
+async def fetch_taskgraphs_for_pushes(pushes, project, known_graphs, session=None):
+    """Find the unexamined task graphs for the provided pushes.
 
+    Args:
+        pushes (DataFrame): pushes indexed by push ID, as from candidate_pushes
 
-def fetch_taskgraphs_for_pushes(pushes, project, known_graphs):
-    """Return TaskGraph objects for all provided pushes."""
-    taskgraphs = list()
+    Returns:
+        tuple of lists of IDs of the finished and unfinished graphs.
+    """
+    candidates = list()
 
     count_no_graph_id = 0
-    count_not_finished = 0
-    for push in pushes[project]:
+    for entry in pushes.itertuples():
+        push = entry.Index
         log.debug("Examining push %s", push)
 
-        if probably_finished(pushes[project][push]['date']):
-            graph_id = pushes[project][push]['taskgraph']
-            if not graph_id or graph_id == '':
-                log.debug("Couldn't find graph id for %s push %s", project, push)
-                count_no_graph_id += 1
-                continue
-            if graph_id in known_graphs:
-                log.debug("Already examined push %s (%s), skipping.", push, graph_id)
-                continue
-            log.debug("Push %s, Graph ID: %s", push, graph_id)
-            taskgraphs.append(graph_id)
-        else:
-            log.debug("Push %s probably not finished, skipping", push)
-            count_not_finished += 1
-    log.info('%d pushes without a graph_id; skipping %d probably not finished yet',
-             count_no_graph_id, count_not_finished)
+        graph_id = entry.taskgraph
+        if not graph_id or graph_id == '':
+            log.debug("Couldn't find graph id for %s push %s", project, push)
+            count_no_graph_id += 1
+            continue
+        if graph_id in known_graphs:
+            log.debug("Already examined push %s (%s), skipping.", push, graph_id)
+            continue
+        log.debug("Push %s, Graph ID: %s", push, graph_id)
+        candidates.append((graph_id, entry.date))
+
+    semaphore = asyncio.Semaphore(COMPLETION_PROBE_CONCURRENCY)
+    finished = await asyncio.gather(*[
+        semaphore_wrapper(semaphore, graph_finished(graph_id, date, session=session))
+        for graph_id, date in candidates
+    ])
+    taskgraphs = [graph_id for (graph_id, _), done in zip(candidates, finished) if done]
+    unfinished = [graph_id for (graph_id, _), done in zip(candidates, finished) if not done]
+
+    log.info('%d pushes without a graph_id; %d not finished yet',
+             count_no_graph_id, len(unfinished))
+
+    return taskgraphs, unfinished
+
 
-    return taskgraphs
+def epoch_from_date(date):
+    """Epoch of a YYYY-MM-DD date, or None."""
+    if not date:
+        return None
+    return int(datetime.strptime(date, "%Y-%m-%d").timestamp())
 
 
-async def scan_project(project, args, config):
-    """Scan a project's recent history for complete task graphs."""
+def load_sample_plan(filename):
+    """Load a saved sample plan, or None if there isn't one."""
+    try:
+        return pd.read_parquet(filename)
+    except Exception as exc:
+        log.info("No sample plan at %s (%s)", filename, exc)
+        return None
+
+
+def sample_parameters(args):
+    """The parameters a sample plan is drawn with, as recorded in its columns."""
+    return {
+        'fraction': float(args['sample_fraction']),
+        'minimum': int(args.get('sample_minimum') or SAMPLE_MINIMUM),
+        'sample_start': args.get('sample_start') or '',
+        'sample_end': args.get('sample_end') or '',
+    }
+
+
+def plan_matches(plan, args):
+    """Whether a saved sample plan was drawn with the parameters in args.
+
+    Without --sample-seed any seed will do, since the saved plan's own
+    seed is the one to repeat.
+    """
+    if not len(plan):
+        return False
+    wanted = sample_parameters(args)
+    if args.get('sample_seed') is not None:
+        wanted['seed'] = args['sample_seed']
+    for column, value in wanted.items():
+        if column not in plan.columns or plan[column].iloc[0] != value:
+            log.info("Saved sample plan has %s %s, not %s", column,
+                     plan[column].iloc[0] if column in plan.columns else None, value)
+            return False
+    return True
+
+
+async def sample_taskgraphs(pushes, project, args, config, session=None):
+    """Choose a stratified sample of a project's graphs, and save the plan.
+
+    A saved plan is reused, so that every run works through the same
+    sample, unless it was drawn with different parameters or
+    args['resample'] is set.
+
+    Returns:
+        set of sampled task graph IDs.
+    """
+    plan = None if args.get('resample') else load_sample_plan(config['sample_plan_output'])
+    if plan is not None and plan_matches(plan, args):
+        log.info("Reusing the sample plan of %d graphs for %s, seed %s", len(plan), project, plan['seed'].iloc[0])
+        return set(plan['groupid'])
+
+    parameters = sample_parameters(args)
+    population = pushes.pushes_between(epoch_from_date(parameters['sample_start']), epoch_from_date(parameters['sample_end']))
+    strata = await stratify_pushes(population, project.split('/')[-1], session)
+    plan = sample_strata(strata, fraction=parameters['fraction'], minimum=parameters['minimum'], seed=args.get('sample_seed'))
+    log.info("Sampled %d of %d graphs in %d strata for %s, seed %s",
+             len(plan), len(strata), len(plan.drop_duplicates(subset=['week', 'size_bucket'])), project,
+             plan['seed'].iloc[0] if len(plan) else None)
+    plan = plan.assign(**parameters)
+    plan.to_parquet(config['sample_plan_output'], compression='gzip')
+    return set(plan['groupid'])
+
+
+def estimate_project(project, config):
+    """Estimate a project's weekly costs from its sample plan and the costs collated so far."""
+    config = copy.deepcopy(config)
+    short_project = project.split('/')[-1]
+    plan = pd.read_parquet(config['sample_plan_output'].format(project=short_project))
+    columns = ['groupid', 'totalcost', 'idealcost']
+    if config.get('cost_dataset'):
+        costs = read_dataset(config['cost_dataset'], config.get('cost_partitions', PARTITION_COLUMNS),
+                             filters={'project': [short_project]}, columns=columns)
+    else:
+        costs = load_parquet(config['total_cost_output'].format(project=short_project), columns=columns)
+    estimates = estimate_totals(plan, costs)
+    output = config['sample_estimate_output'].format(project=short_project)
+    log.info("Writing %d weekly estimates to %s", len(estimates), output)
+    estimates.to_parquet(output, compression='gzip')
+    return {
+        'weeks': len(estimates),
+        'analyzed': int(estimates['analyzed'].sum()) if len(estimates) else 0,
+        'missing_strata': int(estimates['missing_strata'].sum()) if len(estimates) else 0,
+        'missing_population': int(estimates['missing_population'].sum()) if len(estimates) else 0,
+    }
+
+
+async def scan_project(project, args, config, session=None):
+    """Scan a project's recent history for complete task graphs.
+
+    Returns:
+        dict summarising the scan.
+    """
     config = copy.deepcopy(config)
 
     short_project = project.split('/')[-1]
     config['total_cost_output'] = config['total_cost_output'].format(project=short_project)
-    config['pushlog_cache_file'] = config['pushlog_cache_file'].format(
-        project=project.replace('/', '_'))
+    config['pushlog_cache'] = config['pushlog_cache'].format(project=project.replace('/', '_'))
     config['staging_output'] = config['staging_output'].format(project=project)
+    if config.get('sample_plan_output'):
+        config['sample_plan_output'] = config['sample_plan_output'].format(project=short_project)
+
+    cache = PushlogCache(config['pushlog_cache'])
+    if config.get('pushlog_cache_file') and cache.last_push is None:
+        cache.import_legacy_json(
+            config['pushlog_cache_file'].format(project=project.replace('/', '_')),
+            project,
+        )
 
     log.info("Looking up pushlog for %s", project)
     pushes = await scan_pushlog(config['pushlog_url'],
@@ -117,23 +315,54 @@ async def scan_project(project, args, config):
                                 product=args['product'],
                                 starting_push=config['starting_push'],
                                 backfill_count=config['backfill_count'],
-                                cache_file=config['pushlog_cache_file'])
-
-    examined_taskgraph_ids = await find_examined_taskgraph_ids(config)
-    taskgraphs = fetch_taskgraphs_for_pushes(pushes, project, examined_taskgraph_ids)
-
-    lambda_client = boto3.client('lambda')
-
+                                cache=cache,
+                                backfill_chunk_size=config['backfill_chunk_size'],
+                                session=session)
+
+    if args.get('sample_fraction'):
+        # A sample covers its own dates, wherever the checkpoint is.
+        checkpoint = None
+        candidates = pushes.pushes_between(epoch_from_date(args.get('sample_start')), epoch_from_date(args.get('sample_end')))
+        recent = candidates
+        backfills = list()
+    else:
+        checkpoint = (pushes.read_state(SCAN_CHECKPOINT) or {}).get('pushid')
+        recent = candidate_pushes(pushes, checkpoint,
+                                  window_days=args.get('scan_window_days') or config.get('scan_window_days', SCAN_WINDOW_DAYS))
+        # Backfilled pushes are older than the window, and have a cursor of their own.
+        backfills = backfilled_pushes(pushes)
+        candidates = pd.concat([recent] + [range_pushes for _, range_pushes in backfills])
+        candidates = candidates[~candidates.index.duplicated(keep='first')]
+    log.info("%d candidate pushes for %s, from push %s and %d backfilled ranges",
+             len(candidates), project, checkpoint, len(backfills))
+
+    months = None
+    if len(candidates):
+        dates = pd.to_datetime(candidates['date'], unit='s')
+        months = months_between(dates.min(), dates.max())
+    examined_taskgraph_ids = await find_examined_taskgraph_ids(config, months=months)
+    taskgraphs, unfinished = await fetch_taskgraphs_for_pushes(candidates, project, examined_taskgraph_ids, session=session)
+    if args.get('incremental'):
+        # The analyzer keeps track of how far it got with each unfinished
+        # graph, and only writes a staged result once the graph has finished.
+        taskgraphs += unfinished
+    if args.get('sample_fraction'):
+        sampled = await sample_taskgraphs(pushes, project, args, config, session=session)
+        taskgraphs = [graph_id for graph_id in taskgraphs if graph_id in sampled]
+
+    by_graph = graph_pushes(candidates)
+    payloads = list()
     for graph_id in taskgraphs:
-        push = find_push_by_group(graph_id, project, pushes)
-        args.update({
+        push = int(by_graph[graph_id])
+        payload = dict(args)
+        payload.update({
             'groupid': graph_id,
             'data': {
                 'project': short_project,
                 'product': args['product'],
                 'groupid': graph_id,
                 'pushid': push,
-                'graph_date': pushes[project][push]['date'],
+                'graph_date': int(candidates.loc[push, 'date']),
                 'origin': 'push',
                 'totalcost': None,
                 'idealcost': None,
@@ -143,12 +372,32 @@ async def scan_project(project, args, config):
                 'artifact_projected_cost': None,
             },
         })
-        log.info("Invoking lambda for %s", graph_id)
-        lambda_client.invoke(
-            FunctionName='taskgraph_analyzer',
-            InvocationType='Event',
-            Payload=json.dumps(args),
-        )
+        payloads.append(payload)
+
+    executor = get_executor(args.get('executor', 'lambda'),
+                            workers=args.get('workers'),
+                            job_queue=args.get('job_queue'),
+                            batch_size=batch_size_from_config(config))
+    failures = await executor.submit(payloads)
+    failed = sum(len(groupids) for groupids, _ in failures)
+    if failures:
+        log.error("%d of %d graphs could not be analyzed for %s", failed, len(payloads), project)
+
+    if not args.get('sample_fraction'):
+        # Graphs just submitted may yet fail in the analyzer, so the next
+        # scan starts from the oldest of them; once they are examined it
+        # moves on, and the window stops it waiting on any one forever.
+        pending = set(taskgraphs) | set(unfinished)
+        checkpoint = next_checkpoint(recent, pending, pushes.last_push)
+        pushes.write_state(SCAN_CHECKPOINT, {'pushid': checkpoint})
+        if backfills:
+            pushes.write_state(BACKFILLED_STATE, {'ranges': remaining_backfills(backfills, pending)})
+
+    return {
+        'last_push': pushes.last_push,
+        'graphs': len(payloads),
+        'failed': failed,
+    }
 
 
 async def main(args):
@@ -158,10 +407,37 @@ async def main(args):
     os.environ['TC_CACHE_DIR'] = config['TC_CACHE_DIR']
     config['backfill_count'] = args.get('backfill_count', None)
     config['starting_push'] = args.get('starting_push', None)
+    config['backfill_chunk_size'] = args.get('backfill_chunk_size') or config.get('backfill_chunk_size', BACKFILL_CHUNK_SIZE)
+    if args.get('pushlog_url'):
+        config['pushlog_url'] = args['pushlog_url']
 
     # cope with original style, listing one project, or listing multiple
-    for project in args.get('projects', [args.get('project')]):
-        await scan_project(project, args, config)
+    projects = args.get('projects', [args.get('project')])
+
+    if args.get('estimate'):
+        return {project: estimate_project(project, config) for project in projects}
+
+    # Projects are scanned at the same time, but share one limit on connections
+    # to hg and Taskcluster. A failure in one doesn't stop the others.
+    session = new_session(limit=config.get('http_connection_limit', HTTP_CONNECTION_LIMIT))
+    try:
+        results = await asyncio.gather(
+            *[scan_project(project, args, config, session=session) for project in projects],
+            return_exceptions=True,
+        )
+    finally:
+        await session.close()
+
+    summary = dict()
+    for project, result in zip(projects, results):
+        if isinstance(result, Exception):
+            log.error("Scanning %s failed: %s", project, result, exc_info=result)
+            summary[project] = {'error': str(result)}
+        else:
+            log.info("%s: up to push %s, %d graphs submitted, %d failed",
+                     project, result['last_push'], result['graphs'], result['failed'])
+            summary[project] = result
+    return summary
 
 
 def lambda_handler(args, context):
@@ -172,7 +448,7 @@ def lambda_handler(args, context):
     if 'product' not in args:
         args['product'] = 'firefox'
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main(args))
+    return loop.run_until_complete(main(args))
 
 
 if __name__ == '__main__':
@@ -3,17 +3,37 @@ import asyncio
 import copy
 import logging
 import os
+import uuid
 
 import pandas as pd
 import yaml
 
 from measuring_ci.artifacts import get_artifact_costs
 from measuring_ci.costs import fetch_all_worker_costs, taskgraph_cost
-from measuring_ci.shipit import fetch_shipit_taskgraph_ids
-from measuring_ci.utils import semaphore_wrapper
-from taskhuddler.aio.graph import TaskGraph
+from measuring_ci.dataset import read_dataset
+from measuring_ci.files import list_files, make_dirs, remove_files
+from measuring_ci.layout import layout_options, write_cost_file
+from measuring_ci.pipeline import QUEUE_SIZE, Stage, Window, run_pipeline
+from measuring_ci.releasewarrior import read_release_taskgraph_ids_from_clone
+from measuring_ci.shipit import fetch_new_shipit_taskgraph_ids, read_high_water_marks, write_high_water_marks
+from measuring_ci.taskgraph import TaskGraph
+from measuring_ci.upsert import upsert_dataset, upsert_frame
 
 LOG_LEVEL = logging.INFO
+FETCH_WORKERS = 10
+COMPUTE_WORKERS = 2
+ARTIFACT_WORKERS = 4
+# Graphs held at once, and rows per staged batch, in streaming mode.
+STREAMING_WINDOW = 2
+STREAMING_BATCH_SIZE = 20
+RELEASE_PARTITIONS = ['product', 'month']
+# Graphs that failed costing are kept in the state file under this key, and
+# retried on later runs until they have failed this many times.
+RETRY_KEY = 'retry'
+# The newest releasewarrior-data commit processed is kept in the state file
+# too, as the clone is lost whenever Lambda starts afresh.
+RELEASEWARRIOR_KEY = 'releasewarrior'
+MAX_ATTEMPTS = 5
 
 # AWS artisinal log handling, they've already set up a handler by the time we get here
 log = logging.getLogger()
@@ -27,6 +47,10 @@ def parse_args():
     """Extract arguments."""
     parser = argparse.ArgumentParser(description="CI Costs")
     parser.add_argument('--config', type=str, default='releases.yml')
+    parser.add_argument('--streaming', action='store_true',
+                        help="Hold only a few graphs in memory at once, staging rows in batches as they're made")
+    parser.add_argument('--memory-limit-mb', type=int, default=None,
+                        help="In streaming mode, don't start on more graphs while resident memory is above this")
     return parser.parse_args()
 
 
@@ -46,6 +70,160 @@ def categorize_version(product, version):
     return 'release'
 
 
+def compute_release_costs(graph, release, worker_costs):
+    """Work out the costs of one release graph, apart from its artifacts.
+
+    Returns:
+        row of costs, with the artifact columns still to fill in.
+    """
+    full_cost, final_runs_cost = taskgraph_cost(graph, worker_costs)
+    product = release['product']
+    version = release['version'].replace('rc', '')
+    return [
+        product,
+        graph.groupid,
+        graph.earliest_start_time.strftime("%Y-%m-%d"),  # date bucket
+        categorize_version(product, version),
+        release['phase'],
+        version,
+        release['build_number'],
+        full_cost,
+        final_runs_cost,
+        len([t for t in graph.tasks()]),  # task count
+        graph.total_compute_time().total_seconds(),
+        None,
+        None,
+    ]
+
+
+class BatchWriter:
+    """Write rows of costs to a staging directory a batch at a time, as they are produced."""
+
+    def __init__(self, staging_output, columns, batch_size=STREAMING_BATCH_SIZE):
+        """Stage batches of batch_size rows under staging_output."""
+        self.staging_output = staging_output
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows = list()
+        make_dirs(staging_output)
+
+    def add(self, row):
+        """Add a row, writing out the batch once it is full."""
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write out any rows not yet written."""
+        if not self.rows:
+            return
+        output = os.path.join(self.staging_output, 'batch-{}.parquet'.format(uuid.uuid4().hex))
+        log.info("Writing %d rows to %s", len(self.rows), output)
+        pd.DataFrame(self.rows, columns=self.columns).to_parquet(output, compression='gzip')
+        self.rows = list()
+
+
+def read_staged_batches(staging_output, columns):
+    """Read the batches staged by this or an interrupted earlier run.
+
+    Returns:
+        (list of batch file names, DataFrame of their rows)
+    """
+    if not staging_output:
+        return list(), pd.DataFrame(columns=columns)
+    filenames = [os.path.join(staging_output, name) for name in list_files(staging_output) if name.endswith('.parquet')]
+    frames = [pd.read_parquet(filename) for filename in filenames]
+    if not frames:
+        return filenames, pd.DataFrame(columns=columns)
+    return filenames, pd.concat(frames, ignore_index=True, sort=False)
+
+
+def release_cost_stages(taskgraph_ids, worker_costs, config, window=None, writer=None):
+    """Pipeline stages taking a release graph ID to its row of costs.
+
+    Downloading graphs and listing artifacts wait on the network, while
+    costing is CPU bound and runs in a thread, so all three overlap.
+
+    Args:
+        window (Window): limits the graphs held in memory, from download
+            until their row is produced
+        writer (BatchWriter): if given, rows are written out as they are
+            produced instead of being returned
+    """
+    def leave():
+        if window is not None:
+            window.leave()
+
+    async def fetch(graph_id):
+        if window is not None:
+            await window.enter()
+        try:
+            return await TaskGraph(graph_id)
+        except Exception:
+            leave()
+            raise
+
+    def compute(graph):
+        try:
+            return graph, compute_release_costs(graph, taskgraph_ids[graph.groupid], worker_costs)
+        except Exception:
+            leave()
+            raise
+
+    async def artifacts(item):
+        graph, row = item
+        try:
+            row[-2:] = await get_artifact_costs(graph)
+        finally:
+            # Only the row is passed on, so the graph can be freed now.
+            leave()
+        return row
+
+    stages = [
+        Stage('fetch', fetch, workers=config.get('fetch_workers', FETCH_WORKERS)),
+        Stage('compute', compute, workers=config.get('compute_workers', COMPUTE_WORKERS), blocking=True),
+        Stage('artifacts', artifacts, workers=config.get('artifact_workers', ARTIFACT_WORKERS)),
+    ]
+    if writer is not None:
+        stages.append(Stage('write', writer.add, blocking=True))
+    return stages
+
+
+def failed_graph_id(item):
+    """The graph ID a failed pipeline item was for, whichever stage it failed in.
+
+    Items are a graph ID, then a TaskGraph, then (graph, row), then a row
+    from compute_release_costs, whose second column is the graph ID.
+    """
+    if isinstance(item, tuple):
+        item = item[0]
+    elif isinstance(item, list):
+        return item[1]
+    return getattr(item, 'groupid', item)
+
+
+def retries_after(failures, taskgraph_ids, retries):
+    """Work out which failed graphs to retry on the next run.
+
+    Args:
+        failures (list): from run_pipeline
+        taskgraph_ids (dict): graph ID to release details, for this run
+        retries (dict): graph ID to {'details', 'attempts'}, from the last run
+
+    Returns:
+        dict like retries, for the next run.
+    """
+    next_retries = dict()
+    for _, item, _ in failures:
+        graph_id = failed_graph_id(item)
+        attempts = retries.get(graph_id, {}).get('attempts', 0) + 1
+        if attempts >= MAX_ATTEMPTS:
+            log.error("Giving up on %s after %d failed attempts", graph_id, attempts)
+            continue
+        next_retries[graph_id] = {'details': taskgraph_ids[graph_id], 'attempts': attempts}
+    return next_retries
+
+
 async def scan_releases(config):
     """Scan recent history for complete task graphs."""
     config = copy.deepcopy(config)
@@ -57,8 +235,13 @@ async def scan_releases(config):
         'compute_time', 'artifact_size', 'artifact_projected_cost',
     ]
 
+    partition_cols = config.get('cost_partitions', RELEASE_PARTITIONS)
     try:
-        existing_costs = pd.read_parquet(config['total_cost_output'])
+        if config.get('cost_dataset'):
+            # Only the IDs are needed, to skip graphs already costed.
+            existing_costs = read_dataset(config['cost_dataset'], partition_cols, columns=['groupid'])
+        else:
+            existing_costs = pd.read_parquet(config['total_cost_output'])
         log.info("Loaded existing release costs")
     except Exception:
         log.info("Couldn't load existing release costs, using empty data set: %s",
@@ -66,58 +249,84 @@ async def scan_releases(config):
         existing_costs = pd.DataFrame(columns=cost_dataframe_columns)
 
     log.info("Looking up taskgraph IDs")
-    taskgraph_ids = fetch_shipit_taskgraph_ids()
-    log.info("Found %d taskgraph IDs", len(taskgraph_ids))
-
-    tasks = list()
-    semaphore = asyncio.Semaphore(10)
+    state_file = config.get('shipit_state_file')
+    high_water_marks = read_high_water_marks(state_file) if state_file else dict()
+    retries = high_water_marks.pop(RETRY_KEY, dict())
+    rw_processed = high_water_marks.pop(RELEASEWARRIOR_KEY, None)
+    taskgraph_ids, high_water_marks = await fetch_new_shipit_taskgraph_ids(
+        high_water_marks=high_water_marks,
+    )
+    rw_path = config.get('releasewarrior-data-path')
+    if rw_path:
+        # Lambda has no multiprocessing, so parse in-process.
+        if not state_file:
+            log.warning('No shipit_state_file to record the releasewarrior commit in, so every run reads since %s',
+                        config.get('since'))
+        rw_graphs, rw_head = read_release_taskgraph_ids_from_clone(
+            rw_path, since_commit=rw_processed, since=config.get('since'), max_workers=0,
+        )
+        # ShipIt knows the phase names, so prefer its details.
+        rw_graphs.update(taskgraph_ids)
+        taskgraph_ids = rw_graphs
+    for graph_id, retry in retries.items():
+        taskgraph_ids.setdefault(graph_id, retry['details'])
+    log.info("Found %d taskgraph IDs, %d of them retries", len(taskgraph_ids), len(retries))
 
+    staged_files, staged_costs = read_staged_batches(config.get('release_staging_output'), cost_dataframe_columns)
+    known_graph_ids = set(existing_costs['groupid'].astype(str)) | set(staged_costs['groupid'].astype(str))
+    new_graph_ids = list()
     for graph_id in taskgraph_ids:
-        if str(graph_id) in existing_costs['groupid'].values:
+        if str(graph_id) in known_graph_ids:
             log.debug("Already examined taskgroup %s, skipping.", graph_id)
             continue
-        tasks.append(asyncio.ensure_future(semaphore_wrapper(semaphore, TaskGraph(graph_id))))
+        new_graph_ids.append(graph_id)
 
-    log.info('Gathering %d task graphs', len(tasks))
-    taskgraphs = await asyncio.gather(*tasks)
-
-    costs = list()
-
-    log.info('Calculating costs')
     worker_costs = fetch_all_worker_costs(
         tc_csv_filename=config['costs_csv_file'],
         scriptworker_csv_filename=config.get('costs_scriptworker_csv_file'),
     )
-    for graph in taskgraphs:
-        full_cost, final_runs_cost = taskgraph_cost(graph, worker_costs)
-        artifact_size, artifact_cost = await get_artifact_costs(graph)
-        product = taskgraph_ids[graph.groupid]['product']
-        version = taskgraph_ids[graph.groupid]['version'].replace('rc', '')
-        try:
-            costs.append(
-                [
-                    product,
-                    graph.groupid,
-                    graph.earliest_start_time.strftime("%Y-%m-%d"),  # date bucket
-                    categorize_version(product, version),
-                    taskgraph_ids[graph.groupid]['phase'],
-                    version,
-                    taskgraph_ids[graph.groupid]['build_number'],
-                    full_cost,
-                    final_runs_cost,
-                    len([t for t in graph.tasks()]),  # task count
-                    graph.total_compute_time().total_seconds(),
-                    artifact_size,
-                    artifact_cost,
-                ])
-        except Exception as e:
-            log.warning('Something screwy with %s, skipping that graph: %s', graph.groupid, e)
-
-    costs_df = pd.DataFrame(costs, columns=cost_dataframe_columns)
-
-    new_costs = existing_costs.merge(costs_df, how='outer')
-    log.info("Writing parquet file %s", config['total_cost_output'])
-    new_costs.to_parquet(config['total_cost_output'], compression='gzip')
+
+    window = writer = None
+    if config.get('streaming'):
+        # Hold only a few graphs at once, and write rows out as they're made.
+        memory_limit = config.get('memory_limit_mb')
+        window = Window(config.get('streaming_window', STREAMING_WINDOW),
+                        memory_limit=memory_limit * 1024 * 1024 if memory_limit else None)
+        writer = BatchWriter(config['release_staging_output'], cost_dataframe_columns,
+                             batch_size=config.get('streaming_batch_size', STREAMING_BATCH_SIZE))
+
+    log.info('Calculating costs for %d task graphs', len(new_graph_ids))
+    costs, failures = await run_pipeline(
+        new_graph_ids,
+        release_cost_stages(taskgraph_ids, worker_costs, config, window=window, writer=writer),
+        queue_size=config.get('pipeline_queue_size', QUEUE_SIZE),
+    )
+    if failures:
+        log.warning('Skipped %d graphs that could not be costed', len(failures))
+        if not state_file:
+            log.error('No shipit_state_file to save failed graphs in, so they will not be retried')
+    if writer is not None:
+        writer.flush()
+        staged_files, staged_costs = read_staged_batches(config['release_staging_output'], cost_dataframe_columns)
+
+    costs_df = pd.concat([staged_costs, pd.DataFrame(costs, columns=cost_dataframe_columns)], ignore_index=True, sort=False)
+
+    if config.get('cost_dataset'):
+        upsert_dataset(config['cost_dataset'], costs_df, partition_cols=partition_cols, layout=layout_options(config))
+    else:
+        new_costs, _ = upsert_frame(existing_costs, costs_df)
+        log.info("Writing parquet file %s", config['total_cost_output'])
+        write_cost_file(new_costs, config['total_cost_output'], convert_types=False, **layout_options(config))
+    remove_files(staged_files)
+
+    if state_file:
+        # The marks move past failed graphs, which are retried from here instead.
+        high_water_marks[RETRY_KEY] = retries_after(failures, taskgraph_ids, retries)
+        if rw_path:
+            high_water_marks[RELEASEWARRIOR_KEY] = rw_head
+        elif rw_processed:
+            high_water_marks[RELEASEWARRIOR_KEY] = rw_processed
+        write_high_water_marks(state_file, high_water_marks)
 
 
 async def main(args):
@@ -126,6 +335,10 @@ async def main(args):
         config = yaml.load(cfg)
     os.environ['TC_CACHE_DIR'] = config['TC_CACHE_DIR']
     config['backfill_count'] = args.get('backfill_count', None)
+    if args.get('streaming'):
+        config['streaming'] = True
+    if args.get('memory_limit_mb'):
+        config['memory_limit_mb'] = args['memory_limit_mb']
 
     await scan_releases(config)
 
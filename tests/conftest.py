@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scanners and graph_analyzer sit at the top of the repository, alongside measuring_ci.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,125 @@
+import asyncio
+
+from measuring_ci import events
+from measuring_ci.events import EventEnricher, FileEventSource, MemoryEventSource, ingest_events
+from measuring_ci.jobqueue import SQLiteJobQueue
+from measuring_ci.pushlog_cache import PushlogCache
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def collect(source):
+    return [message async for message in source.events()]
+
+
+def decision_task(project='integration/autoland', pushid=None, nightly_route=None):
+    routes = []
+    if pushid is not None:
+        routes.append('index.gecko.v2.{}.pushlog-id.{}.decision'.format(project.split('/')[-1], pushid))
+    if nightly_route:
+        routes.append('index.gecko.v2.{}.latest.taskgraph.{}'.format(project, nightly_route))
+    return {
+        'created': '2019-03-01T12:00:00.000Z',
+        'routes': routes,
+        'payload': {'env': {
+            'GECKO_HEAD_REPOSITORY': 'https://hg.mozilla.org/{}/'.format(project),
+            'GECKO_HEAD_REV': 'abcdef',
+        }},
+    }
+
+
+class FakeQueue:
+    """Queue client serving task definitions from a dict."""
+
+    def __init__(self, tasks):
+        """Serve tasks, keyed by task ID."""
+        self.tasks = tasks
+
+    async def task(self, task_id):
+        """Task definition."""
+        return self.tasks[task_id]
+
+
+def enricher(tasks, config=None):
+    enricher = EventEnricher(['integration/autoland'], config or {})
+    enricher.queue = FakeQueue(tasks)
+    return enricher
+
+
+def test_file_source_skips_bad_lines(tmp_path):
+    path = tmp_path / 'events.jsonl'
+    path.write_text('{"payload": {"taskGroupId": "A"}}\n\nnot json\n{"taskGroupId": "B"}\n')
+
+    messages = run(collect(FileEventSource(str(path))))
+
+    assert [events.parse_event(message) for message in messages] == ['A', 'B']
+
+
+def test_memory_source_stops_when_closed():
+    source = MemoryEventSource([{'taskGroupId': 'A'}])
+    source.put({'taskGroupId': 'B'})
+    source.close()
+    source.put({'taskGroupId': 'C'})
+
+    assert run(collect(source)) == [{'taskGroupId': 'A'}, {'taskGroupId': 'B'}]
+
+
+def test_push_payload_prefers_cached_date(tmp_path):
+    cache_path = str(tmp_path / '{project}')
+    PushlogCache(cache_path.format(project='integration_autoland')).add_pushes(
+        [{'pushid': 7, 'date': 1234, 'changeset': 'abcdef', 'taskgraph': 'A'}])
+
+    payload = run(enricher({'A': decision_task(pushid=7)}, {'pushlog_cache': cache_path}).payload('A'))
+
+    assert payload['project'] == 'integration/autoland'
+    assert payload['data']['pushid'] == 7
+    assert payload['data']['graph_date'] == 1234
+    assert payload['data']['origin'] == 'push'
+
+
+def test_push_payload_without_cache_uses_creation_time():
+    payload = run(enricher({'A': decision_task(pushid=7)}).payload('A'))
+
+    assert payload['data']['graph_date'] == 1551441600
+
+
+def test_nightly_payload(monkeypatch):
+    async def fake_version(session, queue, group_id):
+        return '67.0a1'
+    monkeypatch.setattr(events, 'fetch_app_version', fake_version)
+    task = decision_task(project='mozilla-central', nightly_route='decision-nightly-desktop')
+
+    payload = run(enricher({'N': task}).payload('N'))
+
+    assert payload['config'] == 'nightlies.yml'
+    assert payload['data']['product'] == 'firefox'
+    assert payload['data']['version'] == '67.0a1'
+
+
+def test_ignores_other_projects_and_groups_without_pushes():
+    tasks = {
+        'T': decision_task(project='try', pushid=3),
+        'U': decision_task(),
+    }
+    assert run(enricher(tasks).payload('T')) is None
+    assert run(enricher(tasks).payload('U')) is None
+
+
+def test_ingest_events_queues_each_group_once(tmp_path):
+    job_queue = SQLiteJobQueue(str(tmp_path / 'queue.db'))
+    source = MemoryEventSource([{'taskGroupId': 'A'}, {'taskGroupId': 'A'}, {'taskGroupId': 'T'}, {'other': 1}])
+    source.close()
+    tasks = {'A': decision_task(pushid=7), 'T': decision_task(project='try', pushid=3)}
+
+    counts = run(ingest_events(source, enricher(tasks), job_queue))
+
+    assert counts == {'events': 4, 'queued': 1, 'known': 1, 'ignored': 2}
+    job, = job_queue.lease()
+    assert job.groupid == 'A'
+    assert job.payload['data']['pushid'] == 7
@@ -0,0 +1,66 @@
+import json
+
+from measuring_ci.jobqueue import SQSJobQueue
+
+
+class FakeSQS:
+    """Just enough of the SQS client for SQSJobQueue, with messages kept in order."""
+
+    def __init__(self):
+        """Start empty."""
+        self.messages = []
+        self.visibility = {}
+        self.receives = {}
+        self.deduplication = set()
+
+    def send_message(self, QueueUrl, MessageBody, MessageGroupId=None, MessageDeduplicationId=None):
+        """Add a message, dropping repeated deduplication IDs."""
+        if MessageDeduplicationId in self.deduplication:
+            return
+        self.deduplication.add(MessageDeduplicationId)
+        handle = str(len(self.messages))
+        self.messages.append((handle, MessageBody))
+        self.visibility[handle] = 0
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, VisibilityTimeout, AttributeNames):
+        """Hide and return visible messages."""
+        received = []
+        for handle, body in self.messages:
+            if len(received) < MaxNumberOfMessages and self.visibility[handle] == 0:
+                self.visibility[handle] = VisibilityTimeout
+                self.receives[handle] = self.receives.get(handle, 0) + 1
+                received.append({'Body': body, 'ReceiptHandle': handle,
+                                 'Attributes': {'ApproximateReceiveCount': str(self.receives[handle])}})
+        return {'Messages': received}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        """Remove a message."""
+        self.messages = [message for message in self.messages if message[0] != ReceiptHandle]
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        """Hide a message for a while, or show it again with 0."""
+        self.visibility[ReceiptHandle] = VisibilityTimeout
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        """Message counts."""
+        hidden = sum(1 for handle, _ in self.messages if self.visibility[handle])
+        return {'Attributes': {'ApproximateNumberOfMessages': str(len(self.messages) - hidden),
+                               'ApproximateNumberOfMessagesNotVisible': str(hidden)}}
+
+
+def test_sqs_queue_lease_fail_complete():
+    sqs = FakeSQS()
+    queue = SQSJobQueue('https://sqs.example/1/analysis.fifo', retry_delay=0, sqs_client=sqs)
+    assert queue.enqueue('A', {'groupid': 'A'})
+    queue.enqueue('A', {'groupid': 'A'})
+    queue.enqueue('B', {'groupid': 'B'})
+
+    first, second = queue.lease(count=5)
+    assert (first.groupid, first.attempts, second.groupid) == ('A', 1, 'B')
+    assert queue.counts() == {'ready': 0, 'leased': 2}
+
+    queue.fail(first, 'boom')
+    queue.complete(second)
+    retried, = queue.lease()
+    assert (retried.groupid, retried.attempts) == ('A', 2)
+    assert json.loads(sqs.messages[0][1])['payload'] == {'groupid': 'A'}
@@ -0,0 +1,41 @@
+import pandas as pd
+import pyarrow as pa
+
+from measuring_ci.dataset import append_rows, read_dataset
+from measuring_ci.parquet import tables_to_frame
+
+
+def cost_row(groupid, totalcost, artifact_size):
+    return pd.DataFrame({
+        'project': ['autoland'],
+        'groupid': [groupid],
+        'graph_date': ['2019-03-12'],
+        'totalcost': [totalcost],
+        'artifact_size': [artifact_size],
+    })
+
+
+def test_tables_to_frame_keeps_file_order_across_schemas():
+    tables = [
+        pa.Table.from_pandas(pd.DataFrame({'groupid': ['a'], 'size': [1.0]}), preserve_index=False),
+        pa.Table.from_pandas(pd.DataFrame({'groupid': ['b'], 'size': [None]}), preserve_index=False),
+        pa.Table.from_pandas(pd.DataFrame({'groupid': ['c'], 'size': [3.0]}), preserve_index=False),
+    ]
+    assert list(tables_to_frame(tables)['groupid']) == ['a', 'b', 'c']
+
+
+def test_tables_to_frame_no_tables():
+    assert tables_to_frame([]) is None
+
+
+def test_read_dataset_keeps_the_last_row_written(tmp_path):
+    dataset = str(tmp_path / 'costs') + '/'
+    append_rows(dataset, cost_row('A', 1.0, 5.0))
+    # All null, so this file's artifact_size column has a different type.
+    append_rows(dataset, cost_row('B', 2.0, None))
+    append_rows(dataset, cost_row('B', 3.0, 7.0))
+
+    costs = read_dataset(dataset).set_index('groupid')
+    assert costs.loc['B', 'totalcost'] == 3.0
+    assert costs.loc['B', 'artifact_size'] == 7.0
+    assert costs.loc['A', 'totalcost'] == 1.0
@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from measuring_ci import pushlog
+from measuring_ci.pushlog import BACKFILL_STATE, PushStreamParser, resume_backfill
+from measuring_ci.pushlog_cache import PushlogCache
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def json_pushes(first, last):
+    """A version 2 json-pushes response body for pushes first to last."""
+    return json.dumps({
+        'lastpushid': last,
+        'pushes': {
+            str(pushid): {'date': 1500000000 + pushid, 'changesets': ['a{}'.format(pushid), 'cset{}'.format(pushid)]}
+            for pushid in range(first, last + 1)
+        },
+    }, indent=1)
+
+
+def expected(first, last):
+    return [(pushid, 1500000000 + pushid, 'cset{}'.format(pushid)) for pushid in range(first, last + 1)]
+
+
+def parse_in_chunks(text, size):
+    parser = PushStreamParser()
+    pushes = list()
+    for offset in range(0, len(text), size):
+        pushes.extend(parser.feed(text[offset:offset + size]))
+    return pushes + parser.close()
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 64, 100000])
+def test_parser_handles_any_chunking(size):
+    assert parse_in_chunks(json_pushes(95, 105), size) == expected(95, 105)
+
+
+def test_parser_waits_for_numbers_split_across_chunks():
+    parser = PushStreamParser()
+    # The date could still be 15000001230, so the push isn't complete yet.
+    assert parser.feed('{"pushes": {"12": {"changesets": ["c"], "date": 150000012') == []
+    assert parser.feed('3}') == [(12, 1500000123, 'c')]
+    assert parser.feed('}, "lastpushid": 12}') == []
+    assert parser.close() == []
+
+
+def test_parser_rejects_truncated_response():
+    parser = PushStreamParser()
+    parser.feed(json_pushes(1, 3)[:-20])
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+async def pushlog_stub(requests):
+    """Serve json-pushes for startID/endID ranges, streamed in small chunks."""
+    async def handler(request):
+        start_id, end_id = int(request.query['startID']), int(request.query['endID'])
+        requests.append((start_id, end_id))
+        response = web.StreamResponse()
+        await response.prepare(request)
+        body = json_pushes(start_id + 1, end_id).encode('utf-8')
+        for offset in range(0, len(body), 50):
+            await response.write(body[offset:offset + 50])
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/{project:.+}/json-pushes', handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def test_resume_backfill_fetches_only_missing_chunks(tmp_path, monkeypatch):
+    async def find_taskgroup(revision, project, product, session=None):
+        return 'graph-' + revision
+    monkeypatch.setattr(pushlog, 'find_taskgroup_by_revision', find_taskgroup)
+
+    cache = PushlogCache(str(tmp_path))
+    # An earlier run wrote its first chunk before being cut short.
+    cache.add_pushes([{'pushid': pushid, 'date': 1500000000 + pushid, 'changeset': 'cset{}'.format(pushid),
+                       'taskgraph': 'graph-cset{}'.format(pushid)} for pushid in range(1, 11)])
+    cache.write_state(BACKFILL_STATE, {'start': 1, 'end': 30})
+
+    async def resume():
+        requests = list()
+        server = await pushlog_stub(requests)
+        url = 'http://{}:{}/'.format(server.host, server.port) + '{project}/json-pushes?version=2'
+        try:
+            async with aiohttp.ClientSession() as session:
+                resumed = await resume_backfill(url, cache, project='integration/autoland', chunk_size=10, session=session)
+        finally:
+            await server.close()
+        return resumed, requests
+
+    resumed, requests = run(resume())
+
+    assert resumed
+    assert sorted(requests) == [(10, 20), (20, 30)]
+    assert cache.read_state(BACKFILL_STATE) is None
+    reopened = PushlogCache(str(tmp_path))
+    assert reopened.missing_pushes(1, 30) == []
+    assert reopened.get(25)['taskgraph'] == 'graph-cset25'
+    assert not run(resume_backfill('unused', reopened))
@@ -0,0 +1,59 @@
+import pyarrow.parquet as pq
+
+from measuring_ci import pushlog_cache
+from measuring_ci.pushlog_cache import PushlogCache
+
+
+def entries(first, last, taskgraph='graph{}', date_base=1000000):
+    return [{'pushid': pushid, 'date': date_base + pushid * 60, 'changeset': 'cset{}'.format(pushid),
+             'taskgraph': taskgraph.format(pushid)} for pushid in range(first, last + 1)]
+
+
+def test_last_written_segment_wins(tmp_path):
+    cache = PushlogCache(str(tmp_path))
+    cache.add_pushes(entries(11, 20))
+    # A backfill refetches older pushes after newer ones were written.
+    cache.add_pushes(entries(1, 15, taskgraph='fixed{}'))
+
+    reopened = PushlogCache(str(tmp_path))
+    assert reopened.get(12)['taskgraph'] == 'fixed12'
+    assert reopened.get(18)['taskgraph'] == 'graph18'
+    assert reopened.pushes.loc[15, 'taskgraph'] == 'fixed15'
+
+
+def test_reads_only_overlapping_row_groups(tmp_path, monkeypatch):
+    monkeypatch.setattr(pushlog_cache, 'ROW_GROUP_SIZE', 10)
+    cache = PushlogCache(str(tmp_path))
+    cache.add_pushes(entries(1, 100))
+    cache.compact()
+    cache.add_pushes(entries(101, 110))
+
+    read = list()
+    original = pq.ParquetFile.read_row_group
+
+    def counting_read_row_group(self, index, *args, **kwargs):
+        read.append(index)
+        return original(self, index, *args, **kwargs)
+
+    monkeypatch.setattr(pq.ParquetFile, 'read_row_group', counting_read_row_group)
+    reopened = PushlogCache(str(tmp_path))
+    recent = reopened.pushes_between(start=1000000 + 95 * 60)
+    assert list(recent.index) == list(range(95, 111))
+    # The last row group of the base, and the segment.
+    assert len(read) == 2
+
+    read.clear()
+    assert reopened.missing_pushes(42, 45) == []
+    assert len(read) == 1
+    assert reopened.missing_pushes(105, 115) == list(range(111, 116))
+
+
+def test_files_without_write_time_are_oldest(tmp_path):
+    cache = PushlogCache(str(tmp_path))
+    legacy = cache._path('segment-0000000001-0000000005.parquet')
+    pushlog_cache.pd.DataFrame(entries(1, 5, taskgraph='old{}')).to_parquet(legacy, index=False)
+    cache = PushlogCache(str(tmp_path))
+    cache.add_pushes(entries(3, 4, taskgraph='new{}'))
+
+    reopened = PushlogCache(str(tmp_path))
+    assert [reopened.get(pushid)['taskgraph'] for pushid in range(1, 6)] == ['old1', 'old2', 'new3', 'new4', 'old5']
@@ -0,0 +1,83 @@
+import asyncio
+
+from measuring_ci import nightly, sampling
+from measuring_ci.ratelimit import RateLimitedClient, TokenBucket
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class CountingBucket(TokenBucket):
+    """Bucket that never makes anyone wait, and counts the tokens taken."""
+
+    blocking = False
+
+    def __init__(self):
+        """Start with none taken."""
+        super().__init__(rate=1)
+        self.taken = 0
+
+    def reserve(self, count=1):
+        """Count the tokens."""
+        self.taken += count
+        return 0
+
+
+class FakeQueue:
+    """Queue client that only builds URLs."""
+
+    def buildUrl(self, method, *args):
+        """Artifact URL."""
+        return 'https://queue.example/{}/{}'.format(method, '/'.join(args))
+
+
+class FakeResponse:
+    """Response to any request."""
+
+    content_length = 123
+
+    async def __aenter__(self):
+        """Enter."""
+        return self
+
+    async def __aexit__(self, *exc):
+        """Exit."""
+
+    def raise_for_status(self):
+        """Always fine."""
+
+    async def text(self):
+        """A parameters.yml."""
+        return 'app_version: 67.0a1\n'
+
+
+class FakeSession:
+    """Session recording requested URLs."""
+
+    def __init__(self):
+        """Start with none requested."""
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        """Record a GET."""
+        self.urls.append(url)
+        return FakeResponse()
+
+    head = get
+
+
+def test_artifact_requests_take_tokens():
+    bucket = CountingBucket()
+    queue = RateLimitedClient(FakeQueue(), bucket)
+    session = FakeSession()
+
+    assert run(sampling.fetch_graph_size(session, queue, 'GROUP')) == 123
+    assert run(nightly.fetch_app_version(session, queue, 'DECISION')) == '67.0a1'
+
+    assert bucket.taken == 2
+    assert session.urls[0].endswith('GROUP/public/task-graph.json')
@@ -0,0 +1,35 @@
+import json
+import subprocess
+
+from measuring_ci.releasewarrior import read_release_taskgraph_ids_from_clone
+
+
+def commit_release(origin, version, graphid):
+    (origin / 'archive').mkdir(exist_ok=True)
+    (origin / 'archive' / '{}.json'.format(version)).write_text(json.dumps({
+        'product': 'firefox', 'version': version, 'inflight': [{'buildnum': 1, 'graphids': [['promote', graphid]]}],
+    }))
+    git = ['git', '-C', str(origin), '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    subprocess.run(git + ['add', 'archive'], check=True)
+    subprocess.run(git + ['commit', '--quiet', '-m', version], check=True)
+    return subprocess.run(git + ['rev-parse', 'HEAD'], stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+
+
+def test_processed_commit_survives_a_fresh_clone(tmp_path):
+    origin = tmp_path / 'origin'
+    subprocess.run(['git', 'init', '--quiet', '-b', 'master', str(origin)], check=True)
+    first = commit_release(origin, '66.0', 'GRAPH1')
+    second = commit_release(origin, '67.0', 'GRAPH2')
+
+    # Each run clones afresh, as on a cold Lambda start.
+    graphs, head = read_release_taskgraph_ids_from_clone(str(tmp_path / 'run1'), url=str(origin), max_workers=0)
+    assert set(graphs) == {'GRAPH1', 'GRAPH2'}
+    assert head == second
+
+    graphs, head = read_release_taskgraph_ids_from_clone(str(tmp_path / 'run2'), url=str(origin),
+                                                         since_commit=first, max_workers=0)
+    assert set(graphs) == {'GRAPH2'}
+
+    graphs, _ = read_release_taskgraph_ids_from_clone(str(tmp_path / 'run3'), url=str(origin),
+                                                      since_commit=head, max_workers=0)
+    assert graphs == {}
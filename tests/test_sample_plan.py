@@ -0,0 +1,38 @@
+import pandas as pd
+
+from measuring_ci.sampling import sample_strata
+from pushlog_scanner import plan_matches, sample_parameters
+
+
+def saved_plan(args):
+    strata = pd.DataFrame({'groupid': ['g{}'.format(i) for i in range(20)], 'project': 'autoland',
+                           'week': '2019-01', 'size_bucket': [i % 2 for i in range(20)]})
+    plan = sample_strata(strata, fraction=args['sample_fraction'], seed=args.get('sample_seed'))
+    return plan.assign(**sample_parameters(args))
+
+
+def test_plan_is_reused_with_the_same_parameters():
+    args = {'sample_fraction': 0.2, 'sample_start': '2019-01-01', 'sample_end': '2019-02-01'}
+    plan = saved_plan(args)
+
+    assert plan_matches(plan, args)
+    # The saved seed is what makes the plan repeatable.
+    assert plan_matches(plan, dict(args, sample_seed=int(plan['seed'].iloc[0])))
+
+
+def test_plan_is_rebuilt_when_parameters_change():
+    args = {'sample_fraction': 0.2, 'sample_start': '2019-01-01', 'sample_end': '2019-02-01', 'sample_seed': 5}
+    plan = saved_plan(args)
+
+    assert not plan_matches(plan, dict(args, sample_fraction=0.5))
+    assert not plan_matches(plan, dict(args, sample_start='2018-12-01'))
+    assert not plan_matches(plan, dict(args, sample_end=None))
+    assert not plan_matches(plan, dict(args, sample_seed=6))
+    assert not plan_matches(plan, dict(args, sample_minimum=5))
+
+
+def test_plans_saved_without_parameters_are_rebuilt():
+    args = {'sample_fraction': 0.2}
+    plan = saved_plan(args).drop(columns=['fraction'])
+
+    assert not plan_matches(plan, args)
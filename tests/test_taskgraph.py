@@ -0,0 +1,38 @@
+import asyncio
+import json
+import time
+
+from measuring_ci import taskgraph
+from measuring_ci.taskgraph import TaskGraph, lease_path
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_cached_empty_group_is_not_refetched(tmp_path, monkeypatch):
+    monkeypatch.setenv('TC_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(taskgraph, 'LEASE_POLL_INTERVAL', 0)
+    cache_file = str(tmp_path / 'EMPTY.json')
+    (tmp_path / 'EMPTY.json').write_text('[]')
+    # Another loader still holds the lease, so waiting on it would hang.
+    with open(lease_path(cache_file), 'w') as f:
+        json.dump({'owner': 'someone', 'expires': time.time() + 600}, f)
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("listed a cached task group")
+    monkeypatch.setattr(TaskGraph, '_list_task_group', fail)
+
+    graph = run(TaskGraph('EMPTY'))
+
+    assert graph.tasks() == []
+
+
+def test_missing_cache_is_none(tmp_path):
+    assert taskgraph.read_cache(str(tmp_path / 'missing.json')) is None
+    (tmp_path / 'empty.json').write_text('[]')
+    assert taskgraph.read_cache(str(tmp_path / 'empty.json')) == []